@@ -2,6 +2,9 @@ import random as rand
 
 import numpy
 import pytest
+import torch
+
+from whisper.model import ModelDimensions, Whisper
 
 
 def pytest_configure(config):
@@ -12,3 +15,24 @@ def pytest_configure(config):
 def random():
     rand.seed(42)
     numpy.random.seed(42)
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(42)
+    dims = ModelDimensions(
+        n_mels=80,
+        n_audio_ctx=1500,
+        n_audio_state=64,
+        n_audio_head=4,
+        n_audio_layer=2,
+        n_vocab=51865,
+        n_text_ctx=448,
+        n_text_state=64,
+        n_text_head=4,
+        n_text_layer=2,
+    )
+    model = Whisper(dims).eval()
+    with torch.no_grad():
+        model.decoder.positional_embedding.normal_(0, 0.02)
+    return model
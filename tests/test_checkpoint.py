@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+import whisper
+from whisper.checkpoint import load_checkpoint
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16])
+def test_convert_checkpoint(model, tmp_path, dtype):
+    checkpoint = {"dims": model.dims.__dict__, "model_state_dict": model.state_dict()}
+    torch.save(checkpoint, tmp_path / "model.pt")
+    path = str(tmp_path / "model.safetensors")
+    whisper.convert_checkpoint(str(tmp_path / "model.pt"), path, dtype=dtype)
+
+    assert load_checkpoint(path)["dims"] == model.dims.__dict__
+    loaded = whisper.load_model(path, device="cpu")
+    assert all(p.dtype == torch.float32 for p in loaded.parameters())
+
+    torch.manual_seed(0)
+    mel = torch.randn(1, 80, 3000)
+    tokens = torch.randint(0, 50000, (1, 10))
+    with torch.no_grad():
+        expected = model(mel, tokens)
+        actual = loaded(mel, tokens)
+    assert torch.allclose(
+        actual, expected, atol=1e-4 if dtype == torch.float32 else 0.1
+    )
+
+
+def test_load_float16_checkpoint(model, tmp_path):
+    state_dict = {k: v.half() for k, v in model.state_dict().items()}
+    checkpoint = {"dims": model.dims.__dict__, "model_state_dict": state_dict}
+    torch.save(checkpoint, tmp_path / "model.pt")
+
+    loaded = whisper.load_model(str(tmp_path / "model.pt"), device="cpu")
+    tensors = [*loaded.parameters(), *loaded.buffers()]
+    assert all(t.device.type == "cpu" for t in tensors)
+    assert all(p.dtype == torch.float32 for p in loaded.parameters())
+
+    loaded_state_dict = loaded.state_dict()
+    assert list(loaded_state_dict.keys()) == list(state_dict.keys())
+    assert all(
+        torch.equal(loaded_state_dict[k], v.float()) for k, v in state_dict.items()
+    )
@@ -0,0 +1,129 @@
+import hashlib
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+import whisper
+from whisper.download import download_file
+
+
+@pytest.fixture
+def model_url(tmp_path):
+    data = os.urandom(100_000)
+    sha256 = hashlib.sha256(data).hexdigest()
+    (tmp_path / sha256).mkdir()
+    (tmp_path / sha256 / "model.pt").write_bytes(data)
+    return (tmp_path / sha256 / "model.pt").as_uri(), data
+
+
+def test_download_verification_cache(model_url, tmp_path, monkeypatch):
+    url, data = model_url
+    root = str(tmp_path / "cache")
+    path = whisper._download(url, root, in_memory=False)
+    assert open(path, "rb").read() == data
+
+    hashed = []
+    sha256 = whisper._sha256
+    monkeypatch.setattr(whisper, "_sha256", lambda p: hashed.append(p) or sha256(p))
+
+    # verified during the download; not hashed again while the file is unchanged
+    assert whisper._download(url, root, in_memory=True) == data
+    assert hashed == []
+
+    os.utime(path, ns=(0, 0))
+    assert whisper._download(url, root, in_memory=False) == path
+    assert hashed == [path]
+    assert whisper._download(url, root, in_memory=False) == path
+    assert hashed == [path]
+
+    # a corrupted file with the same size is re-downloaded
+    with open(path, "r+b") as f:
+        f.write(b"\0" * 10)
+    with pytest.warns(UserWarning, match="re-downloading"):
+        assert whisper._download(url, root, in_memory=True) == data
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    data: bytes
+    requests: list
+    failures: set  # ranges to fail once, by closing the connection halfway
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.data)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        self.requests.append(header)
+        start, end = map(int, header[len("bytes=") :].split("-"))
+        body = self.data[start : end + 1]
+        self.send_response(206)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(self.data)}")
+        self.end_headers()
+        if header in self.failures:
+            self.failures.remove(header)
+            self.wfile.write(body[: len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    data = os.urandom(1_000_000)
+    handler = type(
+        "Handler",
+        (RangeRequestHandler,),
+        {"data": data, "requests": [], "failures": set()},
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/model.pt", handler
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_ranges(http_server, tmp_path):
+    url, handler = http_server
+    sha256 = hashlib.sha256(handler.data).hexdigest()
+    target = str(tmp_path / "model.pt")
+
+    handler.failures.add("bytes=300000-399999")
+    download_file(url, target, sha256, chunk_size=100_000)
+    assert open(target, "rb").read() == handler.data
+    assert len(handler.requests) == 11  # 10 chunks, one retried
+    assert not os.path.exists(target + ".part.json")
+
+    with pytest.raises(RuntimeError, match="checksum"):
+        download_file(url, str(tmp_path / "other.pt"), "0" * 64, chunk_size=100_000)
+    assert not os.path.exists(str(tmp_path / "other.pt.part"))
+
+
+def test_download_resume(http_server, tmp_path):
+    url, handler = http_server
+    sha256 = hashlib.sha256(handler.data).hexdigest()
+    target = str(tmp_path / "model.pt")
+
+    # an interrupted download, with only the first half of the chunks complete
+    with open(target + ".part", "wb") as f:
+        f.write(handler.data[:500_000] + b"\0" * 500_000)
+    with open(target + ".part.json", "w") as f:
+        progress = {"url": url, "size": len(handler.data), "chunk_size": 100_000}
+        json.dump({**progress, "done": [0, 1, 2, 3, 4]}, f)
+
+    download_file(url, target, sha256, chunk_size=100_000)
+    assert open(target, "rb").read() == handler.data
+    assert sorted(handler.requests) == [
+        f"bytes={start}-{start + 99_999}"
+        for start in range(500_000, 1_000_000, 100_000)
+    ]
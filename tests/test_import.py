@@ -0,0 +1,72 @@
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ["torch", "numba", "tiktoken", "tqdm"]
+
+
+def run_python(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *args], capture_output=True, text=True, timeout=60
+    )
+
+
+def test_import_is_lazy():
+    code = f"""
+import sys
+import time
+
+start = time.perf_counter()
+import whisper
+import whisper.cli
+import whisper.normalizers
+
+whisper.available_models()
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))
+"""
+    result = run_python("-c", code)
+    assert result.returncode == 0, result.stderr
+    elapsed, loaded = result.stdout.splitlines()
+    assert loaded == ""
+    assert float(elapsed) < 1.0
+
+
+def test_lazy_attributes():
+    code = """
+import whisper
+
+assert "Whisper" in dir(whisper)
+assert whisper.Whisper.__module__ == "whisper.model"
+assert callable(whisper.transcribe)
+
+import whisper.transcribe
+
+assert callable(whisper.transcribe)
+"""
+    result = run_python("-c", code)
+    assert result.returncode == 0, result.stderr
+
+    # the model imports the transcribe submodule without having accessed the function first
+    code = """
+import whisper
+import whisper.model
+
+assert callable(whisper.transcribe)
+assert whisper.Whisper.transcribe is whisper.transcribe
+"""
+    result = run_python("-c", code)
+    assert result.returncode == 0, result.stderr
+
+
+def test_cli_startup():
+    start = time.perf_counter()
+    result = run_python("-m", "whisper", "--help")
+    assert result.returncode == 0, result.stderr
+    assert "--model" in result.stdout
+
+    result = run_python("-m", "whisper", "x.wav", "--highlight_words", "True")
+    assert result.returncode == 2
+    assert "requires --word_timestamps True" in result.stderr
+    assert time.perf_counter() - start < 2.0
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import torch
+
+from whisper.audio import log_mel_spectrogram, pad_or_trim
+from whisper.decoding import detect_language
+from whisper.lid import identify_languages, window_offsets
+from whisper.tokenizer import get_tokenizer
+
+
+def test_detect_language_projection(model):
+    torch.manual_seed(0)
+    mel = torch.randn(3, 80, 3000)
+    tokenizer = get_tokenizer(True, num_languages=model.num_languages)
+    language_tokens, language_probs = detect_language(model, mel, tokenizer)
+
+    # the same as masking the logits of the full vocabulary
+    sot = torch.tensor([[tokenizer.sot]] * 3)
+    with torch.no_grad():
+        logits = model.logits(sot, model.embed_audio(mel))[:, 0]
+    mask = torch.ones(logits.shape[-1], dtype=torch.bool)
+    mask[list(tokenizer.all_language_tokens)] = False
+    logits[:, mask] = -np.inf
+
+    assert language_tokens.tolist() == logits.argmax(dim=-1).tolist()
+    expected = logits.softmax(dim=-1)[:, list(tokenizer.all_language_tokens)]
+    actual = [list(probs.values()) for probs in language_probs]
+    assert np.allclose(actual, expected, atol=1e-6)
+
+
+def test_window_offsets():
+    assert window_offsets(100, 5) == [0]
+    assert window_offsets(480000 * 3, 1) == [0]
+    assert window_offsets(480000 * 3, 3) == [0, 480000, 960000]
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 16])
+def test_identify_languages(model, batch_size):
+    torch.manual_seed(0)
+    audio = [torch.randn(16000 * seconds) * 0.1 for seconds in [5, 70, 20, 31]]
+    tokenizer = get_tokenizer(True, num_languages=model.num_languages)
+
+    inputs = [audio[0], "nonexistent.wav", *audio[1:]]
+    results = list(
+        identify_languages(model, inputs, n_windows=3, batch_size=batch_size)
+    )
+    assert [r["audio"] for r in results] == [0, "nonexistent.wav", 2, 3, 4]
+    assert "error" in results[1]
+    assert [len(r["windows"]) for r in results if "error" not in r] == [1, 3, 1, 3]
+
+    # a single window per file gives the language of the first 30 seconds
+    results = list(identify_languages(model, audio, batch_size=batch_size))
+    for result, samples in zip(results, audio):
+        mel = log_mel_spectrogram(pad_or_trim(samples))
+        _, probs = detect_language(model, mel, tokenizer)
+        assert result["language"] == max(probs, key=probs.get)
+        assert result["probability"] == pytest.approx(max(probs.values()), abs=1e-6)
+
+
+def test_identify_languages_dtype(model, monkeypatch):
+    import whisper.lid
+
+    dtypes = []
+
+    def spy(model, mel, tokenizer):
+        dtypes.append(mel.dtype)
+        return detect_language(model, mel, tokenizer)
+
+    monkeypatch.setattr(whisper.lid, "detect_language", spy)
+    audio = [torch.randn(16000) * 0.1]
+
+    # float32 on CPU, whatever the dtype of the weights
+    with pytest.warns(UserWarning, match="FP16 is not supported on CPU"):
+        list(identify_languages(model.half(), audio))
+    list(identify_languages(model, audio, fp16=False))
+    assert dtypes == [torch.float32, torch.float32]
@@ -0,0 +1,249 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+
+import pytest
+import torch
+
+from whisper.decoding import (
+    DecodingOptions,
+    PyTorchInference,
+    StaticCacheInference,
+    decode_tasks,
+)
+from whisper.model import Whisper
+
+
+@pytest.mark.parametrize("n_initial", [3, 40])
+def test_static_cache_inference(model, n_initial):
+    torch.manual_seed(0)
+    audio_features = model.embed_audio(torch.randn(1, 80, 3000))
+    initial_tokens = torch.randint(0, 50000, (2, n_initial))
+
+    def greedy_logits(inference):
+        tokens, result = initial_tokens, []
+        with torch.no_grad():
+            for i in range(5):
+                logits = inference.logits(tokens, audio_features)
+                result.append(logits)
+                next_tokens = logits[:, -1].argmax(dim=-1, keepdim=True)
+                tokens = torch.cat([tokens, next_tokens], dim=-1)
+                if i == 2:  # swap the two sequences, as beam search would
+                    inference.rearrange_kv_cache([1, 0])
+                    tokens = tokens[[1, 0]]
+        inference.cleanup_caching()
+        return result
+
+    expected = greedy_logits(PyTorchInference(model, n_initial))
+    actual = greedy_logits(StaticCacheInference(model, n_initial))
+
+    for a, e in zip(actual, expected):
+        assert a.shape == e.shape
+        assert torch.allclose(a, e, atol=1e-4)
+
+
+def test_fuse_qkv(model):
+    torch.manual_seed(0)
+    mel = torch.randn(1, 80, 3000)
+    tokens = torch.randint(0, 50000, (1, 10))
+    state_dict = model.state_dict()
+
+    with torch.no_grad():
+        expected = model(mel, tokens)
+        fused = Whisper(model.dims).eval().fuse_qkv()
+        fused.load_state_dict(state_dict)
+        actual = fused(mel, tokens)
+
+    assert fused.decoder.blocks[0].attn.qkv is not None
+    assert fused.decoder.blocks[0].cross_attn.qkv is None
+    assert torch.allclose(actual, expected, atol=1e-4)
+
+    # the state_dict keeps the original checkpoint format
+    fused_state_dict = fused.state_dict()
+    assert list(fused_state_dict.keys()) == list(state_dict.keys())
+    assert all(torch.equal(fused_state_dict[k], v) for k, v in state_dict.items())
+
+
+def test_alignment_heads_qk(model):
+    torch.manual_seed(0)
+    audio_features = model.embed_audio(torch.randn(1, 80, 3000))
+    tokens = torch.randint(0, 50000, (1, 20))
+
+    with torch.no_grad():
+        all_qk, qk = [], []
+        expected = model.decoder(tokens, audio_features, cross_qk=all_qk)
+        logits = model.decoder(
+            tokens, audio_features, cross_qk=qk, qk_heads=[[], [1, 3]]
+        )
+
+    assert torch.allclose(logits, expected, atol=1e-4)
+    assert [t.shape[1] for t in all_qk] == [4, 4]
+    assert qk[0] is None
+    assert torch.allclose(qk[1], all_qk[1][:, [1, 3]], atol=1e-5)
+
+
+def test_disable_sdpa(model, monkeypatch):
+    import whisper.model
+    from whisper.model import MultiHeadAttention, disable_sdpa
+
+    if not whisper.model.SDPA_AVAILABLE:
+        pytest.skip("the fused attention is not available")
+    calls = []
+    sdpa = whisper.model.scaled_dot_product_attention
+
+    def count_calls(*args, **kwargs):
+        calls.append(1)
+        return sdpa(*args, **kwargs)
+
+    monkeypatch.setattr(whisper.model, "scaled_dot_product_attention", count_calls)
+
+    torch.manual_seed(0)
+    mel = torch.randn(1, 80, 3000)
+    tokens = torch.randint(0, 50000, (1, 10))
+    with torch.no_grad():
+        expected = model(mel, tokens)
+        assert calls
+        calls.clear()
+        with disable_sdpa():
+            actual = model(mel, tokens)
+    assert not calls
+    assert MultiHeadAttention.use_sdpa
+    assert torch.allclose(actual, expected, atol=1e-4)
+
+
+def test_concurrent_inference(model):
+    from whisper.decoding import DecodingOptions
+    from whisper.timing import find_alignment
+    from whisper.tokenizer import get_tokenizer
+
+    torch.manual_seed(0)
+    mels = [torch.randn(80, 3000) for _ in range(4)]
+    tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+    text_tokens = tokenizer.encode(" hello world")
+    options = DecodingOptions(language="en", fp16=False, sample_len=10, beam_size=2)
+
+    def run(mel):
+        words = find_alignment(model, tokenizer, text_tokens, mel, 3000)
+        result = model.decode(mel, options)
+        return [(w.start, w.end) for w in words], result.tokens
+
+    expected = [run(mel) for mel in mels]
+    with ThreadPoolExecutor(len(mels)) as executor:
+        actual = list(executor.map(run, mels))
+
+    assert actual == expected
+
+
+def test_recorded_alignment(model):
+    torch.manual_seed(0)
+    audio_features = model.embed_audio(torch.randn(1, 80, 3000)).repeat(2, 1, 1)
+    initial_tokens = torch.randint(0, 50000, (2, 4))
+    inference = PyTorchInference(model, 4, record_alignment=True, n_text_tokens=50000)
+
+    tokens = initial_tokens
+    with torch.no_grad():
+        for i in range(5):
+            logits = inference.logits(tokens, audio_features)
+            next_tokens = logits[:, -1, :50000].argmax(dim=-1, keepdim=True)
+            tokens = torch.cat([tokens, next_tokens], dim=-1)
+            if i == 2:  # both beams continue from the second sequence
+                inference.rearrange_kv_cache([1, 1])
+                tokens = tokens[[1, 1]]
+
+        # the same weights and probabilities as teacher-forcing the sampled tokens
+        qk, heads = [], model.alignment_heads_per_layer()
+        logits = model.decoder(tokens, audio_features, cross_qk=qk, qk_heads=heads)
+        weights = torch.cat([w for w in qk if w is not None], dim=1)
+        probs = logits[:, 3:-2, :50000].softmax(dim=-1)
+        probs = probs.gather(-1, tokens[:, 4:-1, None])[..., 0]
+
+    for i in range(2):
+        recorded_weights, recorded_probs = inference.recorded_alignment(i)
+        assert recorded_weights.shape == (weights.shape[1], 5, 1500)
+        assert torch.allclose(recorded_weights, weights[i, :, 3:-1], atol=1e-4)
+        assert torch.allclose(recorded_probs, probs[i], atol=1e-5)
+
+
+def test_vocabulary_logits(model):
+    torch.manual_seed(0)
+    audio_features = model.embed_audio(torch.randn(2, 80, 3000))
+    tokens = torch.randint(0, 50000, (2, 5))
+    next_tokens = torch.tensor([[50], [7000]])
+    vocab = torch.tensor([13, 50, 7000, 50257, 50364, 51864])
+
+    expected, actual = PyTorchInference(model, 5), PyTorchInference(
+        model, 5, vocab=vocab
+    )
+    with torch.no_grad():
+        # the first pass covers the whole vocabulary, the following ones only `vocab`
+        for inference in [expected, actual]:
+            assert inference.logits(tokens, audio_features).shape[-1] == 51865
+        tokens = torch.cat([tokens, next_tokens], dim=-1)
+        expected = expected.logits(tokens, audio_features)
+        actual = actual.logits(tokens, audio_features)
+
+    assert actual.shape == (2, 1, len(vocab))
+    assert torch.allclose(actual, expected[..., vocab], atol=1e-4)
+
+
+@pytest.mark.parametrize("beam_size", [None, 3])
+def test_vocabulary_decoding(model, beam_size):
+    torch.manual_seed(0)
+    with torch.no_grad():
+        # flatter logits, for the normalization of no_speech_prob to make a difference
+        model.decoder.token_embedding.weight.mul_(0.01)
+    mel = torch.randn(2, 80, 3000)
+    vocabulary = list(range(200, 400)) + [13, 11, 30]
+    options = DecodingOptions(
+        language="en", sample_len=10, beam_size=beam_size, fp16=False
+    )
+    vocab_options = replace(options, vocabulary=vocabulary)
+
+    results = model.decode(mel, vocab_options)
+    for result in results:
+        # the special tokens and timestamps, from 50257 on, are always allowed
+        assert all(t in vocabulary or t >= 50257 for t in result.tokens)
+
+    # the same as the static-cache inference, which suppresses the other tokens instead, and
+    # no_speech_prob is normalized over the whole vocabulary, as without `vocabulary`
+    model.compiled_decoder_step = model.decoder.forward_static
+    try:
+        expected = model.decode(mel, vocab_options)
+    finally:
+        model.compiled_decoder_step = None
+    unrestricted = model.decode(mel, options)
+    for result, expected_result, unrestricted_result in zip(
+        results, expected, unrestricted
+    ):
+        assert result.tokens == expected_result.tokens
+        assert result.avg_logprob == pytest.approx(
+            expected_result.avg_logprob, abs=1e-4
+        )
+        assert result.no_speech_prob == pytest.approx(
+            expected_result.no_speech_prob, rel=1e-4
+        )
+        assert result.no_speech_prob == pytest.approx(
+            unrestricted_result.no_speech_prob, rel=1e-4
+        )
+
+
+@pytest.mark.parametrize("beam_size", [None, 3])
+@pytest.mark.parametrize("prompts", [[[100, 200, 300], [400, 500]], [[100, 200], []]])
+def test_decode_tasks(model, beam_size, prompts):
+    torch.manual_seed(0)
+    mel = torch.randn(2, 80, 3000)
+    options = DecodingOptions(
+        language="de", sample_len=10, beam_size=beam_size, fp16=False
+    )
+
+    transcriptions, translations = decode_tasks(model, mel, options, prompts=prompts)
+
+    # the same as decoding each task on its own, with its full prompt
+    for task, prompt, results in zip(
+        ["transcribe", "translate"], prompts, [transcriptions, translations]
+    ):
+        expected = model.decode(mel, options, task=task, prompt=prompt)
+        assert [r.tokens for r in results] == [r.tokens for r in expected]
+        for result, expected_result in zip(results, expected):
+            assert result.avg_logprob == pytest.approx(
+                expected_result.avg_logprob, abs=1e-5
+            )
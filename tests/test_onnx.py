@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+import whisper
+from whisper.decoding import DecodingOptions
+
+pytest.importorskip("onnxruntime")
+onnx = pytest.importorskip("onnx")
+
+
+def test_onnx_runtime(model, tmp_path):
+    from whisper.onnx import OnnxRuntime, export_onnx
+
+    export_onnx(model.fuse_qkv(), str(tmp_path))
+    onnx_runtime = OnnxRuntime(str(tmp_path))
+
+    torch.manual_seed(0)
+    mel = torch.randn(80, 3000)
+    for options in [
+        DecodingOptions(language="en", fp16=False, sample_len=10),
+        DecodingOptions(language="en", fp16=False, sample_len=10, beam_size=3),
+    ]:
+        model.onnx_runtime = None
+        expected = model.decode(mel, options)
+        model.onnx_runtime = onnx_runtime
+        actual = model.decode(mel, options)
+
+        assert actual.tokens == expected.tokens
+        assert actual.avg_logprob == pytest.approx(expected.avg_logprob, abs=1e-4)
+
+
+def test_onnx_language_and_alignment(model, tmp_path):
+    from whisper.onnx import OnnxRuntime, export_onnx
+    from whisper.timing import find_alignment_batch
+    from whisper.tokenizer import get_tokenizer
+
+    export_onnx(model.fuse_qkv(), str(tmp_path))
+
+    # the decoder step holds a single copy of the token embedding
+    graph = onnx.load(str(tmp_path / "decoder.onnx")).graph
+    n_vocab = model.dims.n_vocab
+    embeddings = [t for t in graph.initializer if n_vocab in t.dims]
+    assert len(embeddings) == 1
+
+    torch.manual_seed(0)
+    mel = torch.randn(2, 80, 3000)
+    tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+    texts = [" hello world", " the quick brown fox"]
+    text_tokens = [tokenizer.encode(text) for text in texts]
+
+    def run():
+        _, language_probs = model.detect_language(mel)
+        words = find_alignment_batch(model, tokenizer, text_tokens, mel, [3000, 2400])
+        return language_probs, words
+
+    model.onnx_runtime = None
+    expected_probs, expected_words = run()
+    model.onnx_runtime = OnnxRuntime(str(tmp_path))
+    actual_probs, actual_words = run()
+
+    for actual, expected in zip(actual_probs, expected_probs):
+        assert list(actual) == list(expected)
+        assert np.allclose(list(actual.values()), list(expected.values()), atol=1e-5)
+    for actual, expected in zip(actual_words, expected_words):
+        assert [(w.word, w.start, w.end) for w in actual] == [
+            (w.word, w.start, w.end) for w in expected
+        ]
+        assert np.allclose(
+            [w.probability for w in actual], [w.probability for w in expected]
+        )
+
+
+def test_onnx_export_cache(model, tmp_path):
+    from whisper.onnx import STAMP_FILE
+
+    # two different checkpoints with the same file name
+    paths = []
+    for i in range(2):
+        os.makedirs(tmp_path / str(i))
+        with torch.no_grad():
+            model.decoder.token_embedding.weight.mul_(1.5)
+        checkpoint = {
+            "dims": model.dims.__dict__,
+            "model_state_dict": model.state_dict(),
+        }
+        paths.append(str(tmp_path / str(i) / "model.pt"))
+        torch.save(checkpoint, paths[-1])
+
+    root = str(tmp_path / "cache")
+    mel = torch.randn(1, 80, 3000)
+    options = DecodingOptions(language="en", fp16=False, sample_len=5)
+    for path in paths:
+        loaded = whisper.load_model(
+            path, "cpu", download_root=root, backend="onnxruntime"
+        )
+        expected = whisper.load_model(path, "cpu").decode(mel, options)
+        assert [r.tokens for r in loaded.decode(mel, options)] == [
+            r.tokens for r in expected
+        ]
+        # the sessions run everything, without the PyTorch weights
+        assert all(p.numel() == 0 for p in loaded.parameters())
+        loaded.detect_language(mel)
+
+    exports = sorted(os.listdir(os.path.join(root, "onnx")))
+    assert len(exports) == 2
+
+    # an export of another version is made again
+    stamp_path = os.path.join(root, "onnx", exports[0], STAMP_FILE)
+    stamp = open(stamp_path).read()
+    with open(stamp_path, "w") as f:
+        f.write(stamp.replace('"version": ', '"version": -'))
+    loaded_again = [
+        whisper.load_model(path, "cpu", download_root=root, backend="onnxruntime")
+        for path in paths
+    ]
+    assert open(stamp_path).read() == stamp
+    assert sorted(os.listdir(os.path.join(root, "onnx"))) == exports
+    assert all(m.onnx_runtime is not None for m in loaded_again)
@@ -0,0 +1,91 @@
+import threading
+
+import torch
+
+import whisper
+from whisper.pool import model_bytes
+
+
+def test_model_pool(model, tmp_path):
+    checkpoint = {"dims": model.dims.__dict__, "model_state_dict": model.state_dict()}
+    torch.save(checkpoint, tmp_path / "a.pt")
+    torch.save(checkpoint, tmp_path / "b.pt")
+    a, b = str(tmp_path / "a.pt"), str(tmp_path / "b.pt")
+
+    size = model_bytes(model)
+    pool = whisper.ModelPool(memory_budget=int(size * 2.2))
+
+    model_a = pool.get(a, device="cpu")
+    assert pool.get(a, device="cpu") is model_a
+    assert pool.resident_bytes == model_bytes(model_a)
+
+    model_a16 = pool.get(a, device="cpu", dtype=torch.float16)
+    assert model_a16 is not model_a
+    assert model_a16.decoder.token_embedding.weight.dtype == torch.float16
+    assert pool.resident_bytes < size * 1.6
+
+    # exceeds the budget, evicting the least recently used model
+    assert pool.get(a, device="cpu") is model_a
+    pool.get(b, device="cpu")
+    assert len(pool) == 2
+    assert (a, "cpu", torch.float16) not in pool
+    assert (a, "cpu", torch.float32) in pool
+
+    mel = torch.randn(1, 80, 3000)
+    tokens = torch.randint(0, 50000, (1, 10))
+    with torch.no_grad():
+        expected = model_a(mel, tokens)
+        actual = model_a16(mel, tokens)
+    assert torch.allclose(actual, expected, atol=0.1)
+
+
+def test_model_pool_concurrent_loads(model, monkeypatch):
+    loads = []
+    release = threading.Event()
+
+    def load_model(name, **kwargs):
+        loads.append(name)
+        if name == "slow":
+            assert release.wait(timeout=10)
+        return model
+
+    monkeypatch.setattr(whisper, "load_model", load_model)
+    pool = whisper.ModelPool()
+    pool.get("cached", device="cpu")
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(pool.get("slow", device="cpu")))
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # a cached model is returned while another one is being loaded
+    assert pool.get("cached", device="cpu") is model
+    release.set()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert results == [model, model]
+    assert loads == ["cached", "slow"]
+    assert not pool.loading
+
+
+def test_model_pool_cuda_device(model, monkeypatch):
+    devices = []
+
+    def load_model(name, device, **kwargs):
+        devices.append(device)
+        return model
+
+    monkeypatch.setattr(whisper, "load_model", load_model)
+    monkeypatch.setattr(torch.cuda, "current_device", lambda: 1)
+    pool = whisper.ModelPool()
+
+    # a device without an index is the current one
+    assert pool.get("tiny", device="cuda") is model
+    assert pool.get("tiny", device="cuda:1") is model
+    assert pool.get("tiny", device=torch.device("cuda")) is model
+    assert devices == [torch.device("cuda:1")]
+    assert ("tiny", "cuda:1", torch.float32) in pool
@@ -1,9 +1,23 @@
+import subprocess
+import sys
+
 import numpy as np
 import pytest
 import scipy.ndimage
 import torch
-
-from whisper.timing import dtw_cpu, dtw_cuda, median_filter
+import torch.nn.functional as F
+
+from whisper.timing import (
+    dtw,
+    dtw_batch,
+    dtw_cpu,
+    dtw_cuda,
+    find_alignment,
+    find_alignment_batch,
+    median_filter,
+    median_filter_cpu,
+    sakoe_chiba_band,
+)
 
 sizes = [
     (10, 20),
@@ -52,6 +66,80 @@ def test_dtw(N: int, M: int):
     assert np.allclose(trace, dtw_trace)
 
 
+def test_dtw_batch():
+    xs = [np.random.randn(N, M) for N, M in sizes]
+    for trace, x in zip(dtw_batch(xs), xs):
+        assert np.array_equal(trace, dtw_cpu(x))
+
+
+@pytest.mark.parametrize("N, M", sizes)
+@pytest.mark.parametrize("radius", [0, 5, 50])
+def test_dtw_band(N: int, M: int, radius: int):
+    x = np.random.random((N, M))
+    lower, upper = sakoe_chiba_band(N, M, radius)
+    text_indices, time_indices = dtw_batch([x], [(lower, upper)])[0]
+
+    assert (text_indices[0], time_indices[0]) == (0, 0)
+    assert (text_indices[-1], time_indices[-1]) == (N - 1, M - 1)
+    assert np.all(np.diff(text_indices) >= 0) and np.all(np.diff(time_indices) >= 0)
+    assert np.all(lower[text_indices] <= time_indices)
+    assert np.all(time_indices <= upper[text_indices])
+
+    # the band does not change the path when it contains it; compared with the same kernel over
+    # the full matrix, as the float32 costs of dtw_cpu() compile to a different rounding
+    diagonal = np.round(np.arange(N) * (M - 1) / (N - 1)).astype(int)
+    x[np.arange(N), diagonal] -= 10
+    band = sakoe_chiba_band(N, M, max(radius, 1 + M // N))
+    path = dtw(torch.from_numpy(x), band)
+    assert np.array_equal(path, dtw_batch([x])[0])
+
+
+@pytest.mark.parametrize("fill", [0.0, np.nan])
+def test_dtw_band_ties(fill):
+    # the ties and NaN costs, e.g. of uniform attention weights, that make dtw_cpu() step left
+    # stay within the band, where the first cell of each row has nothing on its left
+    x = np.full((5, 300), fill)
+    lower, upper = sakoe_chiba_band(5, 300, 10)
+    text_indices, time_indices = dtw_batch([x], [(lower, upper)])[0]
+
+    assert (text_indices[-1], time_indices[-1]) == (4, 299)
+    assert np.all(lower[text_indices] <= time_indices)
+    assert np.all(time_indices <= upper[text_indices])
+
+
+def test_warm_up():
+    # in a new process, since the kernels compiled by the other tests would hide missing ones
+    code = """
+import torch
+
+from whisper.model import ModelDimensions, Whisper
+from whisper.timing import _dtw_batch, _median_filter_rows, backtrace, dtw_cpu
+from whisper.timing import find_alignment
+from whisper.timing import sakoe_chiba_band, warm_up
+from whisper.tokenizer import get_tokenizer
+
+# _dtw_trace() is compiled into _dtw_batch() rather than on its own
+kernels = [_dtw_batch, _median_filter_rows, backtrace, dtw_cpu]
+warm_up()
+signatures = [list(kernel.signatures) for kernel in kernels]
+assert all(len(s) > 0 for s in signatures), signatures
+
+# the kernels compiled by warm_up() are the ones that word timestamps run on CPU
+dims = ModelDimensions(80, 1500, 64, 4, 2, 51865, 448, 64, 4, 2)
+model = Whisper(dims).eval()
+tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+tokens = tokenizer.encode(" hello world")
+mel = torch.randn(80, 3000)
+find_alignment(model, tokenizer, tokens, mel, 3000)
+find_alignment(model, tokenizer, tokens, mel, 3000, band=sakoe_chiba_band(3, 1500, 100))
+assert [list(kernel.signatures) for kernel in kernels] == signatures
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, timeout=300
+    )
+    assert result.returncode == 0, result.stderr
+
+
 @pytest.mark.requires_cuda
 @pytest.mark.parametrize("N, M", sizes)
 def test_dtw_cuda_equivalence(N: int, M: int):
@@ -94,3 +182,47 @@ def test_median_filter_equivalence(shape):
         filtered_gpu = median_filter(x.cuda(), filter_width).cpu()
 
         assert np.allclose(filtered_cpu, filtered_gpu)
+
+
+@pytest.mark.parametrize("shape", shapes)
+def test_median_filter_cpu(shape):
+    x = torch.randn(*shape)
+    x[..., ::3] = 0.5  # repeated values
+    padded = F.pad(x.reshape(1, -1, x.shape[-1]), (3, 3, 0, 0), mode="reflect")
+
+    expected = padded.unfold(-1, 7, 1).sort()[0][..., 3]
+    assert torch.equal(median_filter_cpu(padded, 7), expected)
+
+    x[..., 0] = float("nan")
+    assert median_filter(x, 7).shape == x.shape
+
+
+def test_median_filter_cpu_full_window():
+    # (heads, tokens, frames) of the alignment weights of a full 30-second window
+    x = torch.randn(6, 200, 1500)
+    padded = F.pad(x, (3, 3, 0, 0), mode="reflect")
+
+    expected = padded.unfold(-1, 7, 1).sort()[0][..., 3]
+    assert torch.equal(median_filter_cpu(padded, 7), expected)
+
+
+def test_find_alignment_batch(model):
+    from whisper.tokenizer import get_tokenizer
+
+    torch.manual_seed(0)
+    tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+    texts = [" hello world", "", " the quick brown fox jumps over the lazy dog", " hi"]
+    text_tokens = [tokenizer.encode(text) for text in texts]
+    mel = torch.randn(len(texts), 80, 3000)
+    num_frames = [3000, 3000, 2400, 1000]
+
+    actual = find_alignment_batch(model, tokenizer, text_tokens, mel, num_frames)
+    for words, tokens, window, frames in zip(actual, text_tokens, mel, num_frames):
+        expected = find_alignment(model, tokenizer, tokens, window, frames)
+        assert [w.word for w in words] == [w.word for w in expected]
+        times = [(w.start, w.end) for w in words]
+        assert times == [(w.start, w.end) for w in expected]
+        assert np.allclose(
+            [w.probability for w in words], [w.probability for w in expected]
+        )
+    assert actual[1] == []
@@ -1,6 +1,17 @@
+import marshal
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 
-from whisper.tokenizer import get_tokenizer
+from whisper.tokenizer import (
+    IncrementalDetokenizer,
+    Tokenizer,
+    _tokenizer_cache_path,
+    _write_tokenizer_cache,
+    get_encoding,
+    get_tokenizer,
+)
 
 
 @pytest.mark.parametrize("multilingual", [True, False])
@@ -32,3 +43,119 @@ def test_split_on_unicode():
 
     assert words == [" elle", " est", " l", "'", "\ufffd", "é", "rit", "oire"]
     assert word_tokens == [[8404], [871], [287], [6], [246], [526], [3210], [20378]]
+
+
+def test_split_on_unicode_multibyte():
+    tokenizer = get_tokenizer(multilingual=True, language="ja")
+
+    text = "こんにちは、世界！😀👍🏽 다람쥐 " + "".join(
+        map(chr, range(0x20000, 0x20010))
+    )
+    tokens = [tokenizer.timestamp_begin, *tokenizer.encode(text), tokenizer.eot]
+    words, word_tokens = tokenizer.split_tokens_on_unicode(tokens)
+
+    assert "".join(words) == tokenizer.decode_with_timestamps(tokens)
+    assert sum(word_tokens, []) == tokens
+    assert "\ufffd" not in "".join(words)
+    assert all(tokenizer.decode(t) == w for t, w in zip(word_tokens[1:-1], words[1:-1]))
+
+    # an incomplete character, which is followed by an unrelated one
+    tokens = [4222, 237, 50369, 121]
+    words, word_tokens = tokenizer.split_tokens_on_unicode(tokens)
+    assert words == ["\ufffd", "\ufffd", "<|0.10|>", "\ufffd"]
+    assert word_tokens == [[4222], [237], [50369], [121]]
+
+
+@pytest.mark.parametrize("name", ["gpt2", "multilingual"])
+def test_tokenizer_cache(tmp_path, monkeypatch, name):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    cache_path = _tokenizer_cache_path(name, 99)
+    assert not os.path.exists(cache_path)
+
+    built = get_encoding.__wrapped__(name)
+    assert os.path.exists(cache_path)
+    loaded = get_encoding.__wrapped__(name)
+
+    text = "Hello, world! ♪ 다람쥐 헌 쳇바퀴에 타고파 <|endoftext|>"
+    assert built.encode(text, allowed_special="all") == loaded.encode(
+        text, allowed_special="all"
+    )
+    assert built.n_vocab == loaded.n_vocab
+
+    expected = Tokenizer(encoding=built, num_languages=99)
+    actual = Tokenizer(encoding=loaded, num_languages=99)
+    assert actual.special_tokens == expected.special_tokens
+    assert actual.timestamp_begin == expected.timestamp_begin
+    assert actual.all_language_tokens == expected.all_language_tokens
+    assert actual.non_speech_tokens == expected.non_speech_tokens
+    assert Tokenizer(encoding=loaded, num_languages=50).all_language_tokens == (
+        expected.all_language_tokens[:50]
+    )
+
+    with open(cache_path, "rb") as f:
+        payload = f.read()
+    for corrupted in [b"corrupted", payload[: len(payload) // 2], payload[:1]]:
+        with open(cache_path, "wb") as f:
+            f.write(corrupted)
+        assert get_encoding.__wrapped__(name).encode(text, allowed_special="all") == (
+            built.encode(text, allowed_special="all")
+        )
+    assert os.listdir(os.path.dirname(cache_path)) == [os.path.basename(cache_path)]
+
+
+def test_tokenizer_cache_writers(tmp_path, monkeypatch):
+    cache_path = str(tmp_path / "tokenizer" / "cache.marshal")
+    caches = [{"source": (i, i), "ranks": {b"a" * 1000: i}} for i in range(8)]
+    with ThreadPoolExecutor(len(caches)) as executor:
+        list(executor.map(lambda c: _write_tokenizer_cache(cache_path, c), caches))
+
+    # one of the writes, whole, and no temporary files left behind
+    assert os.listdir(tmp_path / "tokenizer") == ["cache.marshal"]
+    with open(cache_path, "rb") as f:
+        assert marshal.loads(f.read()) in caches
+
+    # nor after a failed write
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    _write_tokenizer_cache(cache_path, caches[0])
+    assert os.listdir(tmp_path / "tokenizer") == ["cache.marshal"]
+
+
+@pytest.mark.parametrize("timestamps", [False, True])
+def test_incremental_detokenizer(timestamps):
+    tokenizer = get_tokenizer(multilingual=True, language="ko")
+    text = " 다람쥐 헌 쳇바퀴에 타고파 😀👍🏽 " + "".join(
+        map(chr, range(0x20000, 0x20008))
+    )
+    tokens = [tokenizer.timestamp_begin, *tokenizer.encode(text)]
+    tokens += [tokenizer.timestamp_begin + 50, *tokenizer.encode(" 🇯🇵 日本語")]
+    tokens += [tokenizer.eot, 4222]  # ends with an incomplete character
+
+    detokenizer = IncrementalDetokenizer(tokenizer, timestamps=timestamps)
+    pieces = [detokenizer.append(token) for token in tokens] + [detokenizer.flush()]
+
+    decode = tokenizer.decode_with_timestamps if timestamps else tokenizer.decode
+    assert "".join(pieces) == decode(tokens)
+    assert "�" not in "".join(pieces[:-2])
+    assert pieces[-1] == "�"
+
+    detokenizer.reset()
+    assert detokenizer.extend(tokens[1:8]) == tokenizer.decode(tokens[1:8])
+
+
+def test_vocabulary():
+    tokenizer = get_tokenizer(multilingual=True, language="en")
+    vocabulary = tokenizer.vocabulary([" hello world", " the quick brown fox"])
+
+    assert set(tokenizer.encode(" hello world")) <= set(vocabulary)
+    assert len(vocabulary) < 300 and max(vocabulary) < tokenizer.eot
+
+    # any other text can still be spelled out with the single-byte tokens
+    text = " 다람쥐 😀"
+    byte_tokens = [
+        tokenizer.encoding.encode_single_token(bytes([b])) for b in text.encode()
+    ]
+    assert set(byte_tokens) <= set(vocabulary)
+    assert tokenizer.decode(byte_tokens) == text
@@ -1,9 +1,11 @@
+import importlib
 import os
 
 import pytest
 import torch
 
 import whisper
+from whisper.model import ModelDimensions, Whisper
 from whisper.tokenizer import get_tokenizer
 
 
@@ -40,3 +42,176 @@ def test_transcribe(model_name: str):
                 timing_checked = True
 
     assert timing_checked
+
+
+@pytest.mark.parametrize("model_name", ["tiny", "tiny.en"])
+def test_align(model_name: str):
+    model = whisper.load_model(model_name)
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    text = (
+        "And so, my fellow Americans, ask not what your country can do for you, "
+        "ask what you can do for your country."
+    )
+
+    result = whisper.align(model, audio_path, text, language="en")
+    assert result["text"] == text
+    words = [w for s in result["segments"] for w in s["words"]]
+    assert "".join(w["word"] for w in words).strip() == text
+
+    for timing in words:
+        assert timing["start"] <= timing["end"]
+        if timing["word"].strip(" ,") == "Americans":
+            assert timing["start"] <= 1.8
+            assert timing["end"] >= 1.8
+
+
+def test_align_windows(model):
+    audio = torch.randn(45 * 16000) * 0.1
+    text = " ".join(["hello world"] * 40)
+
+    result = whisper.align(model, audio, text, language="en")
+    assert [s["seek"] for s in result["segments"]] == [0, 3000]
+    words = [w for s in result["segments"] for w in s["words"]]
+    assert " ".join(w["word"].strip() for w in words) == text
+    assert all(0 <= w["start"] <= w["end"] <= 45 for w in words)
+    assert words[-1]["start"] >= 30
+
+    # the windows of different lengths are aligned as they would be one at a time
+    assert whisper.align(model, audio, text, language="en", batch_size=1) == result
+
+    with pytest.raises(ValueError, match="text context"):
+        whisper.align(model, audio, " ".join(["hello world"] * 400), language="en")
+
+
+def test_align_dtype(model, monkeypatch):
+    # the module, which the `transcribe` function of the package shadows
+    transcribe_module = importlib.import_module("whisper.transcribe")
+
+    dtypes = []
+    find_alignment_batch = transcribe_module.find_alignment_batch
+
+    def spy(model, tokenizer, text_tokens, mel, *args, **kwargs):
+        dtypes.append(mel.dtype)
+        return find_alignment_batch(model, tokenizer, text_tokens, mel, *args, **kwargs)
+
+    monkeypatch.setattr(transcribe_module, "find_alignment_batch", spy)
+    audio = torch.randn(5 * 16000) * 0.1
+
+    # float32 on CPU, whatever the dtype of the weights
+    with pytest.warns(UserWarning, match="FP16 is not supported on CPU"):
+        whisper.align(model.half(), audio, "hello world", language="en")
+    whisper.align(model, audio, "hello world", language="en", fp16=False)
+    assert dtypes == [torch.float32, torch.float32]
+
+
+def test_language_per_window(model, monkeypatch):
+    torch.manual_seed(0)
+    audio = torch.randn(45 * 16000) * 0.1
+    encoder_calls = []
+    forward = model.encoder.forward
+    monkeypatch.setattr(
+        model.encoder, "forward", lambda x: encoder_calls.append(x) or forward(x)
+    )
+
+    result = whisper.transcribe(
+        model,
+        audio,
+        temperature=(0.0, 0.2),
+        sample_len=8,
+        fp16=False,
+        language_per_window=True,
+    )
+    seeks = sorted({s["seek"] for s in result["segments"]})
+    assert len(seeks) > 1
+    assert len(encoder_calls) == len(seeks)
+    assert all(s["language"] in whisper.tokenizer.LANGUAGES for s in result["segments"])
+    assert result["language"] == result["segments"][0]["language"]
+
+
+@pytest.mark.parametrize("condition_on_previous_text", [False, True])
+def test_with_translation(model, monkeypatch, condition_on_previous_text):
+    torch.manual_seed(0)
+    audio = torch.randn(45 * 16000) * 0.1
+    encoder_calls = []
+    forward = model.encoder.forward
+    monkeypatch.setattr(
+        model.encoder, "forward", lambda x: encoder_calls.append(x) or forward(x)
+    )
+
+    options = dict(
+        language="de",
+        temperature=(0.0, 0.2),
+        sample_len=8,
+        fp16=False,
+        condition_on_previous_text=condition_on_previous_text,
+        initial_prompt="Guten Tag",
+    )
+    torch.manual_seed(0)
+    expected = whisper.transcribe(model, audio, **options)
+    encoder_calls.clear()
+
+    # each window is encoded once, for both tasks and their fallbacks
+    torch.manual_seed(0)
+    result = whisper.transcribe(model, audio, with_translation=True, **options)
+    assert len(encoder_calls) == len({s["seek"] for s in result["segments"]})
+    assert result["text"] == expected["text"]
+    assert result["segments"] == expected["segments"]
+
+    translation = result["translation"]
+    assert {s["seek"] for s in translation["segments"]} <= {
+        s["seek"] for s in result["segments"]
+    }
+    assert [s["id"] for s in translation["segments"]] == list(
+        range(len(translation["segments"]))
+    )
+    assert translation["text"] == "".join(s["text"] for s in translation["segments"])
+
+
+def test_cascade_model(model):
+    # a larger model with more mel bins and languages, so its timestamp tokens are offset
+    torch.manual_seed(1)
+    dims = ModelDimensions(**{**model.dims.__dict__, "n_mels": 128, "n_vocab": 51866})
+    cascade_model = Whisper(dims).eval()
+    with torch.no_grad():
+        cascade_model.decoder.positional_embedding.normal_(0, 0.02)
+
+    torch.manual_seed(0)
+    audio = (torch.randn(45 * 16000) * 0.1).numpy()
+    options = dict(language="de", sample_len=8, fp16=False, no_speech_threshold=None)
+
+    # every window is decoded again, like transcribing with the larger model only
+    torch.manual_seed(0)
+    expected = whisper.transcribe(cascade_model, audio, **options)
+    torch.manual_seed(0)
+    result = whisper.transcribe(
+        model,
+        audio,
+        cascade_model=cascade_model,
+        cascade_logprob_threshold=0,
+        **options,
+    )
+    assert result["text"] == expected["text"]
+    keys = ["seek", "start", "end", "text", "temperature", "avg_logprob"]
+    assert [[s[k] for k in keys] for s in result["segments"]] == [
+        [s[k] for k in keys] for s in expected["segments"]
+    ]
+    timestamp_begin = get_tokenizer(True).timestamp_begin
+    for segment, expected_segment in zip(result["segments"], expected["segments"]):
+        assert segment["tokens"] == [
+            t - 1 if t > timestamp_begin else t for t in expected_segment["tokens"]
+        ]
+
+    # no window is decoded again
+    expected = whisper.transcribe(model, audio, temperature=0.0, **options)
+    result = whisper.transcribe(
+        model,
+        audio,
+        cascade_model=cascade_model,
+        cascade_logprob_threshold=None,
+        cascade_compression_ratio_threshold=None,
+        cascade_no_speech_threshold=None,
+        logprob_threshold=None,
+        compression_ratio_threshold=None,
+        **options,
+    )
+    assert result["segments"] == expected["segments"]
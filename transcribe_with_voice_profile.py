@@ -19,6 +19,7 @@ warnings.filterwarnings("ignore")
 MODEL_SIZE = "large-v3"  # Most accurate model
 OUTPUT_DIR = Path.home() / "Documents" / "whisper_transcriptions"
 OUTPUT_DIR.mkdir(exist_ok=True)
+MODEL_POOL = whisper.ModelPool()  # models are loaded once and shared between the passes
 
 def analyze_pitch(audio_data: np.ndarray, sample_rate: int) -> Dict:
     """Analyze pitch characteristics of speaker's voice"""
@@ -79,7 +80,7 @@ def create_voice_profile(voice_sample_path: str) -> Path:
     audio_data, sample_rate = librosa.load(voice_sample_path, sr=16000)
     
     # Initialize Whisper model for analysis
-    model = whisper.load_model("base")
+    model = MODEL_POOL.get("base")
     
     # Transcribe sample to capture speech patterns
     result = model.transcribe(audio_data, 
@@ -143,7 +144,7 @@ def transcribe_with_profile(audio_path: str, profile_path: Path) -> Tuple[Path,
     
     # Load best model for transcription
     print(f"📥 Loading Whisper model: {MODEL_SIZE}")
-    model = whisper.load_model(MODEL_SIZE)
+    model = MODEL_POOL.get(MODEL_SIZE)
     
     # Load audio
     audio_data, sample_rate = librosa.load(audio_path, sr=16000)
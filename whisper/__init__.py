@@ -1,19 +1,77 @@
 import hashlib
+import importlib
 import io
+import json
 import os
-import urllib
 import warnings
-from typing import List, Optional, Union
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
-import torch
-from tqdm import tqdm
-
-from .audio import load_audio, log_mel_spectrogram, pad_or_trim
-from .decoding import DecodingOptions, DecodingResult, decode, detect_language
-from .model import ModelDimensions, Whisper
-from .transcribe import transcribe
 from .version import __version__
 
+if TYPE_CHECKING:
+    import torch
+
+    from .audio import load_audio, log_mel_spectrogram, pad_or_trim
+    from .decoding import DecodingOptions, DecodingResult, decode, detect_language
+    from .lid import identify_languages
+    from .model import ModelDimensions, Whisper
+    from .pool import ModelPool
+    from .transcribe import align, transcribe
+
+# the public API that is imported on first use, to keep `import whisper` free of torch and numba
+_LAZY_ATTRIBUTES = {
+    "load_audio": "audio",
+    "log_mel_spectrogram": "audio",
+    "pad_or_trim": "audio",
+    "DecodingOptions": "decoding",
+    "DecodingResult": "decoding",
+    "decode": "decoding",
+    "detect_language": "decoding",
+    "identify_languages": "lid",
+    "ModelDimensions": "model",
+    "Whisper": "model",
+    "ModelPool": "pool",
+    "transcribe": "transcribe",
+    "align": "transcribe",
+}
+_SUBMODULES = [
+    "audio",
+    "checkpoint",
+    "decoding",
+    "download",
+    "lid",
+    "model",
+    "normalizers",
+    "onnx",
+    "pool",
+    "timing",
+    "tokenizer",
+    "transcribe",
+    "utils",
+]
+
+
+def _import_attribute(name: str):
+    # importing the `whisper.transcribe` submodule binds it on the package, over the function of
+    # the same name; the function is bound again once the import is done. The package imports
+    # the submodule through here so that `whisper.transcribe` stays the function.
+    module = importlib.import_module("." + _LAZY_ATTRIBUTES[name], __name__)
+    value = globals()[name] = getattr(module, name)
+    return value
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRIBUTES:
+        return _import_attribute(name)
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> List[str]:
+    return sorted({*globals(), *_LAZY_ATTRIBUTES, *_SUBMODULES})
+
+
 _MODELS = {
     "tiny.en": "https://openaipublic.azureedge.net/main/whisper/models/d3dd57d32accea0b295c96e26691aa14d8822fac7d9d27d5dc00b4ca2826dd03/tiny.en.pt",
     "tiny": "https://openaipublic.azureedge.net/main/whisper/models/65147644a518d12f04e32d6f3b26facc3f8dd46e5390956a9424a650c0ce22b9/tiny.pt",
@@ -51,6 +109,37 @@ _ALIGNMENT_HEADS = {
 }
 
 
+def _sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _file_signature(path: str) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "inode": stat.st_ino}
+
+
+def _is_verified(path: str, sha256: str) -> bool:
+    # the sidecar records the checksum of the file as it was when last hashed
+    try:
+        with open(path + ".sha256.json") as f:
+            verified = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return verified == {"sha256": sha256, **_file_signature(path)}
+
+
+def _mark_verified(path: str, sha256: str):
+    try:
+        with open(path + ".sha256.json", "w") as f:
+            json.dump({"sha256": sha256, **_file_signature(path)}, f)
+    except OSError:
+        pass  # e.g. a read-only cache directory; the file will be hashed again next time
+
+
 def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
     os.makedirs(root, exist_ok=True)
 
@@ -61,38 +150,22 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        with open(download_target, "rb") as f:
-            model_bytes = f.read()
-        if hashlib.sha256(model_bytes).hexdigest() == expected_sha256:
-            return model_bytes if in_memory else download_target
+        if _is_verified(download_target, expected_sha256):
+            return open(download_target, "rb").read() if in_memory else download_target
+        if _sha256(download_target) == expected_sha256:
+            _mark_verified(download_target, expected_sha256)
+            return open(download_target, "rb").read() if in_memory else download_target
         else:
             warnings.warn(
                 f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file"
             )
 
-    with urllib.request.urlopen(url) as source, open(download_target, "wb") as output:
-        with tqdm(
-            total=int(source.info().get("Content-Length")),
-            ncols=80,
-            unit="iB",
-            unit_scale=True,
-            unit_divisor=1024,
-        ) as loop:
-            while True:
-                buffer = source.read(8192)
-                if not buffer:
-                    break
-
-                output.write(buffer)
-                loop.update(len(buffer))
-
-    model_bytes = open(download_target, "rb").read()
-    if hashlib.sha256(model_bytes).hexdigest() != expected_sha256:
-        raise RuntimeError(
-            "Model has been downloaded but the SHA256 checksum does not not match. Please retry loading the model."
-        )
+    from .download import download_file
+
+    download_file(url, download_target, expected_sha256)
+    _mark_verified(download_target, expected_sha256)
 
-    return model_bytes if in_memory else download_target
+    return open(download_target, "rb").read() if in_memory else download_target
 
 
 def available_models() -> List[str]:
@@ -100,12 +173,99 @@ def available_models() -> List[str]:
     return list(_MODELS.keys())
 
 
+def _default_download_root() -> str:
+    default = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(os.getenv("XDG_CACHE_HOME", default), "whisper")
+
+
+def _checkpoint_file(
+    name: str, download_root: str, in_memory: bool
+) -> Tuple[Union[bytes, str], Optional[bytes]]:
+    if name in _MODELS:
+        checkpoint_file = _download(_MODELS[name], download_root, in_memory)
+        alignment_heads = _ALIGNMENT_HEADS[name]
+    elif os.path.isfile(name):
+        checkpoint_file = open(name, "rb").read() if in_memory else name
+        alignment_heads = None
+    else:
+        raise RuntimeError(
+            f"Model {name} not found; available models = {available_models()}"
+        )
+    return checkpoint_file, alignment_heads
+
+
+def _checkpoint_id(name: str) -> str:
+    """
+    Identifies the contents of a checkpoint: the SHA256 of an official model, or a hash of the
+    path, size and modification time of another file
+    """
+    if name in _MODELS:
+        return _MODELS[name].split("/")[-2]
+    path = os.path.realpath(name)
+    signature = json.dumps({"path": path, **_file_signature(path)}, sort_keys=True)
+    return hashlib.sha256(signature.encode()).hexdigest()
+
+
+def _pack_qkv(state_dict: dict, dims: dict):
+    from .model import _pack_qkv_state_dict
+
+    for i in range(dims["n_audio_layer"]):
+        _pack_qkv_state_dict(state_dict, f"encoder.blocks.{i}.attn.")
+    for i in range(dims["n_text_layer"]):
+        _pack_qkv_state_dict(state_dict, f"decoder.blocks.{i}.attn.")
+
+
+def convert_checkpoint(
+    name: str,
+    output_path: str,
+    download_root: str = None,
+    dtype: Optional["torch.dtype"] = None,
+):
+    """
+    Convert a Whisper checkpoint into the flat tensor format in `whisper.checkpoint`, which
+    `load_model()` memory-maps instead of unpickling when given a path ending in ".safetensors".
+
+    Parameters
+    ----------
+    name : str
+        one of the official model names listed by `whisper.available_models()`, or
+        path to a model checkpoint containing the model dimensions and the model state_dict.
+    output_path : str
+        the file to write
+    download_root: str
+        path to download the model files; by default, it uses "~/.cache/whisper"
+    dtype: torch.dtype
+        the dtype to store the weights in; the default float32 can be used by the model on CPU
+        without any conversion, while float16 halves the file size but is converted on loading
+    """
+    import torch
+
+    from .checkpoint import save_checkpoint
+
+    if dtype is None:
+        dtype = torch.float32
+    if download_root is None:
+        download_root = _default_download_root()
+
+    checkpoint_file, alignment_heads = _checkpoint_file(name, download_root, False)
+    checkpoint = torch.load(checkpoint_file, map_location="cpu")
+    dims = checkpoint["dims"]
+    state_dict = {k: v.to(dtype) for k, v in checkpoint["model_state_dict"].items()}
+
+    # store the self-attention projections packed, the layout `Whisper.fuse_qkv()` uses
+    _pack_qkv(state_dict, dims)
+    save_checkpoint(output_path, dims, state_dict, alignment_heads)
+
+
 def load_model(
     name: str,
-    device: Optional[Union[str, torch.device]] = None,
+    device: Optional[Union[str, "torch.device"]] = None,
     download_root: str = None,
     in_memory: bool = False,
-) -> Whisper:
+    compile: bool = False,
+    backend: str = "pytorch",
+    dtype: Optional["torch.dtype"] = None,
+) -> "Whisper":
     """
     Load a Whisper ASR model
 
@@ -113,48 +273,96 @@ def load_model(
     ----------
     name : str
         one of the official model names listed by `whisper.available_models()`, or
-        path to a model checkpoint containing the model dimensions and the model state_dict.
+        path to a model checkpoint containing the model dimensions and the model state_dict,
+        or to a ".safetensors" file written by `convert_checkpoint()`.
     device : Union[str, torch.device]
         the PyTorch device to put the model into
     download_root: str
         path to download the model files; by default, it uses "~/.cache/whisper"
     in_memory: bool
         whether to preload the model weights into host memory
+    compile: bool
+        whether to compile the encoder and the decoder step with `torch.compile`, which requires
+        PyTorch 2.0 or later and spends some time on warming up the compiled graphs
+    backend: str
+        "pytorch", or "onnxruntime" to run the encoder and the decoder with ONNX Runtime, which
+        requires the `onnx` extra; the ONNX graphs are exported into `download_root` on first use.
+        The sessions also run the language detection and the alignment for word timestamps, so
+        the PyTorch weights are released once they are loaded
+    dtype: torch.dtype
+        the dtype to keep the weights in, float32 by default; computations use the dtype of the
+        inputs regardless, so float16 halves the memory footprint of the model without requiring
+        fp16 decoding
 
     Returns
     -------
     model : Whisper
         The Whisper ASR model instance
     """
+    import torch
+
+    from .checkpoint import CHECKPOINT_EXTENSION, load_checkpoint
+    from .model import ModelDimensions, Whisper  # noqa: F811
+
+    if backend not in ("pytorch", "onnxruntime"):
+        raise ValueError(f"Unsupported backend: {backend}")
+    if backend == "onnxruntime" and compile:
+        raise ValueError("compile is only supported with the pytorch backend")
 
     if device is None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
+    if dtype is None:
+        dtype = torch.float32
     if download_root is None:
-        default = os.path.join(os.path.expanduser("~"), ".cache")
-        download_root = os.path.join(os.getenv("XDG_CACHE_HOME", default), "whisper")
+        download_root = _default_download_root()
 
-    if name in _MODELS:
-        checkpoint_file = _download(_MODELS[name], download_root, in_memory)
-        alignment_heads = _ALIGNMENT_HEADS[name]
-    elif os.path.isfile(name):
-        checkpoint_file = open(name, "rb").read() if in_memory else name
-        alignment_heads = None
-    else:
-        raise RuntimeError(
-            f"Model {name} not found; available models = {available_models()}"
-        )
+    checkpoint_file, alignment_heads = _checkpoint_file(name, download_root, in_memory)
 
-    with (
-        io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb")
-    ) as fp:
-        checkpoint = torch.load(fp, map_location=device)
-    del checkpoint_file
+    if name.endswith(CHECKPOINT_EXTENSION):
+        checkpoint = load_checkpoint(checkpoint_file)
+        alignment_heads = alignment_heads or checkpoint["alignment_heads"]
+    else:
+        with (
+            io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb")
+        ) as fp:
+            checkpoint = torch.load(fp, map_location="cpu")
 
-    dims = ModelDimensions(**checkpoint["dims"])
-    model = Whisper(dims)
-    model.load_state_dict(checkpoint["model_state_dict"])
+    # build the model without allocating its weights, then assign the checkpoint tensors to it,
+    # converting them to `dtype` on the device one at a time, so that the converted weights and
+    # the remaining checkpoint tensors together take about the size of the model at most.
+    # Checkpoints already in `dtype` on CPU are used without copying.
+    state_dict = checkpoint.pop("model_state_dict")
+    _pack_qkv(state_dict, checkpoint["dims"])
+    for key, tensor in state_dict.items():
+        if tensor.is_floating_point():
+            state_dict[key] = tensor.to(device=device, dtype=dtype)
+    with torch.device("meta"):
+        model = Whisper(ModelDimensions(**checkpoint["dims"])).fuse_qkv()
+    model.load_state_dict(state_dict, assign=True)
+    del checkpoint_file, checkpoint, state_dict
 
     if alignment_heads is not None:
         model.set_alignment_heads(alignment_heads)
 
-    return model.to(device)
+    model = model.to(device)
+    if compile:
+        model.compile_for_inference()
+
+    if backend == "onnxruntime":
+        from .onnx import OnnxRuntime, export_onnx, is_exported, release_weights
+
+        # keyed on the contents of the checkpoint and the dtype of the weights, so that another
+        # checkpoint of the same name, or a changed one, is exported again
+        checkpoint_id = _checkpoint_id(name)
+        model_stem = os.path.splitext(os.path.basename(name))[0]
+        dtype_name = str(dtype).replace("torch.", "")
+        export_name = f"{model_stem}-{checkpoint_id[:16]}-{dtype_name}"
+        onnx_dir = os.path.join(download_root, "onnx", export_name)
+        stamp = {"checkpoint": checkpoint_id, "dtype": dtype_name}
+        if not is_exported(onnx_dir, stamp):
+            export_onnx(model, onnx_dir, stamp=stamp)
+        model.onnx_runtime = OnnxRuntime(onnx_dir)
+        # the sessions hold their own copy of the weights
+        release_weights(model)
+
+    return model
@@ -1,3 +1,3 @@
-from .transcribe import cli
+from .cli import cli
 
 cli()
@@ -0,0 +1,108 @@
+import json
+import mmap
+import struct
+from typing import Dict, Optional, Union
+
+import torch
+from torch import Tensor
+
+# a flat file layout compatible with the safetensors format: an 8-byte little-endian header
+# length, a JSON header with the dtype, shape and byte range of each tensor, then the raw data.
+CHECKPOINT_EXTENSION = ".safetensors"
+
+_DTYPES = {
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "F32": torch.float32,
+    "F64": torch.float64,
+    "I32": torch.int32,
+    "I64": torch.int64,
+    "BOOL": torch.bool,
+}
+_DTYPE_NAMES = {dtype: name for name, dtype in _DTYPES.items()}
+
+
+def save_checkpoint(
+    path: str,
+    dims: dict,
+    state_dict: Dict[str, Tensor],
+    alignment_heads: Optional[bytes] = None,
+):
+    """
+    Write the model dimensions and the state_dict of a Whisper model in the flat tensor format
+    that `load_checkpoint()` memory-maps.
+
+    Parameters
+    ----------
+    path : str
+        the file to write, conventionally with the ".safetensors" extension
+    dims : dict
+        the model dimensions, as in the "dims" entry of the original checkpoints
+    state_dict : Dict[str, Tensor]
+        the model weights
+    alignment_heads : Optional[bytes]
+        the base85-encoded alignment heads, as in `whisper._ALIGNMENT_HEADS`
+    """
+    metadata = {"dims": json.dumps(dims)}
+    if alignment_heads is not None:
+        metadata["alignment_heads"] = alignment_heads.decode()
+
+    header, tensors, offset = {"__metadata__": metadata}, [], 0
+    for name, tensor in state_dict.items():
+        data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8)
+        header[name] = {
+            "dtype": _DTYPE_NAMES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + data.numel()],
+        }
+        tensors.append(data)
+        offset += data.numel()
+
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b" " * (-len(header_bytes) % 8)  # keep the tensor data aligned
+
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for data in tensors:
+            f.write(data.numpy().tobytes())
+
+
+def load_checkpoint(file: Union[str, bytes]) -> dict:
+    """
+    Load a checkpoint written by `save_checkpoint()`. When given a path, the tensors are views
+    of a copy-on-write memory map of the file, so loading does not read the weights up front,
+    and processes loading the same file share its pages in the page cache.
+
+    Returns
+    -------
+    A dict with the "dims", "model_state_dict" and "alignment_heads" (or None) of the model
+    """
+    if isinstance(file, bytes):
+        buffer = bytearray(file)
+    else:
+        with open(file, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    (header_size,) = struct.unpack("<Q", buffer[:8])
+    header = json.loads(bytes(buffer[8 : 8 + header_size]))
+    metadata = header.pop("__metadata__")
+
+    state_dict = {}
+    for name, info in header.items():
+        dtype, shape = _DTYPES[info["dtype"]], info["shape"]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            state_dict[name] = torch.empty(shape, dtype=dtype)
+            continue
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        offset = 8 + header_size + begin
+        tensor = torch.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+        state_dict[name] = tensor.reshape(shape)
+
+    alignment_heads = metadata.get("alignment_heads")
+    return {
+        "dims": json.loads(metadata["dims"]),
+        "model_state_dict": state_dict,
+        "alignment_heads": alignment_heads and alignment_heads.encode(),
+    }
@@ -1,3 +1,4 @@
+import bisect
 from dataclasses import dataclass, field, replace
 from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
@@ -49,25 +50,25 @@ def detect_language(
 
     # skip encoder forward pass if already-encoded audio features were given
     if mel.shape[-2:] != (model.dims.n_audio_ctx, model.dims.n_audio_state):
-        mel = model.encoder(mel)
+        if model.onnx_runtime is not None:
+            mel = model.onnx_runtime.embed_audio(mel)
+        else:
+            mel = model.encoder(mel)
 
-    # forward pass using a single token, startoftranscript
+    # forward pass using a single token, startoftranscript, projected on the language tokens only
     n_audio = mel.shape[0]
     x = torch.tensor([[tokenizer.sot]] * n_audio).to(mel.device)  # [n_audio, 1]
-    logits = model.logits(x, mel)[:, 0]
-
-    # collect detected languages; suppress all non-language tokens
-    mask = torch.ones(logits.shape[-1], dtype=torch.bool)
-    mask[list(tokenizer.all_language_tokens)] = False
-    logits[:, mask] = -np.inf
-    language_tokens = logits.argmax(dim=-1)
-    language_token_probs = logits.softmax(dim=-1).cpu()
+    vocab = torch.tensor(tokenizer.all_language_tokens, device=mel.device)
+    if model.onnx_runtime is not None:
+        logits = model.onnx_runtime.logits(x, mel)[:, 0, vocab]
+    else:
+        logits = model.logits(x, mel, vocab=vocab)[:, 0]
+
+    # collect detected languages
+    language_tokens = vocab[logits.argmax(dim=-1)]
+    language_token_probs = logits.softmax(dim=-1).cpu().tolist()
     language_probs = [
-        {
-            c: language_token_probs[i, j].item()
-            for j, c in zip(tokenizer.all_language_tokens, tokenizer.all_language_codes)
-        }
-        for i in range(n_audio)
+        dict(zip(tokenizer.all_language_codes, probs)) for probs in language_token_probs
     ]
 
     if single:
@@ -106,10 +107,18 @@ class DecodingOptions:
     suppress_tokens: Optional[Union[str, Iterable[int]]] = "-1"
     suppress_blank: bool = True  # this will suppress blank outputs
 
+    # the text tokens that may be sampled, e.g. from `Tokenizer.vocabulary()` for a language; the
+    # output projection then only covers these, the special tokens and the timestamps
+    vocabulary: Optional[Iterable[int]] = None
+
     # timestamp sampling options
     without_timestamps: bool = False  # use <|notimestamps|> to sample text tokens only
     max_initial_timestamp: Optional[float] = 1.0
 
+    # record the cross-attention weights of the alignment heads while sampling, so that word-level
+    # timestamps can be found without another decoder pass; only with the PyTorch inference
+    record_alignment: bool = False
+
     # implementation details
     fp16: bool = True  # use fp16 for most of the calculation
 
@@ -125,6 +134,11 @@ class DecodingResult:
     no_speech_prob: float = np.nan
     temperature: float = np.nan
     compression_ratio: float = np.nan
+    # with `record_alignment`, the alignment heads' cross-attention weights before the softmax
+    # (heads * (len(tokens) + 1) * n_audio_ctx) of the queries at the last initial token and at
+    # each sampled token, and the probability of each sampled token among the text tokens
+    alignment_weights: Optional[Tensor] = None
+    token_probs: Optional[List[float]] = None
 
 
 class Inference:
@@ -140,40 +154,193 @@ class Inference:
         """Clean up any resources or hooks after decoding is finished"""
         pass
 
+    def recorded_alignment(self, index: int) -> Optional[Tuple[Tensor, Tensor]]:
+        """The alignment weights and token probabilities recorded for the sequence at `index`"""
+        return None
+
 
 class PyTorchInference(Inference):
-    def __init__(self, model: "Whisper", initial_token_length: int):
+    def __init__(
+        self,
+        model: "Whisper",
+        initial_token_length: int,
+        record_alignment: bool = False,
+        n_text_tokens: Optional[int] = None,
+        vocab: Optional[Tensor] = None,
+    ):
         self.model: "Whisper" = model
         self.initial_token_length = initial_token_length
         self.kv_cache = {}
-        self.hooks = []
+        # the tokens to compute the logits of after the first forward pass, or None for all;
+        # the first pass covers the whole vocabulary, so that the probabilities at the initial
+        # tokens, e.g. of no speech, are normalized the same way as without `vocab`
+        self.vocab = vocab
+        # the output projection restricted to `vocab`, gathered once rather than at every step
+        self.projection: Optional[Tensor] = None
+        if vocab is not None:
+            self.projection = model.decoder.token_embedding.weight[vocab]
+        # the left padding of each sequence, if any
+        self.padding: Optional[Tensor] = None
 
         key_modules = [block.attn.key for block in self.model.decoder.blocks]
         value_modules = [block.attn.value for block in self.model.decoder.blocks]
         self.kv_modules = key_modules + value_modules
 
-    def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
-        if not self.kv_cache:
-            self.kv_cache, self.hooks = self.model.install_kv_cache_hooks()
+        # with record_alignment, the alignment heads' weights of each step, and the probability
+        # of the token sampled at the previous step; rows follow their beams through `sources`
+        self.qk_heads = model.alignment_heads_per_layer() if record_alignment else None
+        self.n_text_tokens = n_text_tokens
+        # the number of logit columns of text tokens, which come first in `vocab` too
+        self.n_text_columns = n_text_tokens
+        if vocab is not None and n_text_tokens is not None:
+            self.n_text_columns = int((vocab < n_text_tokens).sum())
+        self.step_weights: List[Tensor] = []
+        self.step_probs: List[Tensor] = []
+        self.step_sources: List[Optional[List[int]]] = []
+        self.text_probs: Optional[Tensor] = None
+        self.source_indices: Optional[List[int]] = None
 
-        if tokens.shape[-1] > self.initial_token_length:
+    def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
+        """
+        The logits of every token in the first forward pass, and of the tokens of `vocab` in
+        its order in the following ones
+        """
+        sampled = tokens[:, -1]
+        first_pass = tokens.shape[-1] <= self.initial_token_length
+        if not first_pass:
             # only need to use the last token except in the first forward pass
             tokens = tokens[:, -1:]
 
-        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+        cross_qk = [] if self.qk_heads is not None else None
+        logits = self.model.decoder(
+            tokens,
+            audio_features,
+            kv_cache=self.kv_cache,
+            cross_qk=cross_qk,
+            qk_heads=self.qk_heads,
+            projection=None if first_pass else self.projection,
+            padding=self.padding,
+        )
+        if self.qk_heads is None:
+            return logits
+
+        weights = torch.cat([qk[:, :, -1] for qk in cross_qk if qk is not None], dim=1)
+        self.step_weights.append(weights)
+        if self.vocab is not None:
+            # the columns of the sampled tokens among those of `vocab`
+            sampled = torch.searchsorted(self.vocab, sampled.contiguous())
+        if self.text_probs is not None:
+            index = sampled.clamp(max=self.n_text_columns - 1)[:, None]
+            self.step_probs.append(self.text_probs.gather(-1, index)[:, 0])
+            self.step_sources.append(self.source_indices)
+        step_logits = logits[:, -1]
+        if self.vocab is not None and first_pass:
+            step_logits = step_logits[:, self.vocab]
+        self.text_probs = step_logits[:, : self.n_text_columns].float().softmax(dim=-1)
+        self.source_indices = None
+        return logits
 
     def cleanup_caching(self):
-        for hook in self.hooks:
-            hook.remove()
-
         self.kv_cache = {}
-        self.hooks = []
 
     def rearrange_kv_cache(self, source_indices):
         if source_indices != list(range(len(source_indices))):
             for module in self.kv_modules:
                 # update the key/value cache to contain the selected sequences
                 self.kv_cache[module] = self.kv_cache[module][source_indices].detach()
+            if self.padding is not None:
+                self.padding = self.padding[source_indices]
+            if self.text_probs is not None:
+                self.text_probs = self.text_probs[source_indices]
+                self.source_indices = source_indices
+
+    def recorded_alignment(self, index: int) -> Optional[Tuple[Tensor, Tensor]]:
+        if not self.step_weights:
+            return None
+
+        # follow the sequence back through the beams it descends from
+        weights, probs = [], []
+        for step in reversed(range(len(self.step_weights))):
+            weights.append(self.step_weights[step][index])
+            if step > 0:
+                probs.append(self.step_probs[step - 1][index])
+                if (sources := self.step_sources[step - 1]) is not None:
+                    index = sources[index]
+
+        return torch.stack(weights[::-1], dim=1), torch.stack(probs[::-1])
+
+
+class StaticCacheInference(Inference):
+    # the initial tokens are right-padded to one of these lengths, capped at n_text_ctx, so that
+    # a compiled decoder step only ever sees a few distinct input shapes
+    prefill_buckets = (32, 128)
+
+    def __init__(self, model: "Whisper", initial_token_length: int):
+        self.model: "Whisper" = model
+        self.initial_token_length = initial_token_length
+        self.kv_cache = None
+        self.cross_kv_cache = None
+
+    def allocate_cache(self, n_batch: int, audio_features: Tensor):
+        self.kv_cache, self.cross_kv_cache = self.model.decoder.allocate_static_cache(
+            n_batch, audio_features
+        )
+
+    def forward(self, tokens: Tensor, positions: Tensor) -> Tensor:
+        step = self.model.compiled_decoder_step or self.model.decoder.forward_static
+        return step(tokens, positions, self.kv_cache, self.cross_kv_cache)
+
+    def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
+        n_batch, n_tokens = tokens.shape
+
+        if self.kv_cache is not None:
+            # only need to use the last token except in the first forward pass; copied to
+            # give it the same strides at every step, which the compiled graph is guarded on
+            tokens = tokens[:, -1:].clone(memory_format=torch.contiguous_format)
+            positions = torch.tensor([n_tokens - 1], device=tokens.device)
+            return self.forward(tokens, positions)
+
+        self.allocate_cache(n_batch, audio_features)
+
+        # positions past the initial tokens are overwritten by the subsequent steps before
+        # they can be attended to, so the values used for padding are irrelevant
+        n_ctx = self.model.dims.n_text_ctx
+        length = next((b for b in self.prefill_buckets if b >= n_tokens), n_ctx)
+        tokens = F.pad(tokens, (0, length - n_tokens))
+        positions = torch.arange(length, device=tokens.device)
+
+        return self.forward(tokens, positions)[:, :n_tokens]
+
+    def cleanup_caching(self):
+        self.kv_cache = None
+        self.cross_kv_cache = None
+
+    def rearrange_kv_cache(self, source_indices):
+        if source_indices != list(range(len(source_indices))):
+            self.kv_cache = [
+                (k[source_indices], v[source_indices]) for k, v in self.kv_cache
+            ]
+
+
+class OnnxRuntimeInference(StaticCacheInference):
+    """Runs the static-shape decoder step exported by `whisper.onnx.export_onnx()`"""
+
+    def allocate_cache(self, n_batch: int, audio_features: Tensor):
+        # the IO binding of the decoder step with the caches bound; see `OnnxRuntime.decode()`
+        self.kv_cache, self.cross_kv_cache = self.model.onnx_runtime.allocate_cache(
+            n_batch, audio_features
+        )
+
+    def forward(self, tokens: Tensor, positions: Tensor) -> Tensor:
+        return self.model.onnx_runtime.decode(
+            tokens, positions, self.kv_cache, self.cross_kv_cache
+        )
+
+    def rearrange_kv_cache(self, source_indices):
+        if source_indices != list(range(len(source_indices))):
+            # in-place, since the decoder step is bound to this array;
+            # shape = (n_text_layer * 2, n_batch, n_text_head, n_text_ctx, n_text_state // n_head)
+            self.kv_cache[:] = self.kv_cache[:, source_indices]
 
 
 class SequenceRanker:
@@ -270,9 +437,11 @@ class TokenDecoder:
 
 
 class GreedyDecoder(TokenDecoder):
-    def __init__(self, temperature: float, eot: int):
+    def __init__(self, temperature: float, eot: int, vocab: Optional[Tensor] = None):
         self.temperature = temperature
         self.eot = eot
+        # the tokens of the logit columns, if not the whole vocabulary
+        self.vocab = vocab
 
     def update(
         self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor
@@ -285,6 +454,8 @@ class GreedyDecoder(TokenDecoder):
         logprobs = F.log_softmax(logits.float(), dim=-1)
         current_logprobs = logprobs[torch.arange(logprobs.shape[0]), next_tokens]
         sum_logprobs += current_logprobs * (tokens[:, -1] != self.eot)
+        if self.vocab is not None:
+            next_tokens = self.vocab[next_tokens]
 
         next_tokens[tokens[:, -1] == self.eot] = self.eot
         tokens = torch.cat([tokens, next_tokens[:, None]], dim=-1)
@@ -305,13 +476,17 @@ class BeamSearchDecoder(TokenDecoder):
         eot: int,
         inference: Inference,
         patience: Optional[float] = None,
+        vocab: Optional[Tensor] = None,
     ):
         self.beam_size = beam_size
         self.eot = eot
         self.inference = inference
+        # the tokens of the logit columns, if not the whole vocabulary
+        self.vocab = vocab
         self.patience = patience or 1.0
         self.max_candidates: int = round(beam_size * self.patience)
         self.finished_sequences = None
+        self.finished_alignments = None
 
         assert (
             self.max_candidates > 0
@@ -319,6 +494,7 @@ class BeamSearchDecoder(TokenDecoder):
 
     def reset(self):
         self.finished_sequences = None
+        self.finished_alignments = None
 
     def update(
         self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor
@@ -329,9 +505,11 @@ class BeamSearchDecoder(TokenDecoder):
         n_audio = tokens.shape[0] // self.beam_size
         if self.finished_sequences is None:  # for the first update
             self.finished_sequences = [{} for _ in range(n_audio)]
+            self.finished_alignments = [{} for _ in range(n_audio)]
 
         logprobs = F.log_softmax(logits.float(), dim=-1)
         next_tokens, source_indices, finished_sequences = [], [], []
+        finished_sources = []
         for i in range(n_audio):
             scores, sources, finished = {}, {}, {}
 
@@ -339,7 +517,10 @@ class BeamSearchDecoder(TokenDecoder):
             for j in range(self.beam_size):
                 idx = i * self.beam_size + j
                 prefix = tokens[idx].tolist()
-                for logprob, token in zip(*logprobs[idx].topk(self.beam_size + 1)):
+                top_logprobs, top_tokens = logprobs[idx].topk(self.beam_size + 1)
+                if self.vocab is not None:
+                    top_tokens = self.vocab[top_tokens]
+                for logprob, token in zip(top_logprobs, top_tokens):
                     new_logprob = (sum_logprobs[idx] + logprob).item()
                     sequence = tuple(prefix + [token.item()])
                     scores[sequence] = new_logprob
@@ -360,19 +541,27 @@ class BeamSearchDecoder(TokenDecoder):
                         break
 
             finished_sequences.append(finished)
+            finished_sources.append(sources)
 
         tokens = torch.tensor(next_tokens, device=tokens.device)
-        self.inference.rearrange_kv_cache(source_indices)
 
         # add newly finished sequences to self.finished_sequences
         assert len(self.finished_sequences) == len(finished_sequences)
-        for previously_finished, newly_finished in zip(
-            self.finished_sequences, finished_sequences
+        for previously_finished, newly_finished, sources, alignments in zip(
+            self.finished_sequences,
+            finished_sequences,
+            finished_sources,
+            self.finished_alignments,
         ):
             for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
                 if len(previously_finished) >= self.max_candidates:
                     break  # the candidate list is full
                 previously_finished[seq] = newly_finished[seq]
+                alignment = self.inference.recorded_alignment(sources[seq])
+                if alignment is not None:
+                    alignments[seq] = alignment
+
+        self.inference.rearrange_kv_cache(source_indices)
 
         # mark as completed if all audio has enough number of samples
         completed = all(
@@ -404,6 +593,17 @@ class BeamSearchDecoder(TokenDecoder):
         return tokens, sum_logprobs
 
 
+def _logit_columns(tokens: Iterable[int], vocab: Optional[Sequence[int]]) -> List[int]:
+    """
+    The columns of `tokens` in logits over the sorted tokens `vocab`, leaving out those not in
+    it; the tokens themselves if the logits are over the whole vocabulary
+    """
+    if vocab is None:
+        return list(tokens)
+    columns = [(bisect.bisect_left(vocab, t), t) for t in tokens]
+    return [i for i, t in columns if i < len(vocab) and vocab[i] == t]
+
+
 class LogitFilter:
     def apply(self, logits: Tensor, tokens: Tensor) -> None:
         """Apply any filtering or masking to logits in-place
@@ -421,18 +621,27 @@ class LogitFilter:
 
 
 class SuppressBlank(LogitFilter):
-    def __init__(self, tokenizer: Tokenizer, sample_begin: int):
+    def __init__(
+        self,
+        tokenizer: Tokenizer,
+        sample_begin: int,
+        vocab: Optional[Sequence[int]] = None,
+    ):
         self.tokenizer = tokenizer
         self.sample_begin = sample_begin
+        blank_tokens = self.tokenizer.encode(" ") + [self.tokenizer.eot]
+        self.blank_columns = _logit_columns(blank_tokens, vocab)
 
     def apply(self, logits: Tensor, tokens: Tensor):
         if tokens.shape[1] == self.sample_begin:
-            logits[:, self.tokenizer.encode(" ") + [self.tokenizer.eot]] = -np.inf
+            logits[:, self.blank_columns] = -np.inf
 
 
 class SuppressTokens(LogitFilter):
-    def __init__(self, suppress_tokens: Sequence[int]):
-        self.suppress_tokens = list(suppress_tokens)
+    def __init__(
+        self, suppress_tokens: Sequence[int], vocab: Optional[Sequence[int]] = None
+    ):
+        self.suppress_tokens = _logit_columns(suppress_tokens, vocab)
 
     def apply(self, logits: Tensor, tokens: Tensor):
         logits[:, self.suppress_tokens] = -np.inf
@@ -444,15 +653,24 @@ class ApplyTimestampRules(LogitFilter):
         tokenizer: Tokenizer,
         sample_begin: int,
         max_initial_timestamp_index: Optional[int],
+        vocab: Optional[Sequence[int]] = None,
     ):
         self.tokenizer = tokenizer
         self.sample_begin = sample_begin
         self.max_initial_timestamp_index = max_initial_timestamp_index
+        # when the logits only cover the sorted tokens `vocab`, which include all the special
+        # tokens, the columns of the special tokens are their ids minus this offset
+        self.offset = 0
+        if vocab is not None:
+            self.offset = tokenizer.eot - bisect.bisect_left(vocab, tokenizer.eot)
 
     def apply(self, logits: Tensor, tokens: Tensor):
+        eot = self.tokenizer.eot - self.offset
+        timestamp_begin = self.tokenizer.timestamp_begin - self.offset
+
         # suppress <|notimestamps|> which is handled by without_timestamps
         if self.tokenizer.no_timestamps is not None:
-            logits[:, self.tokenizer.no_timestamps] = -np.inf
+            logits[:, self.tokenizer.no_timestamps - self.offset] = -np.inf
 
         # timestamps have to appear in pairs, except directly before EOT; mask logits accordingly
         for k in range(tokens.shape[0]):
@@ -467,9 +685,9 @@ class ApplyTimestampRules(LogitFilter):
 
             if last_was_timestamp:
                 if penultimate_was_timestamp:  # has to be non-timestamp
-                    logits[k, self.tokenizer.timestamp_begin :] = -np.inf
+                    logits[k, timestamp_begin:] = -np.inf
                 else:  # cannot be normal text tokens
-                    logits[k, : self.tokenizer.eot] = -np.inf
+                    logits[k, :eot] = -np.inf
 
             timestamps = sampled_tokens[
                 sampled_tokens.ge(self.tokenizer.timestamp_begin)
@@ -481,28 +699,25 @@ class ApplyTimestampRules(LogitFilter):
                     timestamp_last = timestamps[-1]
                 else:
                     timestamp_last = timestamps[-1] + 1
-                logits[k, self.tokenizer.timestamp_begin : timestamp_last] = -np.inf
+                timestamp_last = timestamp_last - self.offset
+                logits[k, timestamp_begin:timestamp_last] = -np.inf
 
         if tokens.shape[1] == self.sample_begin:
             # suppress generating non-timestamp tokens at the beginning
-            logits[:, : self.tokenizer.timestamp_begin] = -np.inf
+            logits[:, :timestamp_begin] = -np.inf
 
             # apply the `max_initial_timestamp` option
             if self.max_initial_timestamp_index is not None:
-                last_allowed = (
-                    self.tokenizer.timestamp_begin + self.max_initial_timestamp_index
-                )
+                last_allowed = timestamp_begin + self.max_initial_timestamp_index
                 logits[:, last_allowed + 1 :] = -np.inf
 
         # if sum of probability over timestamps is above any other token, sample timestamp
         logprobs = F.log_softmax(logits.float(), dim=-1)
         for k in range(tokens.shape[0]):
-            timestamp_logprob = logprobs[k, self.tokenizer.timestamp_begin :].logsumexp(
-                dim=-1
-            )
-            max_text_token_logprob = logprobs[k, : self.tokenizer.timestamp_begin].max()
+            timestamp_logprob = logprobs[k, timestamp_begin:].logsumexp(dim=-1)
+            max_text_token_logprob = logprobs[k, :timestamp_begin].max()
             if timestamp_logprob > max_text_token_logprob:
-                logits[k, : self.tokenizer.timestamp_begin] = -np.inf
+                logits[k, :timestamp_begin] = -np.inf
 
 
 class DecodingTask:
@@ -511,7 +726,13 @@ class DecodingTask:
     decoder: TokenDecoder
     logit_filters: List[LogitFilter]
 
-    def __init__(self, model: "Whisper", options: DecodingOptions):
+    def __init__(
+        self,
+        model: "Whisper",
+        options: DecodingOptions,
+        tasks: Optional[Sequence[str]] = None,
+        prompts: Optional[Sequence[Optional[Union[str, List[int]]]]] = None,
+    ):
         self.model = model
 
         language = options.language or "en"
@@ -532,12 +753,54 @@ class DecodingTask:
         if self.options.without_timestamps:
             self.sot_sequence = tokenizer.sot_sequence_including_notimestamps
 
-        self.initial_tokens: Tuple[int] = self._get_initial_tokens()
+        # the tasks to decode the audio for, as rows of one batch; see `decode_tasks()`
+        self.tasks: Tuple[str, ...] = tuple(tasks or [options.task])
+        if len(self.tasks) > 1:
+            if not model.is_multilingual:
+                raise ValueError("Only multilingual models can decode several tasks")
+            if not set(self.tasks) <= {"transcribe", "translate"}:
+                raise ValueError(f"Cannot decode the tasks {self.tasks} together")
+
+        # the initial tokens of each task, left-padded to the same length; the decoder masks the
+        # padding, so that each task is decoded with its full prompt
+        task_initial_tokens = self._get_task_initial_tokens(prompts)
+        n_initial = max(map(len, task_initial_tokens))
+        self.task_padding: List[int] = [n_initial - len(t) for t in task_initial_tokens]
+        self.task_initial_tokens: List[Tuple[int]] = [
+            (tokenizer.eot,) * padding + tokens
+            for padding, tokens in zip(self.task_padding, task_initial_tokens)
+        ]
+        self.initial_tokens: Tuple[int] = self.task_initial_tokens[0]
         self.sample_begin: int = len(self.initial_tokens)
         self.sot_index: int = self.initial_tokens.index(tokenizer.sot)
 
+        # the tokens that may be sampled: the vocabulary given, the special tokens and timestamps
+        self.vocab: Optional[List[int]] = None
+        if options.vocabulary is not None:
+            special_tokens = range(tokenizer.eot, model.dims.n_vocab)
+            self.vocab = sorted({*options.vocabulary, *special_tokens})
+
         # inference: implements the forward pass through the decoder, including kv caching
-        self.inference = PyTorchInference(model, len(self.initial_tokens))
+        # the PyTorch inference only computes the logits of `self.vocab` after the first pass,
+        # which the logit filters and the decoders then work on; `logit_vocab` is their tokens
+        self.logit_vocab: Optional[List[int]] = None
+        vocab_tokens = None
+        if model.onnx_runtime is not None:
+            self.inference = OnnxRuntimeInference(model, len(self.initial_tokens))
+        elif model.compiled_decoder_step is not None:
+            self.inference = StaticCacheInference(model, len(self.initial_tokens))
+        else:
+            if self.vocab is not None:
+                self.logit_vocab = self.vocab
+                vocab_tokens = torch.tensor(self.vocab, device=model.device)
+            self.inference = PyTorchInference(
+                model,
+                len(self.initial_tokens),
+                record_alignment=options.record_alignment,
+                n_text_tokens=tokenizer.eot,
+                vocab=vocab_tokens,
+            )
+        self.vocab_tokens: Optional[Tensor] = vocab_tokens
 
         # sequence ranker: implements how to rank a group of sampled sequences
         self.sequence_ranker = MaximumLikelihoodRanker(options.length_penalty)
@@ -545,17 +808,31 @@ class DecodingTask:
         # decoder: implements how to select the next tokens, given the autoregressive distribution
         if options.beam_size is not None:
             self.decoder = BeamSearchDecoder(
-                options.beam_size, tokenizer.eot, self.inference, options.patience
+                options.beam_size,
+                tokenizer.eot,
+                self.inference,
+                options.patience,
+                vocab=vocab_tokens,
             )
         else:
-            self.decoder = GreedyDecoder(options.temperature, tokenizer.eot)
+            self.decoder = GreedyDecoder(
+                options.temperature, tokenizer.eot, vocab=vocab_tokens
+            )
 
         # logit filters: applies various rules to suppress or penalize certain tokens
         self.logit_filters = []
         if self.options.suppress_blank:
-            self.logit_filters.append(SuppressBlank(self.tokenizer, self.sample_begin))
+            self.logit_filters.append(
+                SuppressBlank(self.tokenizer, self.sample_begin, self.logit_vocab)
+            )
         if self.options.suppress_tokens:
-            self.logit_filters.append(SuppressTokens(self._get_suppress_tokens()))
+            self.logit_filters.append(
+                SuppressTokens(self._get_suppress_tokens(), self.logit_vocab)
+            )
+        if self.vocab is not None and self.logit_vocab is None:
+            # the other inferences compute all logits; suppress those outside the vocabulary
+            excluded = set(range(model.dims.n_vocab)).difference(self.vocab)
+            self.logit_filters.append(SuppressTokens(sorted(excluded)))
         if not options.without_timestamps:
             precision = CHUNK_LENGTH / model.dims.n_audio_ctx  # usually 0.02 seconds
             max_initial_timestamp_index = None
@@ -565,7 +842,10 @@ class DecodingTask:
                 )
             self.logit_filters.append(
                 ApplyTimestampRules(
-                    tokenizer, self.sample_begin, max_initial_timestamp_index
+                    tokenizer,
+                    self.sample_begin,
+                    max_initial_timestamp_index,
+                    self.logit_vocab,
                 )
             )
 
@@ -584,7 +864,7 @@ class DecodingTask:
 
         return options
 
-    def _get_initial_tokens(self) -> Tuple[int]:
+    def _get_initial_tokens(self, prompt_tokens: List[int]) -> Tuple[int]:
         tokens = list(self.sot_sequence)
 
         if prefix := self.options.prefix:
@@ -598,20 +878,49 @@ class DecodingTask:
                 prefix_tokens = prefix_tokens[-max_prefix_len:]
             tokens = tokens + prefix_tokens
 
-        if prompt := self.options.prompt:
-            prompt_tokens = (
-                self.tokenizer.encode(" " + prompt.strip())
-                if isinstance(prompt, str)
-                else prompt
-            )
-            tokens = (
-                [self.tokenizer.sot_prev]
-                + prompt_tokens[-(self.n_ctx // 2 - 1) :]
-                + tokens
-            )
+        if prompt_tokens:
+            tokens = [self.tokenizer.sot_prev] + prompt_tokens + tokens
 
         return tuple(tokens)
 
+    def _get_prompt_tokens(self, prompt: Optional[Union[str, List[int]]]) -> List[int]:
+        if not prompt:
+            return []
+
+        prompt_tokens = (
+            self.tokenizer.encode(" " + prompt.strip())
+            if isinstance(prompt, str)
+            else prompt
+        )
+        return list(prompt_tokens[-(self.n_ctx // 2 - 1) :])
+
+    def _get_task_initial_tokens(
+        self, prompts: Optional[Sequence[Optional[Union[str, List[int]]]]]
+    ) -> List[Tuple[int]]:
+        if prompts is None:
+            prompts = [self.options.prompt] * len(self.tasks)
+        if len(prompts) != len(self.tasks):
+            raise ValueError("prompts should be given for each of the tasks")
+
+        if len(self.tasks) == 1:
+            return [self._get_initial_tokens(self._get_prompt_tokens(prompts[0]))]
+
+        task_tokens = {
+            "transcribe": self.tokenizer.transcribe,
+            "translate": self.tokenizer.translate,
+        }
+
+        task_initial_tokens = []
+        for task, prompt in zip(self.tasks, prompts):
+            initial_tokens = list(
+                self._get_initial_tokens(self._get_prompt_tokens(prompt))
+            )
+            sot_index = initial_tokens.index(self.tokenizer.sot)
+            initial_tokens[sot_index + 2] = task_tokens[task]
+            task_initial_tokens.append(tuple(initial_tokens))
+
+        return task_initial_tokens
+
     def _get_suppress_tokens(self) -> Tuple[int]:
         suppress_tokens = self.options.suppress_tokens
 
@@ -651,6 +960,8 @@ class DecodingTask:
         ):
             # encoded audio features are given; skip audio encoding
             audio_features = mel
+        elif self.model.onnx_runtime is not None:
+            audio_features = self.model.onnx_runtime.embed_audio(mel)
         else:
             audio_features = self.model.encoder(mel)
 
@@ -694,6 +1005,9 @@ class DecodingTask:
 
                 # now we need to consider the logits at the last token only
                 logits = logits[:, -1]
+                if i == 0 and self.vocab_tokens is not None:
+                    # the first forward pass covers the whole vocabulary; see PyTorchInference
+                    logits = logits[:, self.vocab_tokens]
 
                 # apply the logit filters, e.g. for suppressing or applying penalty to
                 for logit_filter in self.logit_filters:
@@ -730,8 +1044,31 @@ class DecodingTask:
                 )
             ]
 
+        if len(self.tasks) > 1:
+            # decode every task from the same audio features, as rows of one batch
+            n_tasks = len(self.tasks)
+            language_tokens = tokens[:, self.sot_index + 1].repeat(n_tasks)
+            tokens = torch.tensor(self.task_initial_tokens)
+            tokens = tokens.repeat_interleave(n_audio, dim=0)
+            tokens[:, self.sot_index + 1] = language_tokens
+            audio_features = audio_features.repeat(n_tasks, 1, 1)
+            languages = languages * n_tasks
+            if any(self.task_padding):
+                if not isinstance(self.inference, PyTorchInference):
+                    raise ValueError(
+                        "Prompts of different lengths can only be decoded in one batch"
+                        " by the PyTorch inference"
+                    )
+                padding = torch.tensor(self.task_padding)
+                padding = padding.repeat_interleave(n_audio * self.n_group)
+                self.inference.padding = padding.to(audio_features.device)
+            n_audio *= n_tasks
+
         # repeat text tensors by the group size, for beam search or best-of-n sampling
         tokens = tokens.repeat_interleave(self.n_group, dim=0).to(audio_features.device)
+        if audio_features.shape[0] > 1:
+            # a single audio is broadcast over the group; more need a row per sequence
+            audio_features = audio_features.repeat_interleave(self.n_group, dim=0)
 
         # call the main sampling loop
         tokens, sum_logprobs, no_speech_probs = self._main_loop(audio_features, tokens)
@@ -746,14 +1083,19 @@ class DecodingTask:
 
         # get the final candidates for each group, and slice between the first sampled token and EOT
         tokens, sum_logprobs = self.decoder.finalize(tokens, sum_logprobs)
+        alignments = self._get_recorded_alignments(tokens)
+        # (the initial tokens of a task may be left-padded with EOT)
         tokens: List[List[Tensor]] = [
-            [t[self.sample_begin : (t == tokenizer.eot).nonzero()[0, 0]] for t in s]
-            for s in tokens
+            [t[self.sample_begin :] for t in s] for s in tokens
+        ]
+        tokens = [
+            [t[: (t == tokenizer.eot).nonzero()[0, 0]] for t in s] for s in tokens
         ]
 
         # select the top-ranked sample in each group
         selected = self.sequence_ranker.rank(tokens, sum_logprobs)
         tokens: List[List[int]] = [t[i].tolist() for i, t in zip(selected, tokens)]
+        alignments = [a[i] for i, a in zip(selected, alignments)]
         texts: List[str] = [tokenizer.decode(t).strip() for t in tokens]
 
         sum_logprobs: List[float] = [lp[i] for i, lp in zip(selected, sum_logprobs)]
@@ -761,6 +1103,15 @@ class DecodingTask:
             lp / (len(t) + 1) for t, lp in zip(tokens, sum_logprobs)
         ]
 
+        # the recorded rows cover the sampled tokens, unless sampling stopped before EOT
+        recorded = []
+        for t, alignment in zip(tokens, alignments):
+            if alignment is not None and alignment[0].shape[1] > len(t):
+                weights, probs = alignment
+                recorded.append((weights[:, : len(t) + 1], probs[: len(t)].tolist()))
+            else:
+                recorded.append((None, None))
+
         fields = (
             texts,
             languages,
@@ -768,6 +1119,7 @@ class DecodingTask:
             audio_features,
             avg_logprobs,
             no_speech_probs,
+            recorded,
         )
         if len(set(map(len, fields))) != 1:
             raise RuntimeError(f"inconsistent result lengths: {list(map(len, fields))}")
@@ -782,10 +1134,38 @@ class DecodingTask:
                 no_speech_prob=no_speech_prob,
                 temperature=self.options.temperature,
                 compression_ratio=compression_ratio(text),
+                alignment_weights=alignment_weights,
+                token_probs=token_probs,
             )
-            for text, language, tokens, features, avg_logprob, no_speech_prob in zip(
-                *fields
-            )
+            for (
+                text,
+                language,
+                tokens,
+                features,
+                avg_logprob,
+                no_speech_prob,
+                (alignment_weights, token_probs),
+            ) in zip(*fields)
+        ]
+
+    def _get_recorded_alignments(
+        self, tokens: Sequence[Sequence[Tensor]]
+    ) -> List[List[Optional[Tuple[Tensor, Tensor]]]]:
+        # the alignment weights and token probabilities of each finalized candidate, if recorded
+        if not self.options.record_alignment:
+            return [[None] * len(s) for s in tokens]
+        if isinstance(self.decoder, BeamSearchDecoder):
+            recorded = self.decoder.finished_alignments or [{} for _ in tokens]
+            return [
+                [alignments.get(tuple(t.tolist())) for t in s]
+                for s, alignments in zip(tokens, recorded)
+            ]
+        return [
+            [
+                self.inference.recorded_alignment(i * self.n_group + j)
+                for j in range(len(s))
+            ]
+            for i, s in enumerate(tokens)
         ]
 
 
@@ -824,3 +1204,62 @@ def decode(
     result = DecodingTask(model, options).run(mel)
 
     return result[0] if single else result
+
+
+@torch.no_grad()
+def decode_tasks(
+    model: "Whisper",
+    mel: Tensor,
+    options: DecodingOptions = DecodingOptions(),
+    tasks: Sequence[str] = ("transcribe", "translate"),
+    prompts: Optional[Sequence[Optional[Union[str, List[int]]]]] = None,
+    **kwargs,
+) -> List[Union[DecodingResult, List[DecodingResult]]]:
+    """
+    Performs several tasks on 30-second audio segment(s), e.g. both transcribing and translating
+    them, encoding the audio once and decoding the tasks as rows of one batch.
+
+    Parameters
+    ----------
+    model: Whisper
+        the multilingual Whisper model instance
+
+    mel: torch.Tensor, shape = (80, 3000) or (*, 80, 3000)
+        A tensor containing the Mel spectrogram(s)
+
+    options: DecodingOptions
+        A dataclass that contains the decoding options shared by the tasks; `task` is ignored
+
+    tasks: Sequence[str]
+        The tasks to perform, "transcribe" and/or "translate"
+
+    prompts: Optional[Sequence[Optional[Union[str, List[int]]]]]
+        The prompt of each task, instead of `options.prompt`
+
+    Returns
+    -------
+    results: List[Union[DecodingResult, List[DecodingResult]]]
+        The result(s) of each task, in the order of `tasks`
+    """
+    if single := mel.ndim == 2:
+        mel = mel.unsqueeze(0)
+
+    if kwargs:
+        options = replace(options, **kwargs)
+
+    task = DecodingTask(model, options, tasks=tasks, prompts=prompts)
+    if any(task.task_padding) and not isinstance(task.inference, PyTorchInference):
+        # the static-shape decoder steps cannot mask the padding of the shorter prompts, so the
+        # tasks are decoded one after another, from the same audio features
+        audio_features = task._get_audio_features(mel)
+        prompts = prompts or [options.prompt] * len(tasks)
+        results = [
+            DecodingTask(model, replace(options, task=t, prompt=p)).run(audio_features)
+            for t, p in zip(tasks, prompts)
+        ]
+    else:
+        result = task.run(mel)
+        n_audio = mel.shape[0]
+        results = [result[i : i + n_audio] for i in range(0, len(result), n_audio)]
+
+    return [r[0] for r in results] if single else results
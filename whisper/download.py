@@ -0,0 +1,180 @@
+import hashlib
+import http.client
+import json
+import os
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Tuple
+
+from tqdm import tqdm
+
+CHUNK_SIZE = 16 << 20  # bytes fetched per range request
+READ_SIZE = 1 << 20  # bytes read from the connection at a time
+N_CONNECTIONS = 4
+MAX_RETRIES = 3
+
+
+def download_file(
+    url: str,
+    target: str,
+    expected_sha256: str,
+    n_connections: int = N_CONNECTIONS,
+    chunk_size: int = CHUNK_SIZE,
+):
+    """
+    Download `url` into `target` and verify its SHA256 checksum.
+
+    When the server supports HTTP Range requests, the file is fetched in chunks over several
+    connections, failed chunks are retried, and the chunks that completed are recorded next to
+    the partial file, so that an interrupted download resumes where it left off. The checksum is
+    computed while downloading, over the chunks completed so far from the start of the file.
+    Other servers are read in a single stream.
+
+    Parameters
+    ----------
+    url : str
+        the URL to download
+    target : str
+        the path to write the file to; it only appears once the download has been verified
+    expected_sha256 : str
+        the hex-encoded SHA256 checksum of the file
+    n_connections : int
+        the number of concurrent range requests
+    chunk_size : int
+        the number of bytes per range request
+    """
+    partial = target + ".part"
+    size, accepts_ranges = _probe(url)
+
+    if size is not None and accepts_ranges:
+        sha256 = _download_ranges(url, partial, size, n_connections, chunk_size)
+    else:
+        sha256 = _download_stream(url, partial, size)
+
+    if sha256 != expected_sha256:
+        os.remove(partial)
+        raise RuntimeError(
+            "Model has been downloaded but the SHA256 checksum does not not match. Please retry loading the model."
+        )
+    os.replace(partial, target)
+
+
+def _probe(url: str) -> Tuple[Optional[int], bool]:
+    if not url.startswith(("http://", "https://")):
+        return None, False
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD")) as r:
+            size = r.headers.get("Content-Length")
+            accepts_ranges = r.headers.get("Accept-Ranges", "").lower() == "bytes"
+            return (int(size) if size is not None else None), accepts_ranges
+    except OSError:
+        return None, False
+
+
+def _progress_bar(total: Optional[int], initial: int = 0) -> tqdm:
+    return tqdm(
+        total=total,
+        initial=initial,
+        ncols=80,
+        unit="iB",
+        unit_scale=True,
+        unit_divisor=1024,
+    )
+
+
+def _download_stream(url: str, partial: str, size: Optional[int]) -> str:
+    sha256 = hashlib.sha256()
+    with urllib.request.urlopen(url) as source, open(partial, "wb") as output:
+        if size is None and source.info().get("Content-Length") is not None:
+            size = int(source.info().get("Content-Length"))
+        with _progress_bar(size) as loop:
+            while buffer := source.read(READ_SIZE):
+                output.write(buffer)
+                sha256.update(buffer)
+                loop.update(len(buffer))
+    return sha256.hexdigest()
+
+
+def _download_ranges(
+    url: str, partial: str, size: int, n_connections: int, chunk_size: int
+) -> str:
+    n_chunks = (size + chunk_size - 1) // chunk_size
+    state = {"url": url, "size": size, "chunk_size": chunk_size}
+
+    # resume from the chunks recorded as complete, if they belong to this same download
+    done = set()
+    if os.path.isfile(partial) and os.path.getsize(partial) == size:
+        try:
+            with open(partial + ".json") as f:
+                progress = json.load(f)
+            if {key: progress.get(key) for key in state} == state:
+                done = set(progress["done"])
+        except (OSError, ValueError, KeyError):
+            pass
+    if not done:
+        with open(partial, "wb") as f:
+            f.truncate(size)
+
+    def save_progress():
+        with open(partial + ".json", "w") as f:
+            json.dump({**state, "done": sorted(done)}, f)
+
+    sha256, n_hashed = hashlib.sha256(), 0
+
+    def update_hash():
+        # hash the chunks that are complete from the start of the file
+        nonlocal n_hashed
+        with open(partial, "rb") as f:
+            while n_hashed < n_chunks and n_hashed in done:
+                f.seek(n_hashed * chunk_size)
+                sha256.update(f.read(min(chunk_size, size - n_hashed * chunk_size)))
+                n_hashed += 1
+
+    update_hash()
+    pending = {
+        i: (i * chunk_size, min((i + 1) * chunk_size, size))
+        for i in range(n_chunks)
+        if i not in done
+    }
+    initial = size - sum(end - start for start, end in pending.values())
+
+    with _progress_bar(size, initial) as loop:
+        with ThreadPoolExecutor(n_connections) as pool:
+            futures = {
+                pool.submit(_fetch_range, url, partial, start, end, loop): i
+                for i, (start, end) in pending.items()
+            }
+            for future in as_completed(futures):
+                future.result()
+                done.add(futures[future])
+                save_progress()
+                update_hash()
+
+    os.remove(partial + ".json")
+    return sha256.hexdigest()
+
+
+def _fetch_range(url: str, partial: str, start: int, end: int, loop: tqdm):
+    for attempt in range(MAX_RETRIES):
+        written = 0
+        try:
+            headers = {"Range": f"bytes={start}-{end - 1}"}
+            request = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(request) as source, open(
+                partial, "r+b"
+            ) as output:
+                if source.status != 206:
+                    raise RuntimeError(f"Range request not honored for {url}")
+                output.seek(start)
+                while written < end - start:
+                    buffer = source.read(min(READ_SIZE, end - start - written))
+                    if not buffer:
+                        raise OSError(f"Connection closed while downloading {url}")
+                    output.write(buffer)
+                    written += len(buffer)
+                    loop.update(len(buffer))
+            return
+        except (OSError, http.client.HTTPException):
+            loop.update(-written)
+            if attempt == MAX_RETRIES - 1:
+                raise
@@ -0,0 +1,203 @@
+import argparse
+import contextlib
+import itertools
+import json
+import sys
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Union
+
+import numpy as np
+import torch
+
+from .audio import N_SAMPLES, load_audio, log_mel_spectrogram, pad_or_trim
+from .decoding import detect_language
+from .tokenizer import get_tokenizer
+from .utils import str2bool
+
+if TYPE_CHECKING:
+    from .model import Whisper
+
+
+def window_offsets(n_samples: int, n_windows: int) -> List[int]:
+    """The first samples of up to `n_windows` 30-second windows spread evenly over the audio"""
+    if n_samples <= N_SAMPLES or n_windows <= 1:
+        return [0]
+    offsets = np.linspace(0, n_samples - N_SAMPLES, n_windows).round().astype(int)
+    return sorted(set(offsets.tolist()))
+
+
+def identify_languages(
+    model: "Whisper",
+    audio: Iterable[Union[str, np.ndarray, torch.Tensor]],
+    *,
+    n_windows: int = 1,
+    batch_size: int = 16,
+    n_loaders: int = 4,
+    fp16: bool = True,
+) -> Iterator[dict]:
+    """
+    Identify the spoken language of many audio files, batching the 30-second windows of several
+    files into each forward pass. The decoder only computes the logits of the language tokens.
+
+    Parameters
+    ----------
+    model: Whisper
+        A multilingual Whisper model instance
+
+    audio: Iterable[Union[str, np.ndarray, torch.Tensor]]
+        The paths to the audio files, or the audio waveforms in 16 kHz
+
+    n_windows: int
+        The number of windows to spread evenly over each file; the language probabilities of the
+        windows are averaged, so that a single window of music or silence does not decide it
+
+    batch_size: int
+        The number of windows in each forward pass
+
+    n_loaders: int
+        The number of files to decode with ffmpeg concurrently, ahead of the forward passes
+
+    fp16: bool
+        Whether to run the forward passes in float16, as in `transcribe()`; on CPU, they always
+        run in float32
+
+    Returns
+    -------
+    A dictionary per file, in the order given, with its path or index ("audio"), the detected
+    language ("language") and its probability ("probability"), and the language detected in each
+    window ("windows"); or, if the file could not be loaded, the error message ("error").
+    """
+    if not model.is_multilingual:
+        raise ValueError(
+            "This model doesn't have language tokens so it can't perform lang id"
+        )
+
+    tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages)
+    dtype = torch.float16 if fp16 else torch.float32
+    if model.device == torch.device("cpu"):
+        if torch.cuda.is_available():
+            warnings.warn("Performing inference on CPU when CUDA is available")
+        if dtype == torch.float16:
+            warnings.warn("FP16 is not supported on CPU; using FP32 instead")
+            dtype = torch.float32
+
+    # the results of the files in progress, and their window counts
+    results, pending = {}, {}
+    windows, owners = [], []
+    next_index = 0  # the next file to yield, in order
+
+    def run_batch():
+        mel = torch.stack(windows).to(model.device, dtype)
+        _, probs = detect_language(model, mel, tokenizer)
+        for index, window_probs in zip(owners, probs):
+            results[index]["window_probs"].append(window_probs)
+            pending[index] -= 1
+        windows.clear()
+        owners.clear()
+
+    def finished() -> Iterator[dict]:
+        nonlocal next_index
+        while next_index in results and pending.get(next_index, 0) == 0:
+            result = results.pop(next_index)
+            pending.pop(next_index, None)
+            next_index += 1
+            if "error" not in result:
+                window_probs = result.pop("window_probs")
+                codes = window_probs[0].keys()
+                mean = {c: np.mean([p[c] for p in window_probs]) for c in codes}
+                result["language"] = max(mean, key=mean.get)
+                result["probability"] = float(mean[result["language"]])
+                result["windows"] = [max(p, key=p.get) for p in window_probs]
+            yield result
+
+    def load(item):
+        return load_audio(item) if isinstance(item, str) else item
+
+    with ThreadPoolExecutor(n_loaders) as executor:
+        # keep a bounded number of files loading ahead, rather than submitting them all at once
+        items = enumerate(audio)
+        loading = deque(
+            (index, item, executor.submit(load, item))
+            for index, item in itertools.islice(items, 2 * n_loaders)
+        )
+        while loading:
+            index, item, future = loading.popleft()
+            for next_item in itertools.islice(items, 1):
+                loading.append((*next_item, executor.submit(load, next_item[1])))
+
+            name = item if isinstance(item, str) else index
+            try:
+                samples = future.result()
+            except Exception as e:
+                results[index] = {"audio": name, "error": f"{type(e).__name__}: {e}"}
+                yield from finished()
+                continue
+
+            offsets = window_offsets(len(samples), n_windows)
+            results[index] = {"audio": name, "window_probs": []}
+            pending[index] = len(offsets)
+            for offset in offsets:
+                segment = pad_or_trim(samples[offset : offset + N_SAMPLES])
+                windows.append(log_mel_spectrogram(segment, model.dims.n_mels))
+                owners.append(index)
+                if len(windows) == batch_size:
+                    run_batch()
+                    yield from finished()
+
+    if windows:
+        run_batch()
+    yield from finished()
+
+
+def cli():
+    from . import load_model
+
+    # fmt: off
+    parser = argparse.ArgumentParser(description="identify the spoken language of audio files, writing one JSON line per file", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("audio", nargs="*", type=str, help="audio file(s) to identify the language of")
+    parser.add_argument("--file_list", type=str, default=None, help="a file with one audio path per line, or '-' to read them from stdin")
+    parser.add_argument("--model", default="turbo", help="name of the Whisper model to use, or the path to a model checkpoint")
+    parser.add_argument("--model_dir", type=str, default=None, help="the path to save model files; uses ~/.cache/whisper by default")
+    parser.add_argument("--device", default=None, help="device to use for PyTorch inference; uses CUDA if available by default")
+    parser.add_argument("--n_windows", type=int, default=1, help="number of 30-second windows per file to average the language probabilities over")
+    parser.add_argument("--batch_size", type=int, default=16, help="number of windows in each forward pass")
+    parser.add_argument("--n_loaders", type=int, default=4, help="number of audio files to decode concurrently")
+    parser.add_argument("--fp16", type=str2bool, default=True, help="whether to perform inference in fp16; True by default")
+    parser.add_argument("--output", "-o", type=str, default="-", help="the JSONL file to write, or '-' for stdout")
+    # fmt: on
+
+    args = parser.parse_args()
+    if args.file_list is None:
+        file_list = contextlib.nullcontext([])
+    elif args.file_list == "-":
+        file_list = contextlib.nullcontext(sys.stdin)
+    else:
+        file_list = open(args.file_list)
+
+    model = load_model(args.model, device=args.device, download_root=args.model_dir)
+
+    # the listed paths are read as the files are processed, so the list is kept open until then
+    with file_list as lines:
+        listed = (line.strip() for line in lines if line.strip())
+        results = identify_languages(
+            model,
+            itertools.chain(args.audio, listed),
+            n_windows=args.n_windows,
+            batch_size=args.batch_size,
+            n_loaders=args.n_loaders,
+            fp16=args.fp16,
+        )
+
+        output = sys.stdout if args.output == "-" else open(args.output, "w")
+        try:
+            for result in results:
+                print(json.dumps(result, ensure_ascii=False), file=output, flush=True)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+
+if __name__ == "__main__":
+    cli()
@@ -2,16 +2,17 @@ import base64
 import gzip
 from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Dict, Iterable, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import Tensor, nn
 
+from . import _import_attribute
+from .decoding import DecodingOptions
 from .decoding import decode as decode_function
 from .decoding import detect_language as detect_language_function
-from .transcribe import transcribe as transcribe_function
 
 try:
     from torch.nn.functional import scaled_dot_product_attention
@@ -21,6 +22,9 @@ except (ImportError, RuntimeError, OSError):
     scaled_dot_product_attention = None
     SDPA_AVAILABLE = False
 
+# through the package rather than `from .transcribe import transcribe`; see `_import_attribute`
+transcribe_function = _import_attribute("transcribe")
+
 
 @dataclass
 class ModelDimensions:
@@ -38,7 +42,13 @@ class ModelDimensions:
 
 class LayerNorm(nn.LayerNorm):
     def forward(self, x: Tensor) -> Tensor:
-        return super().forward(x.float()).type(x.dtype)
+        return F.layer_norm(
+            x.float(),
+            self.normalized_shape,
+            None if self.weight is None else self.weight.float(),
+            None if self.bias is None else self.bias.float(),
+            self.eps,
+        ).type(x.dtype)
 
 
 class Linear(nn.Linear):
@@ -59,6 +69,52 @@ class Conv1d(nn.Conv1d):
         )
 
 
+class PackedSlice(nn.Module):
+    """Selects one of the projections from the output of a packed `Linear`"""
+
+    def __init__(self, index: int, n_state: int):
+        super().__init__()
+        self.start = index * n_state
+        self.end = (index + 1) * n_state
+
+    def forward(self, x: Tensor) -> Tensor:
+        return x[..., self.start : self.end]
+
+
+def _split_qkv_state_dict(module, state_dict, prefix, local_metadata):
+    # save the packed projection in the original checkpoint format
+    if isinstance(state_dict[prefix + "qkv.weight"], nn.Parameter):
+        return  # keep_vars=True, e.g. when tracing: the parameters themselves are wanted
+    weights = state_dict.pop(prefix + "qkv.weight").chunk(3)
+    biases = state_dict.pop(prefix + "qkv.bias").chunk(3)
+    for name, weight, bias in zip(("query", "key", "value"), weights, biases):
+        state_dict[prefix + name + ".weight"] = weight
+        if name != "key":
+            state_dict[prefix + name + ".bias"] = bias
+    for name in ("out.weight", "out.bias"):  # keep the original ordering of the keys
+        state_dict[prefix + name] = state_dict.pop(prefix + name)
+
+
+def _pack_qkv_state_dict(state_dict, prefix, *args):
+    # load checkpoints in the original format into the packed projection
+    if prefix + "query.weight" not in state_dict:
+        return
+    query_bias = state_dict.pop(prefix + "query.bias")
+    state_dict[prefix + "qkv.weight"] = torch.cat(
+        [
+            state_dict.pop(prefix + f"{name}.weight")
+            for name in ("query", "key", "value")
+        ]
+    )
+    state_dict[prefix + "qkv.bias"] = torch.cat(
+        [
+            query_bias,
+            torch.zeros_like(query_bias),
+            state_dict.pop(prefix + "value.bias"),
+        ]
+    )
+
+
 def sinusoids(length, channels, max_timescale=10000):
     """Returns sinusoids for positional embedding"""
     assert channels % 2 == 0
@@ -70,6 +126,11 @@ def sinusoids(length, channels, max_timescale=10000):
 
 @contextmanager
 def disable_sdpa():
+    """
+    Computes the attention without the fused SDPA kernel, in every thread, while in effect.
+    Whisper itself no longer needs this: the attention weights of the alignment heads are
+    requested per call, with the `cross_qk` and `qk_heads` arguments of `TextDecoder.forward()`.
+    """
     prev_state = MultiHeadAttention.use_sdpa
     try:
         MultiHeadAttention.use_sdpa = False
@@ -79,6 +140,7 @@ def disable_sdpa():
 
 
 class MultiHeadAttention(nn.Module):
+    # whether to use the fused SDPA kernel where it is available; see `disable_sdpa()`
     use_sdpa = True
 
     def __init__(self, n_state: int, n_head: int):
@@ -88,6 +150,33 @@ class MultiHeadAttention(nn.Module):
         self.key = Linear(n_state, n_state, bias=False)
         self.value = Linear(n_state, n_state)
         self.out = Linear(n_state, n_state)
+        self.qkv: Optional[Linear] = None  # set by `fuse_qkv()`
+
+    def fuse_qkv(self):
+        """
+        Pack the query, key and value projections into a single `Linear`, so that self-attention
+        performs one matrix multiplication instead of three. `query`, `key` and `value` become
+        slices of its output, so they still key the kv-cache entries, and the state_dict keeps
+        using the original checkpoint format. Not applicable to cross-attention, which projects
+        the audio features to keys and values instead of `x`.
+        """
+        if self.qkv is not None:
+            return
+
+        n_state = self.query.in_features
+        state_dict = self.state_dict()
+        _pack_qkv_state_dict(state_dict, "")
+
+        weight = state_dict["qkv.weight"]
+        self.qkv = nn.utils.skip_init(
+            Linear, n_state, 3 * n_state, device=weight.device, dtype=weight.dtype
+        )
+        self.qkv.load_state_dict({"weight": weight, "bias": state_dict["qkv.bias"]})
+        self.query = PackedSlice(0, n_state)
+        self.key = PackedSlice(1, n_state)
+        self.value = PackedSlice(2, n_state)
+        self._register_state_dict_hook(_split_qkv_state_dict)
+        self._register_load_state_dict_pre_hook(_pack_qkv_state_dict)
 
     def forward(
         self,
@@ -95,49 +184,131 @@ class MultiHeadAttention(nn.Module):
         xa: Optional[Tensor] = None,
         mask: Optional[Tensor] = None,
         kv_cache: Optional[dict] = None,
+        qk_heads: Optional[List[int]] = None,
     ):
+        """
+        kv_cache : dict, optional
+            the key and value tensors of the previous calls, keyed by the `key` and `value`
+            modules, which is updated in-place; owned by the caller, e.g. one per decoding task
+        qk_heads : List[int], optional
+            the heads whose attention weights before the softmax are computed explicitly and
+            returned; the attention itself uses the fused SDPA kernel unless these are all heads
+        """
+        if self.qkv is not None:
+            # a packed self-attention projection; `query`, `key` and `value` slice its output
+            x = self.qkv(x)
+
         q = self.query(x)
 
-        if kv_cache is None or xa is None or self.key not in kv_cache:
-            # hooks, if installed (i.e. kv_cache is not None), will prepend the cached kv tensors;
-            # otherwise, perform key/value projections for self- or cross-attention as usual.
+        if kv_cache is None:
             k = self.key(x if xa is None else xa)
             v = self.value(x if xa is None else xa)
-        else:
+        elif xa is not None:
             # for cross-attention, calculate keys and values once and reuse in subsequent calls.
+            if self.key not in kv_cache:
+                kv_cache[self.key] = self.key(xa)
+                kv_cache[self.value] = self.value(xa)
             k = kv_cache[self.key]
             v = kv_cache[self.value]
-
-        wv, qk = self.qkv_attention(q, k, v, mask)
+        else:
+            # for self-attention, append the keys and values of `x` to those of the previous tokens
+            k = self.key(x)
+            v = self.value(x)
+            if self.key in kv_cache:
+                k = torch.cat([kv_cache[self.key], k], dim=1).detach()
+                v = torch.cat([kv_cache[self.value], v], dim=1).detach()
+            kv_cache[self.key] = k
+            kv_cache[self.value] = v
+
+        wv, qk = self.qkv_attention(q, k, v, mask, qk_heads)
         return self.out(wv), qk
 
     def qkv_attention(
-        self, q: Tensor, k: Tensor, v: Tensor, mask: Optional[Tensor] = None
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        mask: Optional[Tensor] = None,
+        qk_heads: Optional[List[int]] = None,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         n_batch, n_ctx, n_state = q.shape
         scale = (n_state // self.n_head) ** -0.25
+        row_masks = mask is not None and mask.ndim == 4  # (n_batch, 1, n_ctx, n_keys)
+        if mask is not None and not row_masks:
+            mask = mask[:n_ctx, :n_ctx]
         q = q.view(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
         k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
         v = v.view(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
 
-        if SDPA_AVAILABLE and MultiHeadAttention.use_sdpa:
-            a = scaled_dot_product_attention(
-                q, k, v, is_causal=mask is not None and n_ctx > 1
-            )
+        all_heads = qk_heads is not None and len(qk_heads) == self.n_head
+        if SDPA_AVAILABLE and MultiHeadAttention.use_sdpa and not all_heads:
+            if row_masks:
+                a = scaled_dot_product_attention(q, k, v, attn_mask=mask.to(q.dtype))
+            else:
+                a = scaled_dot_product_attention(
+                    q, k, v, is_causal=mask is not None and n_ctx > 1
+                )
             out = a.permute(0, 2, 1, 3).flatten(start_dim=2)
             qk = None
+            if qk_heads:
+                # only the few requested heads are computed outside of the fused kernel
+                q, k = q[:, qk_heads], k[:, qk_heads]
+                qk = (q * scale) @ (k * scale).transpose(-1, -2)
+                if mask is not None:
+                    qk = qk + mask
+                qk = qk.float().detach()
         else:
             qk = (q * scale) @ (k * scale).transpose(-1, -2)
             if mask is not None:
-                qk = qk + mask[:n_ctx, :n_ctx]
+                qk = qk + mask
             qk = qk.float()
 
             w = F.softmax(qk, dim=-1).to(q.dtype)
             out = (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2)
             qk = qk.detach()
+            if qk_heads is not None and not all_heads:
+                qk = qk[:, qk_heads] if qk_heads else None
 
         return out, qk
 
+    def forward_static(
+        self,
+        x: Tensor,
+        kv_cache: Tuple[Tensor, Tensor],
+        mask: Optional[Tensor] = None,
+        positions: Optional[Tensor] = None,
+    ) -> Tensor:
+        """
+        Attention over preallocated key/value tensors of a fixed length. For self-attention, the
+        keys and values of `x` are written in-place at `positions`, and the boolean `mask` selects
+        the cache entries each query may attend to. Cross-attention passes neither.
+        """
+        if self.qkv is not None:
+            x = self.qkv(x)
+
+        q = self.query(x)
+        k, v = kv_cache
+        if positions is not None:
+            k.index_copy_(1, positions, self.key(x))
+            v.index_copy_(1, positions, self.value(x))
+
+        n_batch, n_ctx, n_state = q.shape
+        scale = (n_state // self.n_head) ** -0.25
+        q = q.view(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
+        k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
+        v = v.view(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
+
+        if SDPA_AVAILABLE and MultiHeadAttention.use_sdpa:
+            a = scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        else:
+            qk = (q * scale) @ (k * scale).transpose(-1, -2)
+            if mask is not None:
+                qk = qk.masked_fill(~mask, -np.inf)
+            w = F.softmax(qk.float(), dim=-1).to(q.dtype)
+            a = w @ v
+
+        return self.out(a.permute(0, 2, 1, 3).flatten(start_dim=2))
+
 
 class ResidualAttentionBlock(nn.Module):
     def __init__(self, n_state: int, n_head: int, cross_attention: bool = False):
@@ -163,10 +334,32 @@ class ResidualAttentionBlock(nn.Module):
         xa: Optional[Tensor] = None,
         mask: Optional[Tensor] = None,
         kv_cache: Optional[dict] = None,
+        cross_qk: Optional[list] = None,
+        qk_heads: Optional[List[int]] = None,
     ):
         x = x + self.attn(self.attn_ln(x), mask=mask, kv_cache=kv_cache)[0]
         if self.cross_attn:
-            x = x + self.cross_attn(self.cross_attn_ln(x), xa, kv_cache=kv_cache)[0]
+            if cross_qk is not None and qk_heads is None:
+                qk_heads = list(range(self.cross_attn.n_head))
+            out, qk = self.cross_attn(
+                self.cross_attn_ln(x), xa, kv_cache=kv_cache, qk_heads=qk_heads
+            )
+            x = x + out
+            if cross_qk is not None:
+                cross_qk.append(qk)
+        x = x + self.mlp(self.mlp_ln(x))
+        return x
+
+    def forward_static(
+        self,
+        x: Tensor,
+        mask: Tensor,
+        positions: Tensor,
+        kv_cache: Tuple[Tensor, Tensor],
+        cross_kv_cache: Tuple[Tensor, Tensor],
+    ):
+        x = x + self.attn.forward_static(self.attn_ln(x), kv_cache, mask, positions)
+        x = x + self.cross_attn.forward_static(self.cross_attn_ln(x), cross_kv_cache)
         x = x + self.mlp(self.mlp_ln(x))
         return x
 
@@ -221,25 +414,118 @@ class TextDecoder(nn.Module):
         )
         self.ln = LayerNorm(n_state)
 
-        mask = torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1)
+        # not part of the checkpoint, so it is built on CPU even under `torch.device("meta")`
+        mask = torch.empty(n_ctx, n_ctx, device="cpu").fill_(-np.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
 
-    def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[dict] = None):
+    def forward(
+        self,
+        x: Tensor,
+        xa: Tensor,
+        kv_cache: Optional[dict] = None,
+        cross_qk: Optional[list] = None,
+        qk_heads: Optional[List[List[int]]] = None,
+        projection: Optional[Tensor] = None,
+        padding: Optional[Tensor] = None,
+    ):
         """
         x : torch.LongTensor, shape = (batch_size, <= n_ctx)
             the text tokens
         xa : torch.Tensor, shape = (batch_size, n_audio_ctx, n_audio_state)
             the encoded audio features to be attended on
+        kv_cache : dict, optional
+            the keys and values of the previous tokens, updated in-place; see `MultiHeadAttention`
+        cross_qk : list, optional
+            if given, the cross-attention weights of each layer before the softmax,
+            of shape (batch_size, n_head, n_tokens, n_audio_ctx), are appended to it
+        qk_heads : List[List[int]], optional
+            the heads of each layer to append the cross-attention weights of to `cross_qk`,
+            instead of all heads; None is appended for the layers without any
+        projection : torch.Tensor, shape = (n_tokens, n_text_state), optional
+            the rows of the token embedding to project on, e.g. `token_embedding.weight[vocab]`,
+            so that only the logits of those tokens are computed, in that order; this skips most
+            of the output projection when only a few tokens are of interest
+        padding : torch.LongTensor, shape = (batch_size,), optional
+            the number of padding tokens at the start of each sequence, to decode sequences of
+            different lengths in one batch; the tokens after them do not attend to them, and
+            their positions start after them
         """
         offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
-        x = (
-            self.token_embedding(x)
-            + self.positional_embedding[offset : offset + x.shape[-1]]
-        )
+        n_ctx = x.shape[-1]
+        mask = self.mask
+        if padding is None:
+            positional_embedding = self.positional_embedding[offset : offset + n_ctx]
+        else:
+            keys = torch.arange(offset + n_ctx, device=x.device)
+            queries = keys[offset:]
+            positions = (queries - padding[:, None]).clamp(min=0)
+            positional_embedding = self.positional_embedding[positions]
+            padded = (keys < padding[:, None, None]) & (
+                queries[:, None] >= padding[:, None, None]
+            )
+            causal = self.mask[offset : offset + n_ctx, : offset + n_ctx]
+            mask = causal.masked_fill(padded, -np.inf)[:, None]
+        x = self.token_embedding(x) + positional_embedding
         x = x.to(xa.dtype)
 
-        for block in self.blocks:
-            x = block(x, xa, mask=self.mask, kv_cache=kv_cache)
+        for i, block in enumerate(self.blocks):
+            heads = qk_heads[i] if qk_heads is not None else None
+            x = block(x, xa, mask, kv_cache, cross_qk=cross_qk, qk_heads=heads)
+
+        x = self.ln(x)
+        weight = self.token_embedding.weight if projection is None else projection
+        logits = (x @ torch.transpose(weight.to(x.dtype), 0, 1)).float()
+
+        return logits
+
+    def allocate_static_cache(
+        self, n_batch: int, xa: Tensor
+    ) -> Tuple[List[Tuple[Tensor, Tensor]], List[Tuple[Tensor, Tensor]]]:
+        """
+        Returns the per-layer self-attention key/value tensors of length n_ctx used by
+        `forward_static()`, and the cross-attention keys/values computed once from `xa`
+        """
+        n_ctx, n_state = self.positional_embedding.shape
+        kv_cache = [
+            (
+                xa.new_zeros(n_batch, n_ctx, n_state),
+                xa.new_zeros(n_batch, n_ctx, n_state),
+            )
+            for _ in self.blocks
+        ]
+        cross_kv_cache = [
+            (block.cross_attn.key(xa), block.cross_attn.value(xa))
+            for block in self.blocks
+        ]
+        return kv_cache, cross_kv_cache
+
+    def forward_static(
+        self,
+        x: Tensor,
+        positions: Tensor,
+        kv_cache: List[Tuple[Tensor, Tensor]],
+        cross_kv_cache: List[Tuple[Tensor, Tensor]],
+    ):
+        """
+        A variant of `forward()` whose tensor shapes do not change as decoding progresses, which
+        lets `torch.compile` reuse a single graph for every decoding step.
+
+        x : torch.LongTensor, shape = (batch_size, n_tokens)
+            the text tokens at the given positions
+        positions : torch.LongTensor, shape = (n_tokens,)
+            the positions of the given tokens in the context
+        kv_cache, cross_kv_cache :
+            the tensors returned by `allocate_static_cache()`; kv_cache is updated in-place
+        """
+        x = self.token_embedding(x) + self.positional_embedding[positions]
+        x = x.to(cross_kv_cache[0][0].dtype)
+
+        # each query attends to itself and the previous positions that are already in the cache
+        context = torch.arange(kv_cache[0][0].shape[1], device=x.device)
+        mask = positions[:, None] >= context[None, :]
+
+        for block, self_kv, cross_kv in zip(self.blocks, kv_cache, cross_kv_cache):
+            x = block.forward_static(x, mask, positions, self_kv, cross_kv)
 
         x = self.ln(x)
         logits = (
@@ -270,10 +556,18 @@ class Whisper(nn.Module):
         # use the last half among the decoder layers for time alignment by default;
         # to use a specific set of heads, see `set_alignment_heads()` below.
         all_heads = torch.zeros(
-            self.dims.n_text_layer, self.dims.n_text_head, dtype=torch.bool
+            self.dims.n_text_layer,
+            self.dims.n_text_head,
+            dtype=torch.bool,
+            device="cpu",
         )
         all_heads[self.dims.n_text_layer // 2 :] = True
         self.register_buffer("alignment_heads", all_heads.to_sparse(), persistent=False)
+        # set by `compile_for_inference()`; used for decoding in place of `decoder.forward`
+        self.compiled_decoder_step = None
+        # an `OnnxRuntime` instance, set by `load_model(..., backend="onnxruntime")`, which runs
+        # the encoder and the decoder in place of the PyTorch weights, which it releases
+        self.onnx_runtime = None
 
     def set_alignment_heads(self, dump: bytes):
         array = np.frombuffer(
@@ -284,11 +578,33 @@ class Whisper(nn.Module):
         )
         self.register_buffer("alignment_heads", mask.to_sparse(), persistent=False)
 
+    def alignment_heads_per_layer(self) -> List[List[int]]:
+        """The alignment heads of each decoder layer, as the `qk_heads` of `TextDecoder`"""
+        heads = self.alignment_heads.indices().T.tolist()
+        return [
+            [h for layer, h in heads if layer == i]
+            for i in range(self.dims.n_text_layer)
+        ]
+
+    def fuse_qkv(self):
+        """Pack the self-attention projections of all layers; see `MultiHeadAttention.fuse_qkv()`"""
+        for block in [*self.encoder.blocks, *self.decoder.blocks]:
+            block.attn.fuse_qkv()
+        return self
+
     def embed_audio(self, mel: torch.Tensor):
         return self.encoder(mel)
 
-    def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor):
-        return self.decoder(tokens, audio_features)
+    def logits(
+        self,
+        tokens: torch.Tensor,
+        audio_features: torch.Tensor,
+        vocab: Optional[torch.Tensor] = None,
+    ):
+        projection = None
+        if vocab is not None:
+            projection = self.decoder.token_embedding.weight[vocab]
+        return self.decoder(tokens, audio_features, projection=projection)
 
     def forward(
         self, mel: torch.Tensor, tokens: torch.Tensor
@@ -307,38 +623,52 @@ class Whisper(nn.Module):
     def num_languages(self):
         return self.dims.n_vocab - 51765 - int(self.is_multilingual)
 
+    def compile_for_inference(self, warmup: bool = True):
+        """
+        Compile the audio encoder and a static-shape decoder step using `torch.compile`.
+
+        The encoder always sees 30-second inputs, so it is compiled for a fixed shape. The decoder
+        step reads and writes a preallocated key/value cache of length n_text_ctx instead of
+        concatenating to it, and the initial tokens are padded to a few bucketed lengths, so that
+        a handful of graphs serve every prompt length without recompiling.
+
+        Parameters
+        ----------
+        warmup : bool
+            whether to decode a silent window right away, so that the compilation cost is paid
+            here rather than in the first call to `transcribe()` or `decode()`
+        """
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("torch.compile requires PyTorch 2.0 or later")
+
+        self.encoder.forward = torch.compile(self.encoder.forward, dynamic=False)
+        self.compiled_decoder_step = torch.compile(
+            self.decoder.forward_static, dynamic=False
+        )
+
+        if warmup:
+            fp16 = self.device.type == "cuda"
+            mel = torch.zeros(self.dims.n_mels, self.dims.n_audio_ctx * 2)
+            options = DecodingOptions(language="en", sample_len=2, fp16=fp16)
+            self.decode(mel.to(self.device), options)
+
+        return self
+
     def install_kv_cache_hooks(self, cache: Optional[dict] = None):
         """
-        The `MultiHeadAttention` module optionally accepts `kv_cache` which stores the key and value
-        tensors calculated for the previous positions. This method returns a dictionary that stores
-        all caches, and the necessary hooks for the key and value projection modules that save the
-        intermediate tensors to be reused during later calculations.
+        Returns a dictionary to pass as `kv_cache` to the decoder, which stores the key and value
+        tensors calculated for the previous positions. `MultiHeadAttention` updates it directly,
+        so no hooks are installed anymore; the empty list is kept for compatibility.
 
         Returns
         -------
         cache : Dict[nn.Module, torch.Tensor]
             A dictionary object mapping the key/value projection modules to its cache
         hooks : List[RemovableHandle]
-            List of PyTorch RemovableHandle objects to stop the hooks to be called
+            An empty list
         """
         cache = {**cache} if cache is not None else {}
-        hooks = []
-
-        def save_to_cache(module, _, output):
-            if module not in cache or output.shape[1] > self.dims.n_text_ctx:
-                # save as-is, for the first token or cross attention
-                cache[module] = output
-            else:
-                cache[module] = torch.cat([cache[module], output], dim=1).detach()
-            return cache[module]
-
-        def install_hooks(layer: nn.Module):
-            if isinstance(layer, MultiHeadAttention):
-                hooks.append(layer.key.register_forward_hook(save_to_cache))
-                hooks.append(layer.value.register_forward_hook(save_to_cache))
-
-        self.decoder.apply(install_hooks)
-        return cache, hooks
+        return cache, []
 
     detect_language = detect_language_function
     transcribe = transcribe_function
@@ -0,0 +1,409 @@
+import json
+import os
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import Tensor, nn
+
+if TYPE_CHECKING:
+    from onnxruntime import IOBinding
+
+    from .model import TextDecoder, Whisper
+
+ONNX_FILES = ("encoder.onnx", "cross_kv.onnx", "decoder.onnx", "alignment.onnx")
+# written after the graphs, with `ONNX_EXPORT_VERSION` and what the export was made from
+STAMP_FILE = "export.json"
+# bumped when the exported graphs change, so that the exports cached before are made again
+ONNX_EXPORT_VERSION = 2
+
+
+class CrossKVExport(nn.Module):
+    """
+    Computes the cross-attention keys and values of all decoder layers, with the heads split off,
+    as `DecoderStepExport` takes them
+    """
+
+    def __init__(self, decoder: "TextDecoder"):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, audio_features: Tensor) -> Tuple[Tensor, ...]:
+        return tuple(
+            _split_heads(projection(audio_features), block.cross_attn.n_head)
+            for block in self.decoder.blocks
+            for projection in (block.cross_attn.key, block.cross_attn.value)
+        )
+
+
+class DecoderStepExport(nn.Module):
+    """
+    A functional variant of `TextDecoder.forward_static()`, since ONNX graphs cannot update their
+    inputs in-place: the self-attention keys and values of the given tokens are returned instead
+    of written to the cache, and the caller copies them in at `positions`. Each step thus only
+    reads the cache, which is kept with the heads split off, so that attending over it does not
+    need a transposed copy either. The keys and values of each layer are separate inputs, which
+    the graph does not have to split a stacked tensor into.
+    """
+
+    def __init__(self, decoder: "TextDecoder"):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(
+        self,
+        tokens: Tensor,
+        positions: Tensor,
+        kv_cache: List[Tensor],
+        cross_kv_cache: List[Tensor],
+    ) -> Tuple[Tensor, Tensor]:
+        decoder = self.decoder
+        # the token embedding is looked up in its transpose, which the output projection uses,
+        # so that the graph holds a single copy of it
+        embedding = torch.transpose(decoder.token_embedding.weight, 0, 1)
+        x = (
+            embedding[:, tokens].permute(1, 2, 0)
+            + decoder.positional_embedding[positions]
+        )
+        x = x.to(cross_kv_cache[0].dtype)
+
+        # the tokens are at consecutive positions: each one attends to the cache entries before
+        # the first of them, the others being stale, and to itself and the previous new tokens
+        context = torch.arange(kv_cache[0].shape[2], device=x.device)
+        past = (context[None, :] < positions[:1, None]).expand(positions.shape[0], -1)
+        mask = torch.cat([past, positions[:, None] >= positions[None, :]], dim=1)
+
+        new_kv = []
+        for i, block in enumerate(decoder.blocks):
+            attn = block.attn
+            h = block.attn_ln(x)
+            if attn.qkv is not None:
+                h = attn.qkv(h)
+            q, k, v = [
+                _split_heads(projection(h), attn.n_head)
+                for projection in (attn.query, attn.key, attn.value)
+            ]
+            new_kv += [k, v]
+            self_kv = ((kv_cache[2 * i], k), (kv_cache[2 * i + 1], v))
+            x = x + attn.out(_attention(q, *self_kv, mask))
+
+            cross_attn = block.cross_attn
+            q = _split_heads(
+                cross_attn.query(block.cross_attn_ln(x)), cross_attn.n_head
+            )
+            cross_kv = ((cross_kv_cache[2 * i],), (cross_kv_cache[2 * i + 1],))
+            x = x + cross_attn.out(_attention(q, *cross_kv))
+
+            x = x + block.mlp(block.mlp_ln(x))
+
+        x = decoder.ln(x)
+        logits = (x @ embedding.to(x.dtype)).float()
+
+        return logits, torch.stack(new_kv)
+
+
+class AlignmentExport(nn.Module):
+    """
+    The decoder forward pass of `timing.find_alignment_batch()`, which returns the logits and the
+    cross-attention weights of the model's alignment heads, before the softmax
+    """
+
+    def __init__(self, model: "Whisper"):
+        super().__init__()
+        self.decoder = model.decoder
+        self.qk_heads = model.alignment_heads_per_layer()
+
+    def forward(self, tokens: Tensor, audio_features: Tensor) -> Tuple[Tensor, Tensor]:
+        # without padding, but with the explicit attention masks of the padding, as the causal
+        # flag of the attention kernel depends on the number of tokens, which is not traced
+        padding = tokens.new_zeros(tokens.shape[0])
+        cross_qk = []
+        logits = self.decoder(
+            tokens,
+            audio_features,
+            cross_qk=cross_qk,
+            qk_heads=self.qk_heads,
+            padding=padding,
+        )
+        return logits, torch.cat([qk for qk in cross_qk if qk is not None], dim=1)
+
+
+def _split_heads(x: Tensor, n_head: int) -> Tensor:
+    # (n_batch, n_ctx, n_state) -> (n_batch, n_head, n_ctx, n_state // n_head)
+    return x.view(*x.shape[:2], n_head, -1).permute(0, 2, 1, 3)
+
+
+def _attention(
+    q: Tensor,
+    keys: Tuple[Tensor, ...],
+    values: Tuple[Tensor, ...],
+    mask: Optional[Tensor] = None,
+) -> Tensor:
+    # attention over the concatenation of `keys` and `values` without concatenating them,
+    # which would copy the cache; only the attention weights of each part are concatenated
+    scale = q.shape[-1] ** -0.5
+    qk = torch.cat([(q * scale) @ k.transpose(-1, -2) for k in keys], dim=-1)
+    if mask is not None:
+        qk = qk.masked_fill(~mask, -np.inf)
+    w = F.softmax(qk.float(), dim=-1).to(q.dtype)
+
+    out, start = 0, 0
+    for k, v in zip(keys, values):
+        out = out + w[..., start : start + k.shape[-2]] @ v
+        start += k.shape[-2]
+    return out.permute(0, 2, 1, 3).flatten(start_dim=2)
+
+
+def is_exported(output_dir: str, stamp: Optional[dict] = None) -> bool:
+    """Whether `output_dir` holds the graphs of a finished export with this version and stamp"""
+    try:
+        with open(os.path.join(output_dir, STAMP_FILE)) as f:
+            exported = json.load(f)
+    except (OSError, ValueError):
+        return False
+    expected = {**(stamp or {}), "version": ONNX_EXPORT_VERSION}
+    files = [os.path.join(output_dir, filename) for filename in ONNX_FILES]
+    return exported == expected and all(map(os.path.isfile, files))
+
+
+@torch.no_grad()
+def export_onnx(
+    model: "Whisper",
+    output_dir: str,
+    opset_version: int = 17,
+    stamp: Optional[dict] = None,
+):
+    """
+    Export the audio encoder, the cross-attention key/value projections, the static-shape
+    decoder step and the alignment pass of a Whisper model as ONNX graphs, for `OnnxRuntime` to
+    load. The alignment pass uses the alignment heads the model has at the time of the export.
+
+    Parameters
+    ----------
+    model : Whisper
+        the model to export; the graphs are exported in float32
+    output_dir : str
+        the directory to write the graphs of `ONNX_FILES` into
+    opset_version : int
+        the ONNX opset to target
+    stamp : dict, optional
+        what the export is made from, e.g. the checkpoint, recorded for `is_exported()` to check
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    stamp_path = os.path.join(output_dir, STAMP_FILE)
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)  # until the graphs written over are complete again
+    dims = model.dims
+    device = model.device
+
+    mel = torch.zeros(1, dims.n_mels, dims.n_audio_ctx * 2, device=device)
+    audio_features = model.encoder(mel)
+    n_layers = dims.n_text_layer * 2
+    n_head = dims.n_text_head
+    shape = (1, n_head, dims.n_text_ctx, dims.n_text_state // n_head)
+    kv_cache = [torch.zeros(shape).to(mel) for _ in range(n_layers)]
+    cross_kv_cache = list(CrossKVExport(model.decoder)(audio_features))
+    self_kv_names = [f"kv_cache.{i}" for i in range(n_layers)]
+    cross_kv_names = [f"cross_kv_cache.{i}" for i in range(n_layers)]
+    tokens = torch.zeros(1, 4, dtype=torch.long, device=device)
+    positions = torch.arange(4, device=device)
+
+    exports = [
+        (
+            model.encoder,
+            (mel,),
+            ["mel"],
+            ["audio_features"],
+            {"mel": {0: "n_audio"}, "audio_features": {0: "n_audio"}},
+        ),
+        (
+            CrossKVExport(model.decoder),
+            (audio_features,),
+            ["audio_features"],
+            cross_kv_names,
+            {
+                "audio_features": {0: "n_audio"},
+                **{name: {0: "n_audio"} for name in cross_kv_names},
+            },
+        ),
+        (
+            DecoderStepExport(model.decoder),
+            (tokens, positions, kv_cache, cross_kv_cache),
+            ["tokens", "positions", *self_kv_names, *cross_kv_names],
+            ["logits", "new_kv_cache"],
+            {
+                "tokens": {0: "n_batch", 1: "n_tokens"},
+                "positions": {0: "n_tokens"},
+                **{name: {0: "n_batch"} for name in self_kv_names},
+                **{name: {0: "n_audio"} for name in cross_kv_names},
+                "logits": {0: "n_batch", 1: "n_tokens"},
+                "new_kv_cache": {1: "n_batch", 3: "n_tokens"},
+            },
+        ),
+        (
+            AlignmentExport(model),
+            (tokens, audio_features),
+            ["tokens", "audio_features"],
+            ["logits", "cross_qk"],
+            {
+                "tokens": {0: "n_audio", 1: "n_tokens"},
+                "audio_features": {0: "n_audio"},
+                "logits": {0: "n_audio", 1: "n_tokens"},
+                "cross_qk": {0: "n_audio", 2: "n_tokens"},
+            },
+        ),
+    ]
+
+    for filename, (module, args, input_names, output_names, axes) in zip(
+        ONNX_FILES, exports
+    ):
+        torch.onnx.export(
+            module,
+            args,
+            os.path.join(output_dir, filename),
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=axes,
+            opset_version=opset_version,
+            dynamo=False,
+        )
+
+    # written last, so that an interrupted export is not taken for a finished one
+    with open(stamp_path, "w") as f:
+        json.dump({**(stamp or {}), "version": ONNX_EXPORT_VERSION}, f)
+
+
+def release_weights(model: "Whisper"):
+    """
+    Frees the PyTorch weights of a model whose `onnx_runtime` takes over all of its forward
+    passes: the decoding, the language detection and the alignment for word timestamps. The
+    parameters keep their device and dtype, but no elements, so the PyTorch modules cannot be run.
+    """
+    for parameter in model.parameters():
+        parameter.data = parameter.new_empty(0)
+
+
+class OnnxRuntime:
+    """
+    ONNX Runtime sessions for the graphs written by `export_onnx()`. The decoder steps are run
+    with IO bindings of the key/value caches, which stay in place across the steps.
+    """
+
+    def __init__(self, model_dir: str, providers: Optional[List[str]] = None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError(
+                "onnxruntime is not installed; try `pip install openai-whisper[onnx]`"
+            )
+
+        self.model_dir = model_dir
+        self.providers = providers or ["CPUExecutionProvider"]
+        self.session_options = onnxruntime.SessionOptions()
+        # the intermediate tensors are freed after each run rather than kept in an arena, which
+        # would otherwise hold on to the peak memory of the encoder
+        self.session_options.enable_cpu_mem_arena = False
+        self.encoder, self.cross_kv, self.decoder = [
+            self._load(filename) for filename in ONNX_FILES[:3]
+        ]
+        # loaded on the first use, as it takes about as much memory as the decoder step
+        self.alignment = None
+        # the names of the key/value inputs of each layer, and their shape, which is
+        # (n_batch, n_text_head, n_text_ctx, n_text_state // n_text_head)
+        inputs = self.decoder.get_inputs()
+        self.kv_cache_names = [i.name for i in inputs if i.name.startswith("kv_cache.")]
+        self.kv_cache_shape = inputs[2].shape
+
+    def _load(self, filename: str):
+        from onnxruntime import InferenceSession
+
+        path = os.path.join(self.model_dir, filename)
+        return InferenceSession(path, self.session_options, providers=self.providers)
+
+    @property
+    def nbytes(self) -> int:
+        """The size of the graphs of the loaded sessions, mostly their weights"""
+        filenames = ONNX_FILES[:3] if self.alignment is None else ONNX_FILES
+        paths = [os.path.join(self.model_dir, filename) for filename in filenames]
+        return sum(map(os.path.getsize, paths))
+
+    def embed_audio(self, mel: Tensor) -> Tensor:
+        (audio_features,) = self.encoder.run(None, {"mel": _numpy(mel)})
+        return torch.from_numpy(audio_features).to(device=mel.device, dtype=mel.dtype)
+
+    def allocate_cache(
+        self, n_batch: int, audio_features: Tensor
+    ) -> Tuple[np.ndarray, "IOBinding"]:
+        """
+        Returns the self-attention keys and values of all layers for `decode()`, stacked and
+        zero-initialized, and an IO binding of the decoder step which has them and the
+        cross-attention keys and values of `audio_features` bound as its inputs, without copying
+        """
+        from onnxruntime import OrtValue
+
+        n_layers = len(self.kv_cache_names)
+        _, n_head, n_ctx, n_head_state = self.kv_cache_shape
+        shape = (n_layers, n_batch, n_head, n_ctx, n_head_state)
+        kv_cache = np.zeros(shape, dtype=np.float32)
+
+        cross_kv = self.cross_kv.io_binding()
+        cross_kv.bind_cpu_input("audio_features", _numpy(audio_features))
+        for output in self.cross_kv.get_outputs():
+            cross_kv.bind_output(output.name)
+        self.cross_kv.run_with_iobinding(cross_kv)
+
+        binding = self.decoder.io_binding()
+        # shares the memory of the array, which `decode()` writes the new keys and values into
+        for name, layer_cache in zip(self.kv_cache_names, kv_cache):
+            binding.bind_ortvalue_input(name, OrtValue.ortvalue_from_numpy(layer_cache))
+        for output, value in zip(self.cross_kv.get_outputs(), cross_kv.get_outputs()):
+            binding.bind_ortvalue_input(output.name, value)
+        return kv_cache, binding
+
+    def decode(
+        self,
+        tokens: Tensor,
+        positions: Tensor,
+        kv_cache: np.ndarray,
+        binding: "IOBinding",
+    ) -> Tensor:
+        """
+        Runs the decoder step on `tokens` at `positions`, which are consecutive, and copies their
+        keys and values into `kv_cache`; the arguments after `positions` are those returned by
+        `allocate_cache()`
+        """
+        binding.bind_cpu_input("tokens", _numpy(tokens))
+        binding.bind_cpu_input("positions", _numpy(positions))
+        # allocated by the session, as their shapes depend on the number of tokens
+        binding.bind_output("logits")
+        binding.bind_output("new_kv_cache")
+        self.decoder.run_with_iobinding(binding)
+        logits, new_kv_cache = binding.copy_outputs_to_cpu()
+
+        start = int(positions[0])
+        kv_cache[:, :, :, start : start + new_kv_cache.shape[3]] = new_kv_cache
+        return torch.from_numpy(logits).to(tokens.device)
+
+    def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
+        """The logits of `tokens` from the start of the context, as `Whisper.logits()`"""
+        kv_cache, binding = self.allocate_cache(tokens.shape[0], audio_features)
+        positions = torch.arange(tokens.shape[1])
+        return self.decode(tokens, positions, kv_cache, binding)
+
+    def align(self, tokens: Tensor, audio_features: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        Returns the logits of `tokens` and the cross-attention weights of the alignment heads
+        before the softmax, of shape (n_audio, n_alignment_heads, n_tokens, n_audio_ctx)
+        """
+        if self.alignment is None:
+            self.alignment = self._load(ONNX_FILES[3])
+
+        inputs = {"tokens": _numpy(tokens), "audio_features": _numpy(audio_features)}
+        logits, cross_qk = self.alignment.run(None, inputs)
+        return torch.from_numpy(logits), torch.from_numpy(cross_qk)
+
+
+def _numpy(x: Tensor) -> np.ndarray:
+    x = x.detach().cpu()
+    return (x.float() if x.is_floating_point() else x).numpy()
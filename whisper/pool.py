@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Dict, Optional, Tuple, Union
+
+import torch
+
+if TYPE_CHECKING:
+    from .model import Whisper
+
+
+def model_bytes(model: "Whisper") -> int:
+    """Returns the number of bytes taken by the parameters and buffers of a model"""
+    tensors = {
+        t.untyped_storage().data_ptr(): t.untyped_storage().nbytes()
+        for t in [*model.parameters(), *model.buffers()]
+        if not t.is_sparse
+    }
+    if model.onnx_runtime is not None:
+        # the weights are held by the ONNX Runtime sessions instead
+        tensors[None] = model.onnx_runtime.nbytes
+    return sum(tensors.values())
+
+
+class ModelPool:
+    """
+    A cache of loaded models shared by their users, keyed by (name, device, dtype). Models are
+    kept until their total size exceeds `memory_budget`, at which point the least recently used
+    ones are dropped from the pool; their memory is freed once no caller holds them anymore.
+    """
+
+    def __init__(self, memory_budget: Optional[int] = None, **load_options):
+        """
+        Parameters
+        ----------
+        memory_budget : Optional[int]
+            the number of bytes the pooled models may take in total, or None for no limit;
+            the most recently used model is always kept, even if it exceeds the budget alone
+        load_options :
+            other arguments for `whisper.load_model()`, e.g. download_root
+        """
+        self.memory_budget = memory_budget
+        self.load_options = load_options
+        self.models: "OrderedDict[Tuple[str, str, torch.dtype], Whisper]" = (
+            OrderedDict()
+        )
+        self.sizes = {}
+        # the models being loaded; other callers asking for the same model wait on its future
+        self.loading: Dict[Tuple[str, str, torch.dtype], Future] = {}
+        # guards the dictionaries only; models are loaded without holding it
+        self.lock = threading.Lock()
+
+    def get(
+        self,
+        name: str,
+        device: Optional[Union[str, torch.device]] = None,
+        dtype: torch.dtype = torch.float32,
+    ) -> "Whisper":
+        """Returns the pooled model, loading it with `whisper.load_model()` if needed"""
+        from . import load_model
+
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        device = torch.device(device)
+        if device.type == "cuda" and device.index is None:
+            # the current device, so that "cuda" and e.g. "cuda:0" share their models
+            device = torch.device("cuda", torch.cuda.current_device())
+        key = (name, str(device), dtype)
+
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            future = self.loading.get(key)
+            loading_elsewhere = future is not None
+            if not loading_elsewhere:
+                future = self.loading[key] = Future()
+
+        if loading_elsewhere:
+            return future.result()
+
+        try:
+            model = load_model(name, device=device, dtype=dtype, **self.load_options)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+
+        size = model_bytes(model)
+        with self.lock:
+            del self.loading[key]
+            self.models[key] = model
+            self.sizes[key] = size
+            self._evict()
+        future.set_result(model)
+        return model
+
+    @property
+    def resident_bytes(self) -> int:
+        """The total size of the pooled models"""
+        return sum(self.sizes.values())
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.sizes.clear()
+
+    def __contains__(self, key: Tuple[str, str, torch.dtype]) -> bool:
+        return key in self.models
+
+    def __len__(self) -> int:
+        return len(self.models)
+
+    def _evict(self):
+        while (
+            self.memory_budget is not None
+            and len(self.models) > 1
+            and self.resident_bytes > self.memory_budget
+        ):
+            key, _ = self.models.popitem(last=False)
+            del self.sizes[key]
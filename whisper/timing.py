@@ -2,7 +2,7 @@ import itertools
 import subprocess
 import warnings
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
 import numba
 import numpy as np
@@ -44,6 +44,10 @@ def median_filter(x: torch.Tensor, filter_width: int):
                 "falling back to a slower median kernel implementation..."
             )
 
+    if result is None and not x.is_cuda and x.dtype in (torch.float32, torch.float64):
+        if not x.isnan().any():  # the sliding kernel relies on the values being ordered
+            result = median_filter_cpu(x, filter_width)
+
     if result is None:
         # sort() is faster than torch.median (https://github.com/pytorch/pytorch/issues/51450)
         result = x.unfold(-1, filter_width, 1).sort()[0][..., filter_width // 2]
@@ -54,7 +58,42 @@ def median_filter(x: torch.Tensor, filter_width: int):
     return result
 
 
-@numba.jit(nopython=True)
+@numba.jit(nopython=True, parallel=True, cache=True)
+def _median_filter_rows(x: np.ndarray, filter_width: int, out: np.ndarray):
+    for row in numba.prange(x.shape[0]):
+        # the sorted values of the current window, updated as it slides by one
+        window = np.sort(x[row, :filter_width])
+        out[row, 0] = window[filter_width // 2]
+        for t in range(1, out.shape[1]):
+            removed, added = x[row, t - 1], x[row, t + filter_width - 1]
+            i = 0
+            while window[i] != removed:
+                i += 1
+            # shift the values between the removed one and the position of the added one
+            while i > 0 and window[i - 1] > added:
+                window[i] = window[i - 1]
+                i -= 1
+            while i < filter_width - 1 and window[i + 1] < added:
+                window[i] = window[i + 1]
+                i += 1
+            window[i] = added
+            out[row, t] = window[filter_width // 2]
+
+
+def median_filter_cpu(x: torch.Tensor, filter_width: int) -> torch.Tensor:
+    """
+    Apply a median filter of width `filter_width` along the last dimension of an already
+    padded CPU tensor without NaNs. Rather than sorting every window, like the `unfold()` path
+    does, it keeps the window sorted as it slides, in parallel over the rows.
+    """
+    rows = x.reshape(-1, x.shape[-1]).contiguous().numpy()
+    out = np.empty((rows.shape[0], rows.shape[1] - filter_width + 1), dtype=rows.dtype)
+    _median_filter_rows(rows, filter_width, out)
+    return torch.from_numpy(out).reshape(*x.shape[:-1], out.shape[-1])
+
+
+# the kernels are cached on disk, so that only the first process using them pays for compilation
+@numba.jit(nopython=True, cache=True)
 def backtrace(trace: np.ndarray):
     i = trace.shape[0] - 1
     j = trace.shape[1] - 1
@@ -79,7 +118,7 @@ def backtrace(trace: np.ndarray):
     return result[::-1, :].T
 
 
-@numba.jit(nopython=True, parallel=True)
+@numba.jit(nopython=True, parallel=True, cache=True)
 def dtw_cpu(x: np.ndarray):
     N, M = x.shape
     cost = np.ones((N + 1, M + 1), dtype=np.float32) * np.inf
@@ -105,6 +144,113 @@ def dtw_cpu(x: np.ndarray):
     return backtrace(trace)
 
 
+@numba.jit(nopython=True, cache=True)
+def _dtw_trace(x: np.ndarray, lo: np.ndarray, hi: np.ndarray, trace: np.ndarray):
+    # the same recurrence as dtw_cpu(), over the cells lo[i] <= j <= hi[i] of each row only
+    N, M = x.shape
+    cost = np.full((N + 1, M + 1), np.inf, dtype=np.float32)
+
+    cost[0, 0] = 0
+    for i in range(1, N + 1):
+        for j in range(lo[i], hi[i] + 1):
+            c0 = cost[i - 1, j - 1]
+            c1 = cost[i - 1, j]
+            c2 = cost[i, j - 1]
+
+            if c0 < c1 and c0 < c2:
+                c, t = c0, 0
+            elif c1 < c0 and c1 < c2:
+                c, t = c1, 1
+            elif j > lo[i] or j == 1:
+                c, t = c2, 2
+            elif lo[i - 1] < j:
+                # on ties or NaN costs, the first cell of a row would point to the cell on its
+                # left, which is outside of the band; the one diagonal to it is in the band,
+                c, t = c0, 0
+            else:
+                # unless the previous row starts at the same column
+                c, t = c1, 1
+
+            cost[i, j] = x[i - 1, j - 1] + c
+            trace[i, j] = t
+
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def _dtw_batch(x: np.ndarray, shapes: np.ndarray, lo: np.ndarray, hi: np.ndarray):
+    traces = -np.ones((x.shape[0], x.shape[1] + 1, x.shape[2] + 1), dtype=np.float32)
+    for b in numba.prange(x.shape[0]):
+        N, M = shapes[b, 0], shapes[b, 1]
+        _dtw_trace(x[b, :N, :M], lo[b], hi[b], traces[b, : N + 1, : M + 1])
+    return traces
+
+
+def dtw_band(
+    lower: np.ndarray, upper: np.ndarray, n_columns: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Make a band for `dtw_batch()` out of the range of columns, `lower[i]` to `upper[i]`
+    inclusive, that each row of the cost matrix is expected to align to. The ranges are widened
+    where needed for the band to contain a path from the first to the last cell.
+    """
+    lower = np.clip(np.round(lower), 0, n_columns - 1).astype(np.int64)
+    upper = np.clip(np.round(upper), lower, n_columns - 1).astype(np.int64)
+    upper = np.maximum.accumulate(upper)
+    upper[-1] = n_columns - 1
+    lower = np.minimum.accumulate(lower[::-1])[::-1]
+    lower[0] = 0
+    lower[1:] = np.minimum(lower[1:], upper[:-1] + 1)
+    return lower, upper
+
+
+def sakoe_chiba_band(
+    n_rows: int, n_columns: int, radius: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """A band of `radius` columns on either side of the diagonal of the cost matrix"""
+    diagonal = np.arange(n_rows) * (n_columns - 1) / max(n_rows - 1, 1)
+    return dtw_band(diagonal - radius, diagonal + radius, n_columns)
+
+
+def dtw_batch(
+    xs: List[np.ndarray],
+    bands: Optional[List[Optional[Tuple[np.ndarray, np.ndarray]]]] = None,
+) -> List[np.ndarray]:
+    """
+    Align several cost matrices at once, in parallel over the matrices, returning the path of
+    each like `dtw_cpu()` does.
+
+    Parameters
+    ----------
+    xs : List[np.ndarray]
+        the cost matrices, of shape (n_rows, n_columns) each
+    bands : Optional[List[Optional[Tuple[np.ndarray, np.ndarray]]]]
+        for each matrix, None for the full matrix or the first and last column of each row to
+        compute the cost of, as returned by `dtw_band()` or `sakoe_chiba_band()`; cells outside
+        of the band are never on the path, and are skipped
+    """
+    if len(xs) == 0:
+        return []
+    if bands is None:
+        bands = [None] * len(xs)
+
+    shapes = np.array([x.shape for x in xs], dtype=np.int64)
+    N, M = shapes.max(axis=0)
+    x = np.zeros((len(xs), N, M), dtype=np.float64)
+    # the bounds of each row of the cost matrices, which have an extra first row and column
+    lo = np.ones((len(xs), N + 1), dtype=np.int64)
+    hi = np.zeros((len(xs), N + 1), dtype=np.int64)
+
+    for b, (matrix, band, (n, m)) in enumerate(zip(xs, bands, shapes)):
+        x[b, :n, :m] = matrix
+        if band is None:
+            hi[b, 1 : n + 1] = m
+        else:
+            lo[b, 1 : n + 1] = band[0] + 1
+            hi[b, 1 : n + 1] = band[1] + 1
+
+    traces = _dtw_batch(x, shapes, lo, hi)
+    return [backtrace(traces[b, : n + 1, : m + 1]) for b, (n, m) in enumerate(shapes)]
+
+
 def dtw_cuda(x, BLOCK_SIZE=1024):
     from .triton_ops import dtw_kernel
 
@@ -138,7 +284,12 @@ def dtw_cuda(x, BLOCK_SIZE=1024):
     return backtrace(trace.cpu().numpy())
 
 
-def dtw(x: torch.Tensor) -> np.ndarray:
+def dtw(
+    x: torch.Tensor, band: Optional[Tuple[np.ndarray, np.ndarray]] = None
+) -> np.ndarray:
+    if band is not None:
+        return dtw_batch([x.double().cpu().numpy()], [band])[0]
+
     if x.is_cuda:
         try:
             return dtw_cuda(x)
@@ -151,6 +302,24 @@ def dtw(x: torch.Tensor) -> np.ndarray:
     return dtw_cpu(x.double().cpu().numpy())
 
 
+def warm_up():
+    """
+    Compile the CPU kernels used for word-level timestamps, or load them from the on-disk cache,
+    so that the first call to `transcribe(..., word_timestamps=True)` does not pay for it.
+    """
+    # the batched DTW of find_alignment_batch(), with and without a band, which also compiles
+    # backtrace() for the non-contiguous float32 views of the traces it returns
+    x = np.zeros((2, 2), dtype=np.float64)
+    dtw_batch([x, x], [None, sakoe_chiba_band(2, 2, 1)])
+    # dtw() without a band, e.g. for the alignments recorded while decoding
+    dtw_cpu(x)
+    # the median filter of the float32 alignment weights
+    median_filter_cpu(torch.zeros(1, 8), 7)
+    if torch.cuda.is_available():
+        # the trace returned by the Triton kernel is a non-contiguous int32 view
+        backtrace(np.zeros((2, 3), dtype=np.int32)[:, :2])
+
+
 @dataclass
 class WordTiming:
     word: str
@@ -169,42 +338,174 @@ def find_alignment(
     *,
     medfilt_width: int = 7,
     qk_scale: float = 1.0,
+    band: Optional[Tuple[np.ndarray, np.ndarray]] = None,
 ) -> List[WordTiming]:
-    if len(text_tokens) == 0:
-        return []
-
+    return find_alignment_batch(
+        model,
+        tokenizer,
+        [text_tokens],
+        mel.unsqueeze(0),
+        [num_frames],
+        medfilt_width=medfilt_width,
+        qk_scale=qk_scale,
+        bands=[band],
+    )[0]
+
+
+def find_alignment_batch(
+    model: "Whisper",
+    tokenizer: Tokenizer,
+    text_tokens: List[List[int]],
+    mel: torch.Tensor,
+    num_frames: List[int],
+    *,
+    medfilt_width: int = 7,
+    qk_scale: float = 1.0,
+    bands: Optional[List[Optional[Tuple[np.ndarray, np.ndarray]]]] = None,
+) -> List[List[WordTiming]]:
+    """
+    Align the text tokens of several windows at once, with one encoder and one decoder forward
+    pass over all of them and the DTW of all windows in parallel; see `find_alignment()`.
+
+    Parameters
+    ----------
+    text_tokens : List[List[int]]
+        the text tokens of each window
+    mel : torch.Tensor, shape = (n_windows, n_mels, n_frames)
+        the log-Mel spectrogram of each window
+    num_frames : List[int]
+        the number of frames of each window that contain audio
+    bands : Optional[List[Optional[Tuple[np.ndarray, np.ndarray]]]]
+        for each window, None or the DTW band of its text tokens, as in `find_alignment()`
+
+    Returns
+    -------
+    The `WordTiming`s of each window
+    """
+    if bands is None:
+        bands = [None] * len(text_tokens)
+    results = [[] for _ in text_tokens]
+    windows = [i for i, tokens in enumerate(text_tokens) if len(tokens) > 0]
+    if len(windows) == 0:
+        return results
+
+    # the text tokens of each window, right-padded with EOT, which the causal mask ignores
+    sot_sequence = [*tokenizer.sot_sequence, tokenizer.no_timestamps]
+    lengths = [len(text_tokens[i]) for i in windows]
     tokens = torch.tensor(
         [
-            *tokenizer.sot_sequence,
-            tokenizer.no_timestamps,
-            *text_tokens,
-            tokenizer.eot,
+            sot_sequence
+            + text_tokens[i]
+            + [tokenizer.eot] * (max(lengths) - len(text_tokens[i]) + 1)
+            for i in windows
         ]
     ).to(model.device)
 
-    # install hooks on the cross attention layers to retrieve the attention weights
-    QKs = [None] * model.dims.n_text_layer
-    hooks = [
-        block.cross_attn.register_forward_hook(
-            lambda _, ins, outs, index=i: QKs.__setitem__(index, outs[-1][0])
+    # the cross-attention weights of the alignment heads of each layer, before the softmax
+    QKs = []
+    qk_heads = model.alignment_heads_per_layer()
+
+    with torch.no_grad():
+        if model.onnx_runtime is not None:
+            audio_features = model.onnx_runtime.embed_audio(mel[windows])
+            logits, weights = model.onnx_runtime.align(tokens, audio_features)
+            QKs.append(weights.to(model.device))
+        else:
+            audio_features = model.embed_audio(mel[windows].to(model.device))
+            logits = model.decoder(
+                tokens, audio_features, cross_qk=QKs, qk_heads=qk_heads
+            )
+        sampled_logits = logits[:, len(tokenizer.sot_sequence) :, : tokenizer.eot]
+        token_probs = sampled_logits.softmax(dim=-1)
+        text_token_probs = [
+            token_probs[b, np.arange(n), text_tokens[i]].tolist()
+            for b, (i, n) in enumerate(zip(windows, lengths))
+        ]
+
+    # windows * heads * tokens * frames; the rows of each window are normalized over its own
+    # tokens, up to its EOT, so that the padding does not change its alignment
+    weights = torch.cat([qk for qk in QKs if qk is not None], dim=1)
+    matrices = [
+        _alignment_matrix(
+            weights[b, :, : len(sot_sequence) + n + 1],
+            num_frames[i],
+            len(tokenizer.sot_sequence),
+            n + 1,
+            medfilt_width,
+            qk_scale,
         )
-        for i, block in enumerate(model.decoder.blocks)
+        for b, (i, n) in enumerate(zip(windows, lengths))
     ]
 
-    from .model import disable_sdpa
+    if weights.is_cuda:
+        paths = [dtw(-matrix, bands[i]) for matrix, i in zip(matrices, windows)]
+    else:
+        xs = [-matrix.double().numpy() for matrix in matrices]
+        paths = dtw_batch(xs, [bands[i] for i in windows])
 
-    with torch.no_grad(), disable_sdpa():
-        logits = model(mel.unsqueeze(0), tokens.unsqueeze(0))[0]
-        sampled_logits = logits[len(tokenizer.sot_sequence) :, : tokenizer.eot]
-        token_probs = sampled_logits.softmax(dim=-1)
-        text_token_probs = token_probs[np.arange(len(text_tokens)), text_tokens]
-        text_token_probs = text_token_probs.tolist()
+    for b, (i, path) in enumerate(zip(windows, paths)):
+        text_indices, time_indices = path
+        results[i] = _word_timings(
+            tokenizer, text_tokens[i], text_indices, time_indices, text_token_probs[b]
+        )
+    return results
+
+
+def find_recorded_alignment(
+    tokenizer: Tokenizer,
+    tokens: List[int],
+    alignment_weights: torch.Tensor,
+    token_probs: List[float],
+    num_frames: int,
+    *,
+    medfilt_width: int = 7,
+    qk_scale: float = 1.0,
+    band: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+) -> List[WordTiming]:
+    """
+    Align the text tokens among `tokens` using the cross-attention weights recorded while they
+    were decoded (see `DecodingOptions.record_alignment`), instead of another decoder pass.
+
+    Parameters
+    ----------
+    tokens : List[int]
+        a prefix of the sampled tokens, including the timestamp tokens
+    alignment_weights : torch.Tensor
+        the `DecodingResult.alignment_weights` of the sampled tokens
+    token_probs : List[float]
+        the `DecodingResult.token_probs` of the sampled tokens
+    """
+    positions = [i for i, token in enumerate(tokens) if token < tokenizer.eot]
+    if len(positions) == 0:
+        return []
+
+    # as in find_alignment(), the first row is the query just before the first text token
+    rows = [positions[0]] + [i + 1 for i in positions]
+    text_tokens = [tokens[i] for i in positions]
+    matrix = _alignment_matrix(
+        alignment_weights[:, rows],
+        num_frames,
+        0,
+        len(rows),
+        medfilt_width,
+        qk_scale,
+    )
+    text_indices, time_indices = dtw(-matrix, band)
+    text_token_probs = [token_probs[i] for i in positions]
+    return _word_timings(
+        tokenizer, text_tokens, text_indices, time_indices, text_token_probs
+    )
 
-    for hook in hooks:
-        hook.remove()
 
-    # heads * tokens * frames
-    weights = torch.stack([QKs[_l][_h] for _l, _h in model.alignment_heads.indices().T])
+def _alignment_matrix(
+    weights: torch.Tensor,
+    num_frames: int,
+    first_row: int,
+    n_rows: int,
+    medfilt_width: int,
+    qk_scale: float,
+) -> torch.Tensor:
+    # heads * tokens * frames, normalized over the tokens and averaged over the heads
     weights = weights[:, :, : num_frames // 2]
     weights = (weights * qk_scale).softmax(dim=-1)
     std, mean = torch.std_mean(weights, dim=-2, keepdim=True, unbiased=False)
@@ -212,9 +513,16 @@ def find_alignment(
     weights = median_filter(weights, medfilt_width)
 
     matrix = weights.mean(axis=0)
-    matrix = matrix[len(tokenizer.sot_sequence) : -1]
-    text_indices, time_indices = dtw(-matrix)
+    return matrix[first_row : first_row + n_rows]
+
 
+def _word_timings(
+    tokenizer: Tokenizer,
+    text_tokens: List[int],
+    text_indices: np.ndarray,
+    time_indices: np.ndarray,
+    text_token_probs: List[float],
+) -> List[WordTiming]:
     words, word_tokens = tokenizer.split_to_word_tokens(text_tokens + [tokenizer.eot])
     if len(word_tokens) <= 1:
         # return on eot only
@@ -242,6 +550,30 @@ def find_alignment(
     ]
 
 
+def segment_band(
+    segments: List[dict],
+    text_tokens_per_segment: List[List[int]],
+    num_frames: int,
+    margin: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The DTW band for `find_alignment()` that keeps the tokens of each segment within `margin`
+    seconds of the segment's timestamps
+    """
+    time_offset = segments[0]["seek"] * HOP_LENGTH / SAMPLE_RATE
+    lower, upper = [], []
+    for segment, text_tokens in zip(segments, text_tokens_per_segment):
+        start = (segment["start"] - time_offset - margin) * TOKENS_PER_SECOND
+        end = (segment["end"] - time_offset + margin) * TOKENS_PER_SECOND
+        lower.extend([start] * len(text_tokens))
+        upper.extend([end] * len(text_tokens))
+
+    # the first row of the alignment is the <|notimestamps|> token before the text
+    lower.insert(0, lower[0])
+    upper.insert(0, upper[0])
+    return dtw_band(np.array(lower), np.array(upper), num_frames // 2)
+
+
 def merge_punctuations(alignment: List[WordTiming], prepended: str, appended: str):
     # merge prepended punctuations
     i = len(alignment) - 2
@@ -286,6 +618,9 @@ def add_word_timestamps(
     prepend_punctuations: str = "\"'“¿([{-",
     append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
     last_speech_timestamp: float,
+    dtw_band: Optional[float] = None,
+    alignment_weights: Optional[torch.Tensor] = None,
+    token_probs: Optional[List[float]] = None,
     **kwargs,
 ):
     if len(segments) == 0:
@@ -297,7 +632,20 @@ def add_word_timestamps(
     ]
 
     text_tokens = list(itertools.chain.from_iterable(text_tokens_per_segment))
-    alignment = find_alignment(model, tokenizer, text_tokens, mel, num_frames, **kwargs)
+    if dtw_band is not None and len(text_tokens) > 0:
+        kwargs["band"] = segment_band(
+            segments, text_tokens_per_segment, num_frames, dtw_band
+        )
+    if alignment_weights is not None and token_probs is not None:
+        # the segments are a prefix of the decoded tokens that the weights were recorded for
+        tokens = [token for segment in segments for token in segment["tokens"]]
+        alignment = find_recorded_alignment(
+            tokenizer, tokens, alignment_weights, token_probs, num_frames, **kwargs
+        )
+    else:
+        alignment = find_alignment(
+            model, tokenizer, text_tokens, mel, num_frames, **kwargs
+        )
     word_durations = np.array([t.end - t.start for t in alignment])
     word_durations = word_durations[word_durations.nonzero()]
     median_duration = np.median(word_durations) if len(word_durations) > 0 else 0.0
@@ -1,11 +1,23 @@
 import base64
+import codecs
+import itertools
+import marshal
 import os
 import string
+import sys
+import tempfile
+import weakref
 from dataclasses import dataclass, field
 from functools import cached_property, lru_cache
-from typing import Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
 
-import tiktoken
+from . import _default_download_root
+
+if TYPE_CHECKING:
+    import tiktoken
+
+# bump when the contents of the tokenizer cache change
+TOKENIZER_CACHE_VERSION = 1
 
 LANGUAGES = {
     "en": "english",
@@ -132,7 +144,7 @@ TO_LANGUAGE_CODE = {
 class Tokenizer:
     """A thin wrapper around `tiktoken` providing quick access to special tokens"""
 
-    encoding: tiktoken.Encoding
+    encoding: "tiktoken.Encoding"
     num_languages: int
     language: Optional[str] = None
     task: Optional[str] = None
@@ -140,9 +152,14 @@ class Tokenizer:
     special_tokens: Dict[str, int] = field(default_factory=dict)
 
     def __post_init__(self):
-        for special in self.encoding.special_tokens_set:
-            special_token = self.encoding.encode_single_token(special)
-            self.special_tokens[special] = special_token
+        if (cached := _cached_tokens.get(self.encoding)) is not None:
+            self.special_tokens.update(cached["special_tokens"])
+        else:
+            for special in sorted(
+                self.encoding.special_tokens_set, key=self.encoding.encode_single_token
+            ):
+                special_token = self.encoding.encode_single_token(special)
+                self.special_tokens[special] = special_token
 
         sot: int = self.special_tokens["<|startoftranscript|>"]
         translate: int = self.special_tokens["<|translate|>"]
@@ -224,6 +241,9 @@ class Tokenizer:
 
     @cached_property
     def all_language_tokens(self) -> Tuple[int]:
+        if (cached := _cached_tokens.get(self.encoding)) is not None:
+            return cached["all_language_tokens"][: self.num_languages]
+
         result = []
         for token, token_id in self.special_tokens.items():
             if token.strip("<|>") in LANGUAGES:
@@ -250,6 +270,9 @@ class Tokenizer:
 
         keeping basic punctuations like commas, periods, question marks, exclamation points, etc.
         """
+        if (cached := _cached_tokens.get(self.encoding)) is not None:
+            return cached["non_speech_tokens"]
+
         symbols = list('"#()*+/:;<=>@[\\]^_`{|}~「」『』')
         symbols += (
             "<< >> <<< >>> -- --- -( -[ (' (\" (( )) ((( ))) [[ ]] {{ }} ♪♪ ♪♪♪".split()
@@ -274,6 +297,20 @@ class Tokenizer:
 
         return tuple(sorted(result))
 
+    def vocabulary(self, texts: Iterable[str]) -> List[int]:
+        """
+        Returns the text tokens used to encode `texts`, e.g. sample transcripts of a language,
+        along with the tokens of the single bytes, which can still spell out any other text; to
+        pass as the `vocabulary` of `DecodingOptions`
+        """
+        tokens = set(
+            itertools.chain.from_iterable(
+                self.encoding.encode_ordinary_batch(list(texts))
+            )
+        )
+        tokens.update(self.encoding.encode_single_token(bytes([b])) for b in range(256))
+        return sorted(tokens)
+
     def split_to_word_tokens(self, tokens: List[int]):
         if self.language in {"zh", "ja", "th", "lo", "my", "yue"}:
             # These languages don't typically use spaces, so it is difficult to split words
@@ -284,27 +321,28 @@ class Tokenizer:
         return self.split_tokens_on_spaces(tokens)
 
     def split_tokens_on_unicode(self, tokens: List[int]):
-        decoded_full = self.decode_with_timestamps(tokens)
-        replacement_char = "\ufffd"
+        token_bytes = self.encoding.decode_tokens_bytes(tokens)
+        full_bytes = b"".join(token_bytes)
+
+        # the byte offsets between the characters of the decoded text, where invalid bytes are
+        # decoded as single-byte surrogates, so that they count as characters of their own
+        decoded_full = full_bytes.decode("utf-8", errors="surrogateescape")
+        boundaries = set(itertools.accumulate(map(_utf8_length, decoded_full)))
 
         words = []
         word_tokens = []
         current_tokens = []
-        unicode_offset = 0
+        start = end = 0
 
-        for token in tokens:
+        for token, data in zip(tokens, token_bytes):
             current_tokens.append(token)
-            decoded = self.decode_with_timestamps(current_tokens)
+            end += len(data)
 
-            if (
-                replacement_char not in decoded
-                or decoded_full[unicode_offset + decoded.index(replacement_char)]
-                == replacement_char
-            ):
-                words.append(decoded)
+            if end in boundaries:
+                words.append(full_bytes[start:end].decode("utf-8", errors="replace"))
                 word_tokens.append(current_tokens)
                 current_tokens = []
-                unicode_offset += len(decoded)
+                start = end
 
         return words, word_tokens
 
@@ -327,41 +365,154 @@ class Tokenizer:
         return words, word_tokens
 
 
+class IncrementalDetokenizer:
+    """
+    Decodes tokens as they are appended, returning only the text that they complete. Characters
+    that are split across tokens are held back until their last byte arrives, so the pieces
+    returned by `append()` and `flush()` concatenate to `tokenizer.decode()` of all the tokens,
+    or to `tokenizer.decode_with_timestamps()` if `timestamps` is True, at a constant cost per
+    token.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, timestamps: bool = False):
+        self.tokenizer = tokenizer
+        self.timestamps = timestamps
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def append(self, token: int) -> str:
+        if token >= self.tokenizer.timestamp_begin and not self.timestamps:
+            return ""
+        data = self.tokenizer.encoding.decode_single_token_bytes(token)
+        return self.decoder.decode(data)
+
+    def extend(self, tokens: List[int]) -> str:
+        return "".join(self.append(token) for token in tokens)
+
+    def flush(self) -> str:
+        """Returns the replacement character for an incomplete character at the end, if any"""
+        return self.decoder.decode(b"", final=True)
+
+    def reset(self):
+        self.decoder.reset()
+
+
+def _utf8_length(char: str) -> int:
+    """The number of bytes that `char` takes in UTF-8, or 1 for an escaped invalid byte"""
+    code = ord(char)
+    if code < 0x80 or 0xDC80 <= code <= 0xDCFF:
+        return 1
+    return 2 if code < 0x800 else 3 if code < 0x10000 else 4
+
+
+# the special tokens and derived token sets of the encodings loaded from the tokenizer cache
+_cached_tokens: "weakref.WeakKeyDictionary[tiktoken.Encoding, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _tokenizer_cache_path(name: str, num_languages: int) -> str:
+    # marshal's format is specific to the Python version
+    version = f"v{TOKENIZER_CACHE_VERSION}-py{sys.version_info[0]}{sys.version_info[1]}"
+    filename = f"{name}-{num_languages}-{version}.marshal"
+    return os.path.join(_default_download_root(), "tokenizer", filename)
+
+
+def _read_tokenizer_cache(path: str, source: Tuple[int, int]) -> Optional[dict]:
+    # a corrupted or truncated file is a cache miss, like a missing one
+    try:
+        with open(path, "rb") as f:
+            cache = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(cache, dict) or cache.get("source") != source:
+        return None
+    return cache
+
+
+def _write_tokenizer_cache(path: str, cache: dict):
+    # written to a temporary file of its own, then renamed, so that concurrent writers never
+    # interleave their writes and readers never see a partially written file
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    except OSError:
+        return  # the cache is an optimization; a read-only cache directory is not an error
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(marshal.dumps(cache))
+        os.replace(temp_path, path)
+    except OSError:
+        pass
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
 @lru_cache(maxsize=None)
 def get_encoding(name: str = "gpt2", num_languages: int = 99):
+    """
+    Load the tiktoken encoding with Whisper's special tokens. The rank table, the special tokens
+    and the token sets that `Tokenizer` derives from them are cached in a binary file under
+    ~/.cache/whisper/tokenizer, since parsing the vocabulary and finding the non-speech tokens
+    take a noticeable fraction of a second on every process start.
+    """
+    import tiktoken
+
     vocab_path = os.path.join(os.path.dirname(__file__), "assets", f"{name}.tiktoken")
-    ranks = {
-        base64.b64decode(token): int(rank)
-        for token, rank in (line.split() for line in open(vocab_path) if line)
-    }
-    n_vocab = len(ranks)
-    special_tokens = {}
-
-    specials = [
-        "<|endoftext|>",
-        "<|startoftranscript|>",
-        *[f"<|{lang}|>" for lang in list(LANGUAGES.keys())[:num_languages]],
-        "<|translate|>",
-        "<|transcribe|>",
-        "<|startoflm|>",
-        "<|startofprev|>",
-        "<|nospeech|>",
-        "<|notimestamps|>",
-        *[f"<|{i * 0.02:.2f}|>" for i in range(1501)],
-    ]
-
-    for token in specials:
-        special_tokens[token] = n_vocab
-        n_vocab += 1
-
-    return tiktoken.Encoding(
+    stat = os.stat(vocab_path)
+    source = (stat.st_size, stat.st_mtime_ns)
+    cache_path = _tokenizer_cache_path(name, num_languages)
+    cache = _read_tokenizer_cache(cache_path, source)
+
+    if cache is not None:
+        ranks, special_tokens = cache["ranks"], cache["special_tokens"]
+    else:
+        ranks = {
+            base64.b64decode(token): int(rank)
+            for token, rank in (line.split() for line in open(vocab_path) if line)
+        }
+        n_vocab = len(ranks)
+        special_tokens = {}
+
+        specials = [
+            "<|endoftext|>",
+            "<|startoftranscript|>",
+            *[f"<|{lang}|>" for lang in list(LANGUAGES.keys())[:num_languages]],
+            "<|translate|>",
+            "<|transcribe|>",
+            "<|startoflm|>",
+            "<|startofprev|>",
+            "<|nospeech|>",
+            "<|notimestamps|>",
+            *[f"<|{i * 0.02:.2f}|>" for i in range(1501)],
+        ]
+
+        for token in specials:
+            special_tokens[token] = n_vocab
+            n_vocab += 1
+
+    encoding = tiktoken.Encoding(
         name=os.path.basename(vocab_path),
-        explicit_n_vocab=n_vocab,
+        explicit_n_vocab=len(ranks) + len(special_tokens),
         pat_str=r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""",
         mergeable_ranks=ranks,
         special_tokens=special_tokens,
     )
 
+    if cache is None:
+        tokenizer = Tokenizer(encoding=encoding, num_languages=num_languages)
+        cache = {
+            "source": source,
+            "ranks": ranks,
+            "special_tokens": special_tokens,
+            "all_language_tokens": tokenizer.all_language_tokens,
+            "non_speech_tokens": tokenizer.non_speech_tokens,
+        }
+        _write_tokenizer_cache(cache_path, cache)
+
+    _cached_tokens[encoding] = cache
+    return encoding
+
 
 @lru_cache(maxsize=None)
 def get_tokenizer(
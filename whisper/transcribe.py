@@ -1,7 +1,5 @@
-import argparse
-import os
-import traceback
 import warnings
+from dataclasses import replace
 from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
 import numpy as np
@@ -9,27 +7,21 @@ import torch
 import tqdm
 
 from .audio import (
+    CHUNK_LENGTH,
     FRAMES_PER_SECOND,
     HOP_LENGTH,
     N_FRAMES,
     N_SAMPLES,
     SAMPLE_RATE,
+    load_audio,
     log_mel_spectrogram,
     pad_or_trim,
 )
-from .decoding import DecodingOptions, DecodingResult
-from .timing import add_word_timestamps
-from .tokenizer import LANGUAGES, TO_LANGUAGE_CODE, get_tokenizer
-from .utils import (
-    exact_div,
-    format_timestamp,
-    get_end,
-    get_writer,
-    make_safe,
-    optional_float,
-    optional_int,
-    str2bool,
-)
+from .cli import cli  # noqa: F401, the former location of the command-line entry point
+from .decoding import DecodingOptions, DecodingResult, decode_tasks
+from .timing import add_word_timestamps, find_alignment_batch, merge_punctuations
+from .tokenizer import LANGUAGES, IncrementalDetokenizer, get_tokenizer
+from .utils import exact_div, format_timestamp, get_end, make_safe
 
 if TYPE_CHECKING:
     from .model import Whisper
@@ -52,6 +44,13 @@ def transcribe(
     append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
     clip_timestamps: Union[str, List[float]] = "0",
     hallucination_silence_threshold: Optional[float] = None,
+    dtw_band: Optional[float] = None,
+    language_per_window: bool = False,
+    with_translation: bool = False,
+    cascade_model: Optional["Whisper"] = None,
+    cascade_logprob_threshold: Optional[float] = -0.5,
+    cascade_compression_ratio_threshold: Optional[float] = 2.0,
+    cascade_no_speech_threshold: Optional[float] = 0.4,
     **decode_options,
 ):
     """
@@ -109,7 +108,8 @@ def transcribe(
         left-sliced to make space.
 
     decode_options: dict
-        Keyword arguments to construct `DecodingOptions` instances
+        Keyword arguments to construct `DecodingOptions` instances; with word_timestamps, pass
+        `record_alignment=True` to align the words with the attention recorded while decoding
 
     clip_timestamps: Union[str, List[float]]
         Comma-separated list start,end,start,end,... timestamps (in seconds) of clips to process.
@@ -119,10 +119,45 @@ def transcribe(
         When word_timestamps is True, skip silent periods longer than this threshold (in seconds)
         when a possible hallucination is detected
 
+    dtw_band: Optional[float]
+        When word_timestamps is True, only align the words of each segment to the audio within
+        this many seconds of the segment's timestamps, which skips most of the alignment work
+
+    language_per_window: bool
+        When the language is not given, detect it in every 30-second window from the encoder
+        output that decodes the window, rather than once from the first 30 seconds, for audio that
+        switches languages. Each segment then reports its language ("language").
+
+    with_translation: bool
+        Also translate the audio into English, decoding the translation of each 30-second window
+        in the same batch as its transcription from one encoder pass. The windows follow the
+        transcription, and each keeps the translated segments centered before the point where
+        its transcription ended; word-level timestamps are only added to the transcription.
+
+    cascade_model: Optional[Whisper]
+        A larger model to decode the windows that `model` is not confident about: `model` decodes
+        each window at the first temperature, and the windows that it finds silent or that pass
+        the cascade thresholds below and the fallback thresholds are kept; the others are decoded
+        again by `cascade_model`, falling back on the temperatures. The seek and timestamps follow
+        whichever result is kept, and the tokens of the segments are those of `model`. With
+        `word_timestamps`, the words of the windows decoded again are aligned by `model` on the
+        tokens of `cascade_model`, since the alignment heads are those of `model`.
+
+    cascade_logprob_threshold: Optional[float]
+        With `cascade_model`, decode the window again if the average log probability is lower
+
+    cascade_compression_ratio_threshold: Optional[float]
+        With `cascade_model`, decode the window again if the gzip compression ratio is higher
+
+    cascade_no_speech_threshold: Optional[float]
+        With `cascade_model`, decode the window again if the no_speech probability is higher,
+        when the window isn't skipped as silent
+
     Returns
     -------
     A dictionary containing the resulting text ("text") and segment-level details ("segments"), and
     the spoken language ("language"), which is detected when `decode_options["language"]` is None.
+    With `with_translation`, the translation ("translation") has the same text and segment keys.
     """
     dtype = torch.float16 if decode_options.get("fp16", True) else torch.float32
     if model.device == torch.device("cpu"):
@@ -135,12 +170,33 @@ def transcribe(
     if dtype == torch.float32:
         decode_options["fp16"] = False
 
+    if cascade_model is not None:
+        if cascade_model.is_multilingual != model.is_multilingual:
+            raise ValueError("cascade_model should have the same vocabulary as model")
+        if with_translation:
+            raise ValueError("cascade_model cannot be combined with with_translation")
+        if isinstance(audio, str):
+            audio = load_audio(audio)  # for the spectrograms of both models
+
     # Pad 30-seconds of silence to the input audio, for slicing
     mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
+    cascade_mel, cascade_timestamp_begin = mel, None
+    if cascade_model is not None:
+        if cascade_model.dims.n_mels != model.dims.n_mels:
+            cascade_mel = log_mel_spectrogram(
+                audio, cascade_model.dims.n_mels, padding=N_SAMPLES
+            )
+        # the timestamp tokens of the models are offset if their numbers of languages differ
+        cascade_timestamp_begin = get_tokenizer(
+            cascade_model.is_multilingual, num_languages=cascade_model.num_languages
+        ).timestamp_begin
     content_frames = mel.shape[-1] - N_FRAMES
     content_duration = float(content_frames * HOP_LENGTH / SAMPLE_RATE)
 
-    if decode_options.get("language", None) is None:
+    per_window = language_per_window and model.is_multilingual
+    per_window = per_window and decode_options.get("language", None) is None
+
+    if decode_options.get("language", None) is None and not per_window:
         if not model.is_multilingual:
             decode_options["language"] = "en"
         else:
@@ -156,7 +212,8 @@ def transcribe(
                     f"Detected language: {LANGUAGES[decode_options['language']].title()}"
                 )
 
-    language: str = decode_options["language"]
+    # None until detected
+    language: Optional[str] = decode_options.get("language", None)
     task: str = decode_options.get("task", "transcribe")
     tokenizer = get_tokenizer(
         model.is_multilingual,
@@ -181,48 +238,139 @@ def transcribe(
     if word_timestamps and task == "translate":
         warnings.warn("Word-level timestamps on translations may not be reliable.")
 
-    def decode_with_fallback(segment: torch.Tensor) -> DecodingResult:
-        temperatures = (
-            [temperature] if isinstance(temperature, (int, float)) else temperature
-        )
+    if with_translation and (task != "transcribe" or not model.is_multilingual):
+        raise ValueError("with_translation requires a multilingual model transcribing")
+
+    temperatures = (
+        [temperature] if isinstance(temperature, (int, float)) else temperature
+    )
+
+    def decoding_options(t: float, **overrides) -> DecodingOptions:
+        kwargs = {**decode_options, **overrides}
+        if t > 0:
+            # disable beam_size and patience when t > 0
+            kwargs.pop("beam_size", None)
+            kwargs.pop("patience", None)
+        else:
+            # disable best_of when t == 0
+            kwargs.pop("best_of", None)
+
+        return DecodingOptions(**kwargs, temperature=t)
+
+    def needs_fallback(decode_result: DecodingResult) -> bool:
+        needs_fallback = False
+        if (
+            compression_ratio_threshold is not None
+            and decode_result.compression_ratio > compression_ratio_threshold
+        ):
+            needs_fallback = True  # too repetitive
+        if (
+            logprob_threshold is not None
+            and decode_result.avg_logprob < logprob_threshold
+        ):
+            needs_fallback = True  # average log probability is too low
+        if (
+            no_speech_threshold is not None
+            and decode_result.no_speech_prob > no_speech_threshold
+            and logprob_threshold is not None
+            and decode_result.avg_logprob < logprob_threshold
+        ):
+            needs_fallback = False  # silence
+        return needs_fallback
+
+    def is_silent(decode_result: DecodingResult) -> bool:
+        if no_speech_threshold is None:
+            return False
+
+        # no voice activity check
+        should_skip = decode_result.no_speech_prob > no_speech_threshold
+        if (
+            logprob_threshold is not None
+            and decode_result.avg_logprob > logprob_threshold
+        ):
+            # don't skip if the logprob is high enough, despite the no_speech_prob
+            should_skip = False
+        return should_skip
+
+    def decode_with_fallback(
+        segment: torch.Tensor,
+        temperatures=temperatures,
+        decoding_model: "Whisper" = model,
+        **overrides,
+    ) -> DecodingResult:
         decode_result = None
 
         for t in temperatures:
-            kwargs = {**decode_options}
-            if t > 0:
-                # disable beam_size and patience when t > 0
-                kwargs.pop("beam_size", None)
-                kwargs.pop("patience", None)
-            else:
-                # disable best_of when t == 0
-                kwargs.pop("best_of", None)
-
-            options = DecodingOptions(**kwargs, temperature=t)
-            decode_result = model.decode(segment, options)
-
-            needs_fallback = False
-            if (
-                compression_ratio_threshold is not None
-                and decode_result.compression_ratio > compression_ratio_threshold
-            ):
-                needs_fallback = True  # too repetitive
-            if (
-                logprob_threshold is not None
-                and decode_result.avg_logprob < logprob_threshold
-            ):
-                needs_fallback = True  # average log probability is too low
-            if (
-                no_speech_threshold is not None
-                and decode_result.no_speech_prob > no_speech_threshold
-                and logprob_threshold is not None
-                and decode_result.avg_logprob < logprob_threshold
-            ):
-                needs_fallback = False  # silence
-            if not needs_fallback:
+            options = decoding_options(t, **overrides)
+            decode_result = decoding_model.decode(segment, options)
+            if not needs_fallback(decode_result):
                 break
 
         return decode_result
 
+    def needs_cascade(decode_result: DecodingResult) -> bool:
+        if is_silent(decode_result):
+            return False
+        if (
+            cascade_logprob_threshold is not None
+            and decode_result.avg_logprob < cascade_logprob_threshold
+        ):
+            return True
+        if (
+            cascade_compression_ratio_threshold is not None
+            and decode_result.compression_ratio > cascade_compression_ratio_threshold
+        ):
+            return True
+        if (
+            cascade_no_speech_threshold is not None
+            and decode_result.no_speech_prob > cascade_no_speech_threshold
+        ):
+            return True
+        return needs_fallback(decode_result)
+
+    def decode_with_cascade(
+        segment: torch.Tensor, cascade_segment: torch.Tensor
+    ) -> DecodingResult:
+        decode_result = decode_with_fallback(segment, temperatures[:1])
+        if not needs_cascade(decode_result):
+            return decode_result
+
+        timestamp_begin = tokenizer.timestamp_begin
+
+        def convert_tokens(tokens: List[int], source: int, target: int) -> List[int]:
+            return [t - source + target if t >= source else t for t in tokens]
+
+        prompt = decode_options["prompt"]
+        prompt = convert_tokens(prompt, timestamp_begin, cascade_timestamp_begin)
+        decode_result = decode_with_fallback(
+            cascade_segment, decoding_model=cascade_model, prompt=prompt
+        )
+        tokens = convert_tokens(
+            decode_result.tokens, cascade_timestamp_begin, timestamp_begin
+        )
+        return replace(decode_result, tokens=tokens)
+
+    def decode_with_translation(
+        segment: torch.Tensor, translation_prompt: List[int]
+    ) -> Tuple[DecodingResult, DecodingResult]:
+        # both tasks are decoded in one batch at the first temperature; a task that needs to
+        # fall back continues alone, from the audio features of the window
+        tasks = ("transcribe", "translate")
+        prompts = (decode_options["prompt"], translation_prompt)
+        options = decoding_options(temperatures[0])
+        results = decode_tasks(model, segment, options, tasks=tasks, prompts=prompts)
+
+        return tuple(
+            (
+                decode_with_fallback(
+                    result.audio_features, temperatures[1:], task=task, prompt=prompt
+                )
+                if needs_fallback(result) and len(temperatures) > 1
+                else result
+            )
+            for result, task, prompt in zip(results, tasks, prompts)
+        )
+
     clip_idx = 0
     seek = seek_clips[clip_idx][0]
     input_stride = exact_div(
@@ -233,6 +381,8 @@ def transcribe(
     )  # time per output token: 0.02 (seconds)
     all_tokens = []
     all_segments = []
+    all_text = []
+    detokenizer = IncrementalDetokenizer(tokenizer)
     prompt_reset_since = 0
 
     remaining_prompt_length = model.dims.n_text_ctx // 2 - 1
@@ -243,12 +393,19 @@ def transcribe(
     else:
         initial_prompt_tokens = []
 
+    # with_translation: the translated tokens and segments, kept like those transcribed
+    translation_tokens = list(initial_prompt_tokens)
+    translation_segments = []
+    translation_text = []
+    translation_detokenizer = IncrementalDetokenizer(tokenizer)
+    translation_reset_since = 0
+
     def new_segment(
         *, start: float, end: float, tokens: torch.Tensor, result: DecodingResult
     ):
         tokens = tokens.tolist()
         text_tokens = [token for token in tokens if token < tokenizer.eot]
-        return {
+        segment = {
             "seek": seek,
             "start": start,
             "end": end,
@@ -259,6 +416,39 @@ def transcribe(
             "compression_ratio": result.compression_ratio,
             "no_speech_prob": result.no_speech_prob,
         }
+        if per_window:
+            segment["language"] = result.language
+        return segment
+
+    def timestamped_segments(
+        result: DecodingResult, time_offset: float, segment_duration: float
+    ) -> List[dict]:
+        # the segments between the timestamp tokens of a window from `previous_seek`, without
+        # the unfinished text after the last one; without any, the window is one segment
+        tokens = torch.tensor(result.tokens)
+        timestamps = (tokens >= tokenizer.timestamp_begin).nonzero().flatten().tolist()
+        segments = []
+        for i, j in zip(timestamps[::2], timestamps[1::2]):
+            start_timestamp_pos = result.tokens[i] - tokenizer.timestamp_begin
+            end_timestamp_pos = result.tokens[j] - tokenizer.timestamp_begin
+            segments.append(
+                new_segment(
+                    start=time_offset + start_timestamp_pos * time_precision,
+                    end=time_offset + end_timestamp_pos * time_precision,
+                    tokens=tokens[i : j + 1],
+                    result=result,
+                )
+            )
+        if not segments and len(tokens) > 0:
+            segments.append(
+                new_segment(
+                    start=time_offset,
+                    end=time_offset + segment_duration,
+                    tokens=tokens,
+                    result=result,
+                )
+            )
+        return [{**segment, "seek": previous_seek} for segment in segments]
 
     # show the progress bar when verbose is False (if True, transcribed text will be printed)
     with tqdm.tqdm(
@@ -292,22 +482,48 @@ def transcribe(
             else:
                 decode_options["prompt"] = all_tokens[prompt_reset_since:]
 
-            result: DecodingResult = decode_with_fallback(mel_segment)
-            tokens = torch.tensor(result.tokens)
+            decode_input = mel_segment
+            if per_window:
+                # encode the window once, for both its language and the decoding passes
+                with torch.no_grad():
+                    if model.onnx_runtime is not None:
+                        decode_input = model.onnx_runtime.embed_audio(mel_segment[None])
+                    else:
+                        decode_input = model.embed_audio(mel_segment[None])
+                    decode_input = decode_input[0]
+                _, probs = model.detect_language(decode_input)
+                decode_options["language"] = max(probs, key=probs.get)
+                language = language or decode_options["language"]
+                tokenizer = get_tokenizer(
+                    model.is_multilingual,
+                    num_languages=model.num_languages,
+                    language=decode_options["language"],
+                    task=task,
+                )
 
-            if no_speech_threshold is not None:
-                # no voice activity check
-                should_skip = result.no_speech_prob > no_speech_threshold
-                if (
-                    logprob_threshold is not None
-                    and result.avg_logprob > logprob_threshold
-                ):
-                    # don't skip if the logprob is high enough, despite the no_speech_prob
-                    should_skip = False
+            if with_translation:
+                if carry_initial_prompt:
+                    nignored = max(len(initial_prompt_tokens), translation_reset_since)
+                    remaining_prompt = translation_tokens[nignored:]
+                    remaining_prompt = remaining_prompt[-remaining_prompt_length:]
+                    translation_prompt = initial_prompt_tokens + remaining_prompt
+                else:
+                    translation_prompt = translation_tokens[translation_reset_since:]
+                result, translation = decode_with_translation(
+                    decode_input, translation_prompt
+                )
+            elif cascade_model is not None:
+                cascade_segment = cascade_mel[:, seek : seek + segment_size]
+                cascade_segment = pad_or_trim(cascade_segment, N_FRAMES)
+                cascade_segment = cascade_segment.to(cascade_model.device).to(dtype)
+                result = decode_with_cascade(decode_input, cascade_segment)
+            else:
+                result: DecodingResult = decode_with_fallback(decode_input)
+            tokens = torch.tensor(result.tokens)
 
-                if should_skip:
-                    seek += segment_size  # fast-forward to the next segment boundary
-                    continue
+            if is_silent(result):
+                seek += segment_size  # fast-forward to the next segment boundary
+                continue
 
             previous_seek = seek
             current_segments = []
@@ -408,6 +624,9 @@ def transcribe(
                     prepend_punctuations=prepend_punctuations,
                     append_punctuations=append_punctuations,
                     last_speech_timestamp=last_speech_timestamp,
+                    dtw_band=dtw_band,
+                    alignment_weights=result.alignment_weights,
+                    token_probs=result.token_probs,
                 )
 
                 if not single_timestamp_ending:
@@ -475,6 +694,38 @@ def transcribe(
                 if last_word_end is not None:
                     last_speech_timestamp = last_word_end
 
+            if with_translation:
+                # the translated segments of the part of the window that was transcribed
+                transcribed_until = min(seek, previous_seek + segment_size)
+                transcribed_until = float(transcribed_until * HOP_LENGTH / SAMPLE_RATE)
+                translated = [
+                    segment
+                    for segment in timestamped_segments(
+                        translation, time_offset, segment_duration
+                    )
+                    if segment["start"] + segment["end"] < 2 * transcribed_until
+                ]
+                for segment in translated:
+                    if (
+                        segment["start"] == segment["end"]
+                        or not segment["text"].strip()
+                    ):
+                        segment["text"] = ""
+                        segment["tokens"] = []
+                translation_segments.extend(
+                    [
+                        {"id": i, **segment}
+                        for i, segment in enumerate(
+                            translated, start=len(translation_segments)
+                        )
+                    ]
+                )
+                new_tokens = [t for segment in translated for t in segment["tokens"]]
+                translation_tokens.extend(new_tokens)
+                translation_text.append(translation_detokenizer.extend(new_tokens))
+                if not condition_on_previous_text or translation.temperature > 0.5:
+                    translation_reset_since = len(translation_tokens)
+
             if verbose:
                 for segment in current_segments:
                     start, end, text = segment["start"], segment["end"], segment["text"]
@@ -496,9 +747,9 @@ def transcribe(
                     )
                 ]
             )
-            all_tokens.extend(
-                [token for segment in current_segments for token in segment["tokens"]]
-            )
+            new_tokens = [t for segment in current_segments for t in segment["tokens"]]
+            all_tokens.extend(new_tokens)
+            all_text.append(detokenizer.extend(new_tokens))
 
             if not condition_on_previous_text or result.temperature > 0.5:
                 # do not feed the prompt tokens if a high temperature was used
@@ -507,116 +758,173 @@ def transcribe(
             # update progress bar
             pbar.update(min(content_frames, seek) - previous_seek)
 
-    return dict(
-        text=tokenizer.decode(all_tokens[len(initial_prompt_tokens) :]),
+    output = dict(
+        text="".join(all_text) + detokenizer.flush(),
         segments=all_segments,
         language=language,
     )
+    if with_translation:
+        output["translation"] = dict(
+            text="".join(translation_text) + translation_detokenizer.flush(),
+            segments=translation_segments,
+        )
+    return output
 
 
-def cli():
-    from . import available_models
+def align(
+    model: "Whisper",
+    audio: Union[str, np.ndarray, torch.Tensor],
+    text: str,
+    *,
+    language: Optional[str] = None,
+    batch_size: int = 8,
+    prepend_punctuations: str = "\"'“¿([{-",
+    append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
+    medfilt_width: int = 7,
+    qk_scale: float = 1.0,
+    fp16: bool = True,
+):
+    """
+    Find the word-level timestamps of a known transcript of an audio file, without decoding
 
-    def valid_model_name(name):
-        if name in available_models() or os.path.exists(name):
-            return name
-        raise ValueError(
-            f"model should be one of {available_models()} or path to a model checkpoint"
-        )
+    The transcript is split at word boundaries over the 30-second windows of the audio, in
+    proportion to its length, assuming a steady rate of speech. Each window is then aligned to
+    its words with the teacher-forced pass of `find_alignment()`, several windows at a time.
 
-    # fmt: off
-    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("audio", nargs="+", type=str, help="audio file(s) to transcribe")
-    parser.add_argument("--model", default="turbo", type=valid_model_name, help="name of the Whisper model to use")
-    parser.add_argument("--model_dir", type=str, default=None, help="the path to save model files; uses ~/.cache/whisper by default")
-    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="device to use for PyTorch inference")
-    parser.add_argument("--output_dir", "-o", type=str, default=".", help="directory to save the outputs")
-    parser.add_argument("--output_format", "-f", type=str, default="all", choices=["txt", "vtt", "srt", "tsv", "json", "all"], help="format of the output file; if not specified, all available formats will be produced")
-    parser.add_argument("--verbose", type=str2bool, default=True, help="whether to print out the progress and debug messages")
-
-    parser.add_argument("--task", type=str, default="transcribe", choices=["transcribe", "translate"], help="whether to perform X->X speech recognition ('transcribe') or X->English translation ('translate')")
-    parser.add_argument("--language", type=str, default=None, choices=sorted(LANGUAGES.keys()) + sorted([k.title() for k in TO_LANGUAGE_CODE.keys()]), help="language spoken in the audio, specify None to perform language detection")
-
-    parser.add_argument("--temperature", type=float, default=0, help="temperature to use for sampling")
-    parser.add_argument("--best_of", type=optional_int, default=5, help="number of candidates when sampling with non-zero temperature")
-    parser.add_argument("--beam_size", type=optional_int, default=5, help="number of beams in beam search, only applicable when temperature is zero")
-    parser.add_argument("--patience", type=float, default=None, help="optional patience value to use in beam decoding, as in https://arxiv.org/abs/2204.05424, the default (1.0) is equivalent to conventional beam search")
-    parser.add_argument("--length_penalty", type=float, default=None, help="optional token length penalty coefficient (alpha) as in https://arxiv.org/abs/1609.08144, uses simple length normalization by default")
-
-    parser.add_argument("--suppress_tokens", type=str, default="-1", help="comma-separated list of token ids to suppress during sampling; '-1' will suppress most special characters except common punctuations")
-    parser.add_argument("--initial_prompt", type=str, default=None, help="optional text to provide as a prompt for the first window.")
-    parser.add_argument("--carry_initial_prompt", type=str2bool, default=False, help="if True, prepend initial_prompt to every internal decode() call. May reduce the effectiveness of condition_on_previous_text")
-
-    parser.add_argument("--condition_on_previous_text", type=str2bool, default=True, help="if True, provide the previous output of the model as a prompt for the next window; disabling may make the text inconsistent across windows, but the model becomes less prone to getting stuck in a failure loop")
-    parser.add_argument("--fp16", type=str2bool, default=True, help="whether to perform inference in fp16; True by default")
-
-    parser.add_argument("--temperature_increment_on_fallback", type=optional_float, default=0.2, help="temperature to increase when falling back when the decoding fails to meet either of the thresholds below")
-    parser.add_argument("--compression_ratio_threshold", type=optional_float, default=2.4, help="if the gzip compression ratio is higher than this value, treat the decoding as failed")
-    parser.add_argument("--logprob_threshold", type=optional_float, default=-1.0, help="if the average log probability is lower than this value, treat the decoding as failed")
-    parser.add_argument("--no_speech_threshold", type=optional_float, default=0.6, help="if the probability of the <|nospeech|> token is higher than this value AND the decoding has failed due to `logprob_threshold`, consider the segment as silence")
-    parser.add_argument("--word_timestamps", type=str2bool, default=False, help="(experimental) extract word-level timestamps and refine the results based on them")
-    parser.add_argument("--prepend_punctuations", type=str, default="\"\'“¿([{-", help="if word_timestamps is True, merge these punctuation symbols with the next word")
-    parser.add_argument("--append_punctuations", type=str, default="\"\'.。,，!！?？:：”)]}、", help="if word_timestamps is True, merge these punctuation symbols with the previous word")
-    parser.add_argument("--highlight_words", type=str2bool, default=False, help="(requires --word_timestamps True) underline each word as it is spoken in srt and vtt")
-    parser.add_argument("--max_line_width", type=optional_int, default=None, help="(requires --word_timestamps True) the maximum number of characters in a line before breaking the line")
-    parser.add_argument("--max_line_count", type=optional_int, default=None, help="(requires --word_timestamps True) the maximum number of lines in a segment")
-    parser.add_argument("--max_words_per_line", type=optional_int, default=None, help="(requires --word_timestamps True, no effect with --max_line_width) the maximum number of words in a segment")
-    parser.add_argument("--threads", type=optional_int, default=0, help="number of threads used by torch for CPU inference; supercedes MKL_NUM_THREADS/OMP_NUM_THREADS")
-    parser.add_argument("--clip_timestamps", type=str, default="0", help="comma-separated list start,end,start,end,... timestamps (in seconds) of clips to process, where the last end timestamp defaults to the end of the file")
-    parser.add_argument("--hallucination_silence_threshold", type=optional_float, help="(requires --word_timestamps True) skip silent periods longer than this threshold (in seconds) when a possible hallucination is detected")
-    # fmt: on
-
-    args = parser.parse_args().__dict__
-    model_name: str = args.pop("model")
-    model_dir: str = args.pop("model_dir")
-    output_dir: str = args.pop("output_dir")
-    output_format: str = args.pop("output_format")
-    device: str = args.pop("device")
-    os.makedirs(output_dir, exist_ok=True)
-
-    if model_name.endswith(".en") and args["language"] not in {"en", "English"}:
-        if args["language"] is not None:
-            warnings.warn(
-                f"{model_name} is an English-only model but receipted '{args['language']}'; using English instead."
-            )
-        args["language"] = "en"
+    Parameters
+    ----------
+    model: Whisper
+        The Whisper model instance
 
-    temperature = args.pop("temperature")
-    if (increment := args.pop("temperature_increment_on_fallback")) is not None:
-        temperature = tuple(np.arange(temperature, 1.0 + 1e-6, increment))
-    else:
-        temperature = [temperature]
+    audio: Union[str, np.ndarray, torch.Tensor]
+        The path to the audio file to open, or the audio waveform
+
+    text: str
+        The transcript of the audio
 
-    if (threads := args.pop("threads")) > 0:
-        torch.set_num_threads(threads)
+    language: Optional[str]
+        The language of the transcript; detected from the first 30 seconds of the audio if None
 
-    from . import load_model
+    batch_size: int
+        The number of windows to align in each forward pass
 
-    model = load_model(model_name, device=device, download_root=model_dir)
+    prepend_punctuations: str
+        Merge these punctuation symbols with the next word
+
+    append_punctuations: str
+        Merge these punctuation symbols with the previous word
+
+    fp16: bool
+        Whether to run the forward passes in float16, as in `transcribe()`; on CPU, they always
+        run in float32
+
+    Returns
+    -------
+    A dictionary with the transcript ("text"), one segment with its words and their timestamps
+    ("segments") per window that contains words, and the language ("language"), in the format
+    of `transcribe(..., word_timestamps=True)`.
+    """
+    dtype = torch.float16 if fp16 else torch.float32
+    if model.device == torch.device("cpu"):
+        if torch.cuda.is_available():
+            warnings.warn("Performing inference on CPU when CUDA is available")
+        if dtype == torch.float16:
+            warnings.warn("FP16 is not supported on CPU; using FP32 instead")
+            dtype = torch.float32
 
-    writer = get_writer(output_format, output_dir)
-    word_options = [
-        "highlight_words",
-        "max_line_count",
-        "max_line_width",
-        "max_words_per_line",
+    mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
+    content_frames = mel.shape[-1] - N_FRAMES
+    n_windows = max(1, -(-content_frames // N_FRAMES))
+    windows = torch.stack(
+        [
+            pad_or_trim(mel[:, seek : seek + N_FRAMES], N_FRAMES)
+            for seek in range(0, n_windows * N_FRAMES, N_FRAMES)
+        ]
+    ).to(model.device, dtype)
+    num_frames = [
+        max(0, min(N_FRAMES, content_frames - seek))
+        for seek in range(0, n_windows * N_FRAMES, N_FRAMES)
     ]
-    if not args["word_timestamps"]:
-        for option in word_options:
-            if args[option]:
-                parser.error(f"--{option} requires --word_timestamps True")
-    if args["max_line_count"] and not args["max_line_width"]:
-        warnings.warn("--max_line_count has no effect without --max_line_width")
-    if args["max_words_per_line"] and args["max_line_width"]:
-        warnings.warn("--max_words_per_line has no effect with --max_line_width")
-    writer_args = {arg: args.pop(arg) for arg in word_options}
-    for audio_path in args.pop("audio"):
-        try:
-            result = transcribe(model, audio_path, temperature=temperature, **args)
-            writer(result, audio_path, **writer_args)
-        except Exception as e:
-            traceback.print_exc()
-            print(f"Skipping {audio_path} due to {type(e).__name__}: {str(e)}")
+
+    if language is None:
+        language = "en"
+        if model.is_multilingual:
+            _, probs = model.detect_language(windows[0])
+            language = max(probs, key=probs.get)
+
+    tokenizer = get_tokenizer(
+        model.is_multilingual,
+        num_languages=model.num_languages,
+        language=language,
+        task="transcribe",
+    )
+
+    # assign each word to the window that its middle character falls in
+    words, word_tokens = tokenizer.split_to_word_tokens(
+        tokenizer.encode(" " + text.strip())
+    )
+    lengths = np.array([len(word) for word in words])
+    middles = (np.cumsum(lengths) - lengths / 2) / max(lengths.sum(), 1)
+    window_indices = np.minimum(
+        (middles * content_frames / N_FRAMES).astype(int), n_windows - 1
+    )
+    text_tokens = [[] for _ in range(n_windows)]
+    for index, tokens in zip(window_indices, word_tokens):
+        text_tokens[index].extend(tokens)
+
+    # each window is decoded as the SOT sequence, <|notimestamps|>, its text tokens and EOT
+    n_special = len(tokenizer.sot_sequence) + 2
+    for i, tokens in enumerate(text_tokens):
+        if n_special + len(tokens) > model.dims.n_text_ctx:
+            raise ValueError(
+                f"The transcript has {len(tokens)} tokens in the 30-second window at"
+                f" {i * CHUNK_LENGTH} seconds, more than the {model.dims.n_text_ctx - n_special}"
+                " that the text context of the model can align at once"
+            )
+
+    alignments = []
+    for i in range(0, n_windows, batch_size):
+        alignments.extend(
+            find_alignment_batch(
+                model,
+                tokenizer,
+                text_tokens[i : i + batch_size],
+                windows[i : i + batch_size],
+                num_frames[i : i + batch_size],
+                medfilt_width=medfilt_width,
+                qk_scale=qk_scale,
+            )
+        )
+
+    segments = []
+    for i, (tokens, alignment) in enumerate(zip(text_tokens, alignments)):
+        merge_punctuations(alignment, prepend_punctuations, append_punctuations)
+        time_offset = i * N_FRAMES * HOP_LENGTH / SAMPLE_RATE
+        words = [
+            dict(
+                word=timing.word,
+                start=round(time_offset + timing.start, 2),
+                end=round(time_offset + timing.end, 2),
+                probability=timing.probability,
+            )
+            for timing in alignment
+            if timing.word
+        ]
+        if len(words) == 0:
+            continue
+        segments.append(
+            {
+                "id": len(segments),
+                "seek": i * N_FRAMES,
+                "start": words[0]["start"],
+                "end": words[-1]["end"],
+                "text": tokenizer.decode(tokens),
+                "tokens": tokens,
+                "words": words,
+            }
+        )
+
+    return dict(text=text, segments=segments, language=language)
 
 
 if __name__ == "__main__":